@@ -0,0 +1,271 @@
+# analytics.py
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import catalog
+import metrics
+import models
+import partitioning
+from logger import get_logger
+
+# Columnar snapshot of every rating (hot and archived) for the /analytics endpoints.
+#
+# A build writes one directory of .npy files, "<path>/<version>/", then points "<path>/CURRENT"
+# at it with an atomic rename. Workers map the arrays read-only (np.load(mmap_mode="r")), so the
+# pages are shared through the OS page cache and a request only touches the slices it needs:
+#   - ratings sorted by (movie_id, created_at): a movie is one searchsorted range
+#   - user_order: the rating positions sorted by user_id, with user_ids_sorted to find a user
+#   - created_sorted: every timestamp sorted, time series are searchsorted bin edges
+#   - movie_ids / movie_counts / movie_sums: per-movie aggregates, genres are a bincount over them
+# Timestamps are seconds since the epoch (UTC). numpy is imported on first use, so importing the
+# module (main does) costs nothing while analytics are disabled. Snapshots are written by
+# "python jobs.py analytics-build" (or the long running "analytics-builder"), never by the API.
+
+HISTOGRAM_BUCKETS = [i / 2 for i in range(11)]  # half stars, 0 to 5
+INTERVALS = {"day": 86400, "week": 7 * 86400, "month": None}
+MAX_BINS = 1000
+CHUNK_SIZE = 100_000
+KEEP_VERSIONS = 2
+
+PATH = None
+CHECK_INTERVAL = 1.0
+
+logger = get_logger(__name__)
+
+
+def configure(settings):
+    global PATH, CHECK_INTERVAL, reader
+    PATH = settings.analytics_path
+    CHECK_INTERVAL = settings.analytics_check_seconds
+    reader = AnalyticsReader(PATH, CHECK_INTERVAL) if PATH else None
+
+
+def _seconds(value: datetime) -> int:
+    # naive values (the database's) are UTC, aware ones (query parameters) keep their offset
+    if value.tzinfo is not None:
+        return int(value.timestamp())
+    return int(value.replace(tzinfo=timezone.utc).timestamp())
+
+
+def _datetime(value) -> datetime:
+    return datetime.fromtimestamp(int(value), timezone.utc).replace(tzinfo=None)
+
+
+def _genres(value):
+    return [genre.strip() for genre in (value or "").split(",") if genre.strip()]
+
+
+# Build
+
+def _load_ratings(db: Session):
+    import numpy as np
+    # (movie_id, user_id, rating, created_at) arrays of hot and archived ratings, read in chunks
+    columns = ("movie_id", "user_id", "rating", "created_at")
+    hot = db.execute(select(*[models.Rating.__table__.c[name] for name in columns]).execution_options(yield_per=CHUNK_SIZE))
+    sources = [hot.partitions(), partitioning.iter_archived(db, "ratings", columns, CHUNK_SIZE)]
+    movie_ids, user_ids, ratings, created = [np.empty(0, "<i8")], [np.empty(0, "<i8")], [np.empty(0, "<f4")], [np.empty(0, "<i8")]
+    for source in sources:
+        for chunk in source:
+            movie_ids.append(np.fromiter((row[0] for row in chunk), dtype="<i8", count=len(chunk)))
+            # ratings of deleted users keep counting under user -1
+            user_ids.append(np.fromiter((-1 if row[1] is None else row[1] for row in chunk), dtype="<i8", count=len(chunk)))
+            ratings.append(np.fromiter((row[2] for row in chunk), dtype="<f4", count=len(chunk)))
+            created.append(np.fromiter((_seconds(row[3]) for row in chunk), dtype="<i8", count=len(chunk)))
+    return np.concatenate(movie_ids), np.concatenate(user_ids), np.concatenate(ratings), np.concatenate(created)
+
+
+def build(db: Session, path: str):
+    """
+    Writes a new snapshot version under path and makes it current. Returns the number of ratings
+    """
+    import numpy as np
+    started = time.time()
+    movie_ids, user_ids, ratings, created = _load_ratings(db)
+    order = np.lexsort((created, movie_ids))
+    arrays = {
+        "movie_id": movie_ids[order],
+        "user_id": user_ids[order],
+        "rating": ratings[order],
+        "created_at": created[order],
+    }
+    user_order = np.argsort(arrays["user_id"], kind="stable")
+    arrays["user_order"] = user_order
+    arrays["user_ids_sorted"] = arrays["user_id"][user_order]
+    arrays["created_sorted"] = np.sort(arrays["created_at"])
+    rated_movies, starts, counts = np.unique(arrays["movie_id"], return_index=True, return_counts=True)
+    arrays["movie_ids"] = rated_movies
+    arrays["movie_counts"] = counts
+    arrays["movie_sums"] = np.add.reduceat(arrays["rating"].astype("<f8"), starts) if len(starts) else np.empty(0, "<f8")
+
+    # (movie, genre) pairs
+    genre_names = []
+    genre_codes = {}
+    pair_movies, pair_genres = [], []
+    for movie_id, genres in db.execute(select(models.Movie.id, models.Movie.genres)):
+        for genre in _genres(genres):
+            pair_movies.append(movie_id)
+            pair_genres.append(genre_codes.setdefault(genre, len(genre_names)))
+            if len(genre_names) < len(genre_codes):
+                genre_names.append(genre)
+    arrays["genre_movie"] = np.array(pair_movies, dtype="<i8")
+    arrays["genre_code"] = np.array(pair_genres, dtype="<i8")
+
+    os.makedirs(path, exist_ok=True)
+    version = f"{time.time_ns()}-{os.getpid()}"
+    directory = os.path.join(path, version)
+    os.makedirs(directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), array)
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"built_at": started, "count": int(len(order)), "genres": genre_names}, f)
+    pointer = os.path.join(path, f"CURRENT.{os.getpid()}.tmp")
+    with open(pointer, "w") as f:
+        f.write(version)
+    os.replace(pointer, os.path.join(path, "CURRENT"))
+
+    # readers keep mapped files open, removing the directory entries doesn't affect them
+    versions = sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+
+    metrics.inc("analytics_builds_total")
+    metrics.set_gauge("analytics_build_seconds", time.time() - started)
+    logger.info(f"Analytics snapshot {version} written with {len(order)} rating(s)")
+    return int(len(order))
+
+
+# Queries
+
+class AnalyticsSnapshot:
+
+    def __init__(self, directory: str):
+        import numpy as np
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.version = os.path.basename(directory)
+        self.built_at = meta["built_at"]
+        self.count = meta["count"]
+        self.genre_names = meta["genres"]
+        for name in ("movie_id", "user_id", "rating", "created_at", "user_order", "user_ids_sorted", "created_sorted",
+                     "movie_ids", "movie_counts", "movie_sums", "genre_movie", "genre_code"):
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+
+    def _movie_slice(self, movie_id: int):
+        import numpy as np
+        return slice(int(np.searchsorted(self.movie_id, movie_id, "left")), int(np.searchsorted(self.movie_id, movie_id, "right")))
+
+    @staticmethod
+    def _summary(ratings):
+        import numpy as np
+        buckets = np.clip(np.rint(np.asarray(ratings) * 2).astype(np.int64), 0, len(HISTOGRAM_BUCKETS) - 1)
+        counts = np.bincount(buckets, minlength=len(HISTOGRAM_BUCKETS))
+        return {
+            "count": int(len(ratings)),
+            "average": round(float(ratings.mean(dtype=np.float64)), 2) if len(ratings) else None,
+            "histogram": [{"rating": bucket, "count": int(count)} for bucket, count in zip(HISTOGRAM_BUCKETS, counts)],
+        }
+
+    def movie_histogram(self, movie_id: int):
+        return {"movie_id": movie_id, **self._summary(self.rating[self._movie_slice(movie_id)])}
+
+    def genres(self):
+        import numpy as np
+        positions = np.searchsorted(self.movie_ids, self.genre_movie)
+        found = positions < len(self.movie_ids)
+        found[found] = self.movie_ids[positions[found]] == self.genre_movie[found]
+        codes = self.genre_code[found]
+        genre_count = len(self.genre_names)
+        counts = np.bincount(codes, weights=self.movie_counts[positions[found]], minlength=genre_count)
+        sums = np.bincount(codes, weights=self.movie_sums[positions[found]], minlength=genre_count)
+        movies = np.bincount(self.genre_code, minlength=genre_count)
+        return [
+            {"genre": name, "movies": int(movies[code]), "ratings": int(counts[code]),
+             "average_rating": round(float(sums[code] / counts[code]), 2) if counts[code] else None}
+            for code, name in sorted(enumerate(self.genre_names), key=lambda item: item[1])
+        ]
+
+    def timeseries(self, interval: str, since: datetime = None, until: datetime = None, movie_id: int = None):
+        import numpy as np
+        times = self.created_at[self._movie_slice(movie_id)] if movie_id is not None else self.created_sorted
+        if not len(times) and (since is None or until is None):
+            return []
+        start = _seconds(since) if since is not None else int(times[0])
+        end = _seconds(until) if until is not None else int(times[-1]) + 1
+        edges = _bin_edges(interval, start, end)
+        counts = np.diff(np.searchsorted(times, edges))
+        return [{"start": _datetime(edge), "count": int(count)} for edge, count in zip(edges[:-1], counts)]
+
+    def user_stats(self, user_id: int):
+        import numpy as np
+        lo, hi = int(np.searchsorted(self.user_ids_sorted, user_id, "left")), int(np.searchsorted(self.user_ids_sorted, user_id, "right"))
+        positions = np.sort(self.user_order[lo:hi])
+        ratings = self.rating[positions]
+        stats = {"user_id": user_id, **self._summary(ratings)}
+        if len(positions):
+            created = self.created_at[positions]
+            stats.update({
+                "min": float(ratings.min()),
+                "max": float(ratings.max()),
+                "movies": int(len(np.unique(self.movie_id[positions]))),
+                "first_rated_at": _datetime(created.min()),
+                "last_rated_at": _datetime(created.max()),
+            })
+        return stats
+
+
+def _too_many_bins(interval: str) -> ValueError:
+    return ValueError(f"The time range needs more than {MAX_BINS} {interval} buckets, narrow since/until or use a longer interval")
+
+
+def _bin_edges(interval: str, start: int, end: int):
+    import numpy as np
+    if interval not in INTERVALS:
+        raise ValueError(f"Unknown interval {interval}, use one of {', '.join(INTERVALS)}")
+    if interval == "month":
+        first = _datetime(start)
+        edges = [datetime(first.year, first.month, 1)]
+        while _seconds(edges[-1]) < end and len(edges) <= MAX_BINS:
+            edges.append(partitioning.next_month(edges[-1]))
+        if _seconds(edges[-1]) < end:
+            raise _too_many_bins(interval)
+        edges = [_seconds(edge) for edge in edges]
+    else:
+        step = INTERVALS[interval]
+        # days start at midnight UTC, weeks on Monday (the epoch was a Thursday)
+        offset = 4 * 86400 if interval == "week" else 0
+        first = (start - offset) // step * step + offset
+        bins = -(-(end - first) // step)
+        if bins > MAX_BINS:
+            raise _too_many_bins(interval)
+        edges = [first + i * step for i in range(bins + 1)]
+    return np.array(edges, dtype="<i8")
+
+
+class AnalyticsReader(catalog.SnapshotReader):
+    """
+    Per-worker handle on the current snapshot version, rechecked at most every check_interval
+    """
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        super().__init__(path, check_interval)
+
+    def _version(self):
+        try:
+            with open(os.path.join(self.path, "CURRENT")) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _load(self, version):
+        return AnalyticsSnapshot(os.path.join(self.path, version))
+
+    def _loaded(self):
+        metrics.set_gauge("analytics_snapshot_ratings", self.snapshot.count)
+
+
+reader = None
+
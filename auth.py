@@ -1,6 +1,4 @@
 #auth.py
-import os
-
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
@@ -8,16 +6,20 @@ from passlib.context import CryptContext
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from dotenv import load_dotenv
 import crud
 from database import get_db
 
-load_dotenv()
+
+SECRET_KEY = None
+ALGORITHM = None
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 
-SECRET_KEY = os.environ.get('SECRET_KEY') 
-ALGORITHM = os.environ.get('ALGORITHM')
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES',30))
+def configure(settings):
+    global SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+    SECRET_KEY = settings.secret_key
+    ALGORITHM = settings.algorithm
+    ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
@@ -59,3 +61,8 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
          raise credentials_exception
     return user
 
+
+def get_current_admin(current_user = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    return current_user
@@ -0,0 +1,501 @@
+# catalog.py
+import glob
+import json
+import math
+import mmap
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+import metrics
+import models
+from logger import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Read-only, memory-mapped snapshot of the movies table shared by every worker.
+#
+# Layout: MAGIC, a little-endian uint64 header length, a JSON header, then 8-byte aligned
+# sections: one fixed-width numpy array per numeric column, an (offset, length) pair of arrays
+# per string column and a utf-8 string heap. Rows are sorted by id, so the id column doubles as
+# the id -> row index (binary search). Workers map the file with numpy views, so pages live once
+# in the OS page cache instead of once per process. numpy is only imported by the functions
+# reading or writing snapshots, so writers that merely touch() movies never load it.
+#
+# Writers call touch(); after the transaction commits the movie ids are appended to
+# "<path>.dirty" and the builder (python jobs.py catalog-builder) rebuilds the snapshot from the
+# previous one plus the dirty rows, then atomically replaces the file. The builder claims the log
+# by renaming it to "<path>.dirty.<suffix>" under an exclusive lock, so no writer can append to
+# a claimed log, and deletes claimed logs only once the new snapshot is in place; the logs of a
+# failed build are picked up again by the next one.
+
+MAGIC = b"MVCAT001"
+FORMAT_VERSION = 1
+
+NUMERIC_COLUMNS = {
+    "id": "<i8",
+    "owner_id": "<i8",
+    "year_released": "<i8",
+    "created_at": "<i8",       # microseconds since the epoch, naive UTC
+    "average_rating": "<f8",   # NaN for NULL
+    "comment_count": "<i8",
+    "reply_count": "<i8",
+    "rating_count": "<i8",
+}
+STRING_COLUMNS = (
+    "title", "description", "genres", "writer", "director", "cast", "language", "Runtime",
+    "owner_username", "owner_full_name", "owner_email",
+)
+NULL_INT = -(1 << 63)  # numpy.iinfo(int64).min
+
+PATH = None
+CHECK_INTERVAL = 0.5
+
+logger = get_logger(__name__)
+
+
+def configure(settings):
+    global PATH, CHECK_INTERVAL, reader
+    PATH = settings.catalog_path
+    CHECK_INTERVAL = settings.catalog_check_seconds
+    reader = CatalogReader(PATH, CHECK_INTERVAL) if PATH else None
+
+
+def _to_micros(value: datetime):
+    if value is None:
+        return NULL_INT
+    return int(value.replace(tzinfo=timezone.utc).timestamp()) * 1_000_000 + value.microsecond
+
+
+def _from_micros(value: int):
+    if value == NULL_INT:
+        return None
+    seconds, micros = divmod(int(value), 1_000_000)
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None, microsecond=micros)
+
+
+def movie_row(movie: models.Movie) -> dict:
+    owner = movie.owner
+    return {
+        "id": movie.id,
+        "owner_id": movie.owner_id,
+        "year_released": movie.year_released,
+        "created_at": movie.created_at,
+        "average_rating": movie.average_rating,
+        "comment_count": movie.comment_count,
+        "reply_count": movie.reply_count,
+        "rating_count": movie.rating_count,
+        "title": movie.title,
+        "description": movie.description,
+        "genres": movie.genres,
+        "writer": movie.writer,
+        "director": movie.director,
+        "cast": movie.cast,
+        "language": movie.language,
+        "Runtime": movie.Runtime,
+        "owner_username": owner.username if owner else None,
+        "owner_full_name": owner.full_name if owner else None,
+        "owner_email": owner.email if owner else None,
+    }
+
+
+def _align(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _encode(rows):
+    import numpy as np
+    # column arrays and string heap of rows, sorted by id
+    rows = sorted(rows, key=lambda row: row["id"])
+    count = len(rows)
+    arrays = {}
+    for name, dtype in NUMERIC_COLUMNS.items():
+        if name == "created_at":
+            values = [_to_micros(row[name]) for row in rows]
+        elif name == "average_rating":
+            values = [np.nan if row[name] is None else row[name] for row in rows]
+        else:
+            values = [NULL_INT if row[name] is None else row[name] for row in rows]
+        arrays[name] = np.array(values, dtype=dtype)
+
+    heap = bytearray()
+    for name in STRING_COLUMNS:
+        offsets = np.zeros(count, dtype="<i8")
+        lengths = np.full(count, -1, dtype="<i8")
+        for i, row in enumerate(rows):
+            value = row[name]
+            if value is not None:
+                encoded = value.encode("utf-8")
+                offsets[i] = len(heap)
+                lengths[i] = len(encoded)
+                heap += encoded
+        arrays[f"{name}.offset"] = offsets
+        arrays[f"{name}.length"] = lengths
+    return arrays, bytes(heap)
+
+
+def write_snapshot(path: str, rows, built_at: float = None):
+    """
+    Writes rows (dicts shaped like movie_row, any order) to path atomically. built_at is the time
+    the rows were read, writes committed after it are not in the snapshot
+    """
+    arrays, heap = _encode(rows)
+    return _write(path, arrays, [heap], built_at)
+
+
+def _write(path: str, arrays, heaps, built_at: float = None):
+    # heaps: the string heap as a list of buffers, written back to back
+    count = len(arrays["id"])
+    heap_size = sum(len(part) for part in heaps)
+    sections = {}
+    position = 0
+    for name, array in arrays.items():
+        sections[name] = {"offset": position, "dtype": array.dtype.str}
+        position = _align(position + array.nbytes)
+    sections["heap"] = {"offset": position, "size": heap_size}
+    header = json.dumps({
+        "version": FORMAT_VERSION,
+        "count": count,
+        "built_at": time.time() if built_at is None else built_at,
+        "sections": sections,
+    }).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + sections[name]["offset"])
+            f.write(array.tobytes())
+        f.seek(data_start + sections["heap"]["offset"])
+        for part in heaps:
+            f.write(part)
+        # empty trailing sections must still be inside the file for the reader's views
+        f.truncate(data_start + sections["heap"]["offset"] + heap_size)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    metrics.inc("catalog_builds_total")
+    return count
+
+
+class Snapshot:
+    """
+    One mapped version of the snapshot file. All columns are zero-copy views into the mapping
+    """
+
+    def __init__(self, path: str):
+        import numpy as np
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a movie catalog snapshot")
+        header_length = int.from_bytes(self._map[len(MAGIC):len(MAGIC) + 8], "little")
+        header_start = len(MAGIC) + 8
+        header = json.loads(self._map[header_start:header_start + header_length])
+        if header["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported catalog snapshot version {header['version']}")
+        data_start = _align(header_start + header_length)
+        self.count = header["count"]
+        self.built_at = header["built_at"]
+        self.columns = {}
+        for name, section in header["sections"].items():
+            if name == "heap":
+                self.heap = memoryview(self._map)[data_start + section["offset"]:data_start + section["offset"] + section["size"]]
+            else:
+                self.columns[name] = np.frombuffer(self._map, dtype=section["dtype"], count=self.count, offset=data_start + section["offset"])
+        self.ids = self.columns["id"]
+
+    def index_of(self, movie_id: int):
+        import numpy as np
+        position = int(np.searchsorted(self.ids, movie_id))
+        if position < self.count and self.ids[position] == movie_id:
+            return position
+        return None
+
+    def _string(self, name: str, position: int):
+        length = int(self.columns[f"{name}.length"][position])
+        if length < 0:
+            return None
+        offset = int(self.columns[f"{name}.offset"][position])
+        return bytes(self.heap[offset:offset + length]).decode("utf-8")
+
+    def _int(self, name: str, position: int):
+        value = int(self.columns[name][position])
+        return None if value == NULL_INT else value
+
+    def row(self, position: int) -> dict:
+        row = {name: self._string(name, position) for name in STRING_COLUMNS}
+        for name in ("id", "owner_id", "year_released", "comment_count", "reply_count", "rating_count"):
+            row[name] = self._int(name, position)
+        row["created_at"] = _from_micros(self.columns["created_at"][position])
+        average_rating = float(self.columns["average_rating"][position])
+        row["average_rating"] = None if math.isnan(average_rating) else average_rating
+        return row
+
+    def rows(self):
+        return [self.row(position) for position in range(self.count)]
+
+
+def to_movie(row: dict) -> dict:
+    # Shapes a snapshot row like schemas.Movie
+    movie = {name: row[name] for name in (
+        "id", "title", "description", "genres", "writer", "director", "cast", "language", "Runtime",
+        "year_released", "owner_id", "created_at", "average_rating", "comment_count", "reply_count", "rating_count",
+    )}
+    movie["owner"] = None
+    if row["owner_username"] is not None:
+        movie["owner"] = {
+            "id": row["owner_id"],
+            "username": row["owner_username"],
+            "full_name": row["owner_full_name"],
+            "email": row["owner_email"],
+        }
+    return movie
+
+
+class SnapshotReader:
+    """
+    Per-worker handle on a snapshot rebuilt by a job, looking for a new version at most every
+    check_interval. Subclasses return the version on disk from _version() (None when there is
+    none), load it in _load() and may update their own state in _loaded(). A version that fails
+    to load is logged and the previous snapshot kept
+    """
+
+    def __init__(self, path: str, check_interval: float):
+        self.path = path
+        self.check_interval = check_interval
+        self.snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._logger = get_logger(type(self).__module__)
+
+    def current(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if now - self._checked_at >= self.check_interval:
+                    self._checked_at = now
+                    self._reload()
+        return self.snapshot
+
+    def _version(self):
+        raise NotImplementedError
+
+    def _load(self, version):
+        raise NotImplementedError
+
+    def _loaded(self):
+        pass
+
+    def _reload(self):
+        version = self._version()
+        if version is None:
+            self.snapshot = None
+            return
+        if self.snapshot is not None and self.snapshot.version == version:
+            return
+        try:
+            # the previous snapshot is released once no request references it anymore
+            self.snapshot = self._load(version)
+        except (OSError, ValueError):
+            self._logger.exception(f"Could not load snapshot {version} of {self.path}")
+            return
+        self._loaded()
+
+
+class CatalogReader(SnapshotReader):
+    """
+    Per-worker handle on the snapshot file; picks up a rebuilt file at most every check_interval
+    """
+
+    def __init__(self, path: str, check_interval: float = 0.5):
+        super().__init__(path, check_interval)
+        # movie id -> time.time() of a write committed by this worker, for read-your-own-writes
+        self._local_writes = {}
+
+    def _version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _load(self, version):
+        return Snapshot(self.path)
+
+    def _loaded(self):
+        metrics.set_gauge("catalog_snapshot_rows", self.snapshot.count)
+        for movie_id, written_at in list(self._local_writes.items()):
+            if written_at < self.snapshot.built_at:
+                self._local_writes.pop(movie_id, None)
+
+    def record_write(self, movie_id: int):
+        self._local_writes[movie_id] = time.time()
+
+    def _stale(self, snapshot, movie_id=None):
+        if movie_id is not None:
+            written_at = self._local_writes.get(movie_id)
+            return written_at is not None and written_at >= snapshot.built_at
+        return any(written_at >= snapshot.built_at for written_at in list(self._local_writes.values()))
+
+    def get(self, movie_id: int):
+        """
+        Returns the movie as a schemas.Movie shaped dict, or None when the caller must use the DB
+        """
+        snapshot = self.current()
+        if snapshot is None or self._stale(snapshot, movie_id):
+            metrics.inc("catalog_misses_total")
+            return None
+        position = snapshot.index_of(movie_id)
+        if position is None:
+            metrics.inc("catalog_misses_total")
+            return None
+        metrics.inc("catalog_hits_total")
+        return to_movie(snapshot.row(position))
+
+    def page(self, skip: int, limit: int):
+        snapshot = self.current()
+        if snapshot is None or self._stale(snapshot):
+            metrics.inc("catalog_misses_total")
+            return None
+        metrics.inc("catalog_hits_total")
+        return [to_movie(snapshot.row(position)) for position in range(max(skip, 0), min(max(skip, 0) + limit, snapshot.count))]
+
+
+reader = None
+
+
+# Write tracking
+
+def touch(db: Session, movie_id):
+    # Marks the movie for a rebuild once the session's transaction commits; ALL rebuilds everything
+    if PATH:
+        db.info.setdefault("catalog_dirty", set()).add(movie_id)
+
+
+ALL = "*"
+
+
+@event.listens_for(Session, "after_commit")
+def _flush_dirty(session):
+    dirty = session.info.pop("catalog_dirty", None)
+    if dirty and PATH:
+        mark_dirty(dirty)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_dirty(session):
+    session.info.pop("catalog_dirty", None)
+
+
+def _open_log(dirty_path: str):
+    """
+    The dirty log opened for appending and locked exclusively; reopened when the builder claimed
+    (renamed) the file between the open and the lock
+    """
+    while True:
+        f = open(dirty_path, "a")
+        if fcntl is None:
+            return f
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.stat(dirty_path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def mark_dirty(movie_ids):
+    # one locked append per commit, safe with concurrent writers in other workers
+    with _open_log(f"{PATH}.dirty") as f:
+        f.write("".join(f"{movie_id}\n" for movie_id in movie_ids))
+    if reader is not None:
+        for movie_id in movie_ids:
+            if movie_id != ALL:
+                reader.record_write(movie_id)
+
+
+# Builder
+
+def _load_movies(db: Session, movie_ids=None):
+    query = db.query(models.Movie).options(joinedload(models.Movie.owner)).order_by(models.Movie.id)
+    if movie_ids is not None:
+        query = query.filter(models.Movie.id.in_(movie_ids))
+    return [movie_row(movie) for movie in query.yield_per(1000)]
+
+
+def _claim(dirty_path: str):
+    """
+    Renames the dirty log out of the writers' way and returns every claimed log waiting for a
+    build, including those left by a failed one
+    """
+    if os.path.exists(dirty_path):
+        with _open_log(dirty_path):
+            os.replace(dirty_path, f"{dirty_path}.{time.time_ns()}-{os.getpid()}")
+    return sorted(name for name in glob.glob(f"{glob.escape(dirty_path)}.*") if not name.endswith(".tmp"))
+
+
+def _patch(snapshot: Snapshot, dirty_ids, rows):
+    """
+    Column arrays and heap parts of the snapshot with the dirty movies replaced by rows, without
+    decoding the other rows: the kept rows are numpy selections and their strings stay where they
+    are in the old heap, followed by the strings of the new rows
+    """
+    import numpy as np
+    added, added_heap = _encode(rows)
+    keep = ~np.isin(snapshot.ids, np.fromiter(dirty_ids, dtype="<i8", count=len(dirty_ids)))
+    base = len(snapshot.heap)
+    arrays = {}
+    for name, values in added.items():
+        if name.endswith(".offset"):
+            values = values + base
+        arrays[name] = np.concatenate([snapshot.columns[name][keep], values])
+    order = np.argsort(arrays["id"], kind="stable")
+    return {name: values[order] for name, values in arrays.items()}, [snapshot.heap, added_heap]
+
+
+def _heap_in_use(arrays) -> int:
+    import numpy as np
+    return int(sum(np.clip(arrays[f"{name}.length"], 0, None).sum() for name in STRING_COLUMNS))
+
+
+def build(db: Session, path: str, incremental: bool = True):
+    """
+    Rebuilds the snapshot. Incremental builds only read the movies listed in the dirty log from
+    the database and copy every other row of the current snapshot over column by column
+    """
+    started = time.time()
+    claimed = _claim(f"{path}.dirty")
+    dirty_ids = set()
+    for claimed_path in claimed:
+        with open(claimed_path) as f:
+            dirty_ids.update(line.strip() for line in f if line.strip())
+
+    if not incremental or ALL in dirty_ids or not os.path.exists(path):
+        count = write_snapshot(path, _load_movies(db), built_at=started)
+    else:
+        if not claimed:
+            return None
+        dirty_ids = {int(movie_id) for movie_id in dirty_ids}
+        snapshot = Snapshot(path)
+        arrays, heaps = _patch(snapshot, dirty_ids, _load_movies(db, dirty_ids))
+        if sum(len(part) for part in heaps) > 2 * _heap_in_use(arrays) + 65536:
+            # mostly replaced strings: compact the heap with a full build
+            count = write_snapshot(path, _load_movies(db), built_at=started)
+        else:
+            count = _write(path, arrays, heaps, built_at=started)
+        metrics.inc("catalog_rebuilt_rows_total", len(dirty_ids))
+    for claimed_path in claimed:
+        os.remove(claimed_path)
+    return count
@@ -0,0 +1,318 @@
+# compression.py
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Negotiated response compression (zstd, br, gzip; brotli and zstd only when their packages are
+# installed). Responses sent in one body message and at least MIN_SIZE bytes long are compressed
+# whole; for cacheable GET responses the compressed bytes are kept in an LRU keyed by the hash of
+# the uncompressed body, so a hot payload is compressed once and then only hashed. Responses
+# streamed in several messages (StreamingResponse, server-sent events) are compressed chunk by
+# chunk with a flush after every chunk, so each event still reaches the client immediately.
+#
+# Routes pick a level profile with the `tune` dependency, e.g.
+#     @router.get(..., dependencies=[Depends(compression.tune("best"))])
+# Bodies of THREADPOOL_MIN_SIZE bytes or more are compressed in the threadpool, so a large cache
+# miss does not hold up the event loop.
+
+ENABLED = True
+MIN_SIZE = 1024
+PREFERENCE = ["zstd", "br", "gzip"]
+DEFAULT_PROFILE = "default"
+CACHE_ENTRIES = 256
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+THREADPOOL_MIN_SIZE = 64 * 1024
+
+# compression level of every encoding for each profile
+PROFILES = {
+    "fast": {"gzip": 1, "br": 1, "zstd": 1},
+    "default": {"gzip": 6, "br": 5, "zstd": 3},
+    # for payloads served from the precompressed cache, where the level is paid once; brotli 11
+    # and zstd 19 cost seconds per megabyte for a few percent, and every distinct page is a miss
+    "best": {"gzip": 9, "br": 6, "zstd": 9},
+}
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+class _Gzip:
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _Zstd:
+
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+ENCODERS = {"gzip": _Gzip}
+if brotli is not None:
+    ENCODERS["br"] = _Brotli
+if zstandard is not None:
+    ENCODERS["zstd"] = _Zstd
+
+
+def configure(settings):
+    global ENABLED, MIN_SIZE, PREFERENCE, DEFAULT_PROFILE
+    ENABLED = settings.compression_enabled
+    MIN_SIZE = settings.compression_min_size
+    PREFERENCE = [name.strip() for name in settings.compression_encodings.split(",") if name.strip() in ENCODERS]
+    DEFAULT_PROFILE = settings.compression_profile
+    cache.resize(settings.compression_cache_entries, settings.compression_cache_max_bytes)
+
+
+def compress(encoding: str, level: int, body: bytes) -> bytes:
+    encoder = ENCODERS[encoding](level)
+    return encoder.compress(body) + encoder.finish()
+
+
+def negotiate(accept_encoding: str):
+    """
+    The preferred available encoding accepted by the client (q > 0), or None for identity
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in PREFERENCE:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def tune(profile: str):
+    """
+    Dependency choosing the compression level profile of a route
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown compression profile {profile}")
+
+    def set_profile(request: Request):
+        request.state.compression_profile = profile
+
+    return set_profile
+
+
+class CompressedCache:
+    # LRU of compressed bodies keyed by (encoding, level, sha256 of the uncompressed body)
+
+    def __init__(self, max_entries: int = CACHE_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resize(self, max_entries: int, max_bytes: int):
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value: bytes):
+        with self._lock:
+            if key in self._entries or len(value) > self.max_bytes:
+                return
+            self._entries[key] = value
+            self.size += len(value)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            _, value = self._entries.popitem(last=False)
+            self.size -= len(value)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = CompressedCache()
+
+
+def _compressible(headers) -> bool:
+    content_type = headers.get(b"content-type", b"").decode("latin-1")
+    return (b"content-encoding" not in headers
+            and content_type.startswith(COMPRESSIBLE_TYPES)
+            and b"no-transform" not in headers.get(b"cache-control", b""))
+
+
+def _cacheable(scope, headers) -> bool:
+    return (scope["method"] == "GET"
+            and b"set-cookie" not in headers
+            and b"no-store" not in headers.get(b"cache-control", b""))
+
+
+def _account(encoding: str, raw: int, sent: int, seconds: float):
+    metrics.inc("http_response_bytes_total", sent, encoding=encoding)
+    metrics.inc("http_response_uncompressed_bytes_total", raw, encoding=encoding)
+    metrics.inc("compression_seconds_total", seconds, encoding=encoding)
+
+
+class CompressionMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not ENABLED or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"accept-encoding"), "")
+        encoding = negotiate(accept)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        started = False
+        encoder = None
+        raw_bytes = sent_bytes = 0
+        seconds = 0.0
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, started, encoder, raw_bytes, sent_bytes, seconds, passthrough
+            if message["type"] == "http.response.start":
+                # held back until the first body message tells whether and how to compress
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+            started = True
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                headers = {name.lower(): value for name, value in start.get("headers", [])}
+                status = start["status"]
+                compressible = status not in (204, 206, 304) and _compressible(headers)
+                if not compressible or (not more_body and len(body) < MIN_SIZE):
+                    passthrough = True
+                    if compressible:
+                        _vary(start)
+                    metrics.inc("http_response_bytes_total", len(body), encoding="identity")
+                    await send(start)
+                    return await send(message)
+
+                profile = scope.get("state", {}).get("compression_profile", DEFAULT_PROFILE)
+                level = PROFILES[profile][encoding]
+                if not more_body:
+                    # whole body: compress once, or reuse the precompressed bytes
+                    began = time.perf_counter()
+                    key = None
+                    compressed = None
+                    if status == 200 and _cacheable(scope, headers):
+                        key = (encoding, level, hashlib.sha256(body).digest())
+                        compressed = cache.get(key)
+                        metrics.inc("compression_cache_hits_total" if compressed is not None else "compression_cache_misses_total")
+                    if compressed is None:
+                        if len(body) >= THREADPOOL_MIN_SIZE:
+                            compressed = await run_in_threadpool(compress, encoding, level, body)
+                        else:
+                            compressed = compress(encoding, level, body)
+                        if key is not None:
+                            cache.put(key, compressed)
+                    _account(encoding, len(body), len(compressed), time.perf_counter() - began)
+                    _encode_headers(start, encoding, len(compressed))
+                    await send(start)
+                    return await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+                encoder = ENCODERS[encoding](level)
+                _encode_headers(start, encoding, None)
+                await send(start)
+
+            began = time.perf_counter()
+            chunk = encoder.compress(body) + (encoder.flush() if more_body else encoder.finish())
+            seconds += time.perf_counter() - began
+            raw_bytes += len(body)
+            sent_bytes += len(chunk)
+            if not more_body:
+                _account(encoding, raw_bytes, sent_bytes, seconds)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+        if start is not None and not started:
+            # response without a body message
+            await send(start)
+
+
+def _vary(start):
+    start["headers"] = [*start.get("headers", []), (b"vary", b"Accept-Encoding")]
+
+
+def _encode_headers(start, encoding: str, length):
+    headers = [(name, value) for name, value in start.get("headers", []) if name.lower() != b"content-length"]
+    headers.append((b"content-encoding", encoding.encode()))
+    headers.append((b"vary", b"Accept-Encoding"))
+    if length is not None:
+        headers.append((b"content-length", str(length).encode()))
+    start["headers"] = headers
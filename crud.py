@@ -2,8 +2,14 @@
 from fastapi import HTTPException, status
 from sqlalchemy.orm import Session
 import models, schemas
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.exc import IntegrityError
 from models import Rating
+import catalog, database, fieldsets, partitioning, pubsub, rating_queue
 
 
 def create_user(db: Session, user: schemas.UserCreate, hashed_password: str):
@@ -24,12 +30,15 @@ def get_user_by_username(db: Session, username: str):
 def create_movie(db: Session, movie: schemas.MovieCreate, user_id: int):
     db_movie = models.Movie(**movie.dict(), owner_id=user_id)
     db.add(db_movie)
+    db.flush()
+    catalog.touch(db, db_movie.id)
     db.commit()
     db.refresh(db_movie)
     return db_movie
     
-def get_movies(db: Session, skip: int = 0, limit: int = 10):
-    return db.query(models.Movie).offset(skip).limit(limit).all()
+def get_movies(db: Session, skip: int = 0, limit: int = 10, fields: frozenset = None):
+    query = db.query(models.Movie).options(*fieldsets.load_options(models.Movie, fields))
+    return query.order_by(models.Movie.id).offset(skip).limit(limit).all()
 
 # Read User Movies
 def get_user_movies(db: Session, user_id: int):
@@ -38,8 +47,9 @@ def get_user_movies(db: Session, user_id: int):
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
-def get_movie_by_id(db: Session, movie_id: int):
-    return db.query(models.Movie).filter(models.Movie.id == movie_id).first()
+def get_movie_by_id(db: Session, movie_id: int, fields: frozenset = None):
+    query = db.query(models.Movie).options(*fieldsets.load_options(models.Movie, fields))
+    return query.filter(models.Movie.id == movie_id).first()
 
 
 def update_movie(db: Session, movie_id: int, movie: schemas.MovieUpdate):
@@ -47,14 +57,88 @@ def update_movie(db: Session, movie_id: int, movie: schemas.MovieUpdate):
     if db_movie:
         for var, value in vars(movie).items():
             setattr(db_movie, var, value)
+        catalog.touch(db, movie_id)
         db.commit()
         db.refresh(db_movie)
     return db_movie
 
+def movie_has_dependents(db: Session, movie_id: int) -> bool:
+    # Checks the rows themselves: in write-behind mode rating_count lags the ratings table, and
+    # archived rows only show in the counters
+    movie = db.get(models.Movie, movie_id)
+    if movie is not None and (movie.rating_count or movie.comment_count or movie.reply_count):
+        return True
+    # replies of a deleted comment stay, with comment_id NULL, and still reference the movie
+    return any(db.query(model.id).filter(model.movie_id == movie_id).first() is not None
+               for model in (models.Rating, models.Comment, models.Reply))
+
+
 def delete_movie(db: Session, movie_id: int):
     db.query(models.Movie).filter(models.Movie.id == movie_id).delete()
+    catalog.touch(db, movie_id)
     db.commit()
     
+def _bump_counters(db: Session, movie_id: int, **deltas):
+    # Adjusts the denormalized counters on the movie row inside the caller's transaction
+    values = {getattr(models.Movie, name): getattr(models.Movie, name) + delta for name, delta in deltas.items()}
+    db.query(models.Movie).filter(models.Movie.id == movie_id).update(values, synchronize_session=False)
+    catalog.touch(db, movie_id)
+
+
+def repair_movie_counters(db: Session):
+    # Recomputes every counter in a single set-based UPDATE and returns the number of repaired movies;
+    # rows moved out by partitioning.archive_before still count through movie_archive_stats
+    if isinstance(db, database.ShardedRoutingSession):
+        return _repair_sharded_movie_counters(db)
+
+    def archived(column):
+        return func.coalesce(select(column).where(models.MovieArchiveStats.movie_id == models.Movie.id).scalar_subquery(), 0)
+
+    comment_count = select(func.count(models.Comment.id)).where(models.Comment.movie_id == models.Movie.id).scalar_subquery() \
+        + archived(models.MovieArchiveStats.comment_count)
+    reply_count = select(func.count(models.Reply.id)).where(models.Reply.movie_id == models.Movie.id).scalar_subquery() \
+        + archived(models.MovieArchiveStats.reply_count)
+    rating_count = select(func.count(models.Rating.id)).where(models.Rating.movie_id == models.Movie.id).scalar_subquery() \
+        + archived(models.MovieArchiveStats.rating_count)
+    result = db.execute(
+        update(models.Movie)
+        .where(or_(models.Movie.comment_count != comment_count,
+                   models.Movie.reply_count != reply_count,
+                   models.Movie.rating_count != rating_count))
+        .values(comment_count=comment_count, reply_count=reply_count, rating_count=rating_count)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount:
+        catalog.touch(db, catalog.ALL)
+    db.commit()
+    return result.rowcount
+
+
+def _repair_sharded_movie_counters(db: Session):
+    # The counted rows are on the shards: gather per-movie counts from every shard, then fix the movies
+    counts = {}
+    for position, model in enumerate((models.Comment, models.Reply, models.Rating)):
+        for movie_id, count in db.execute(select(model.movie_id, func.count(model.id)).group_by(model.movie_id)):
+            counts.setdefault(movie_id, [0, 0, 0])[position] += count
+    for stats in db.query(models.MovieArchiveStats):
+        expected = counts.setdefault(stats.movie_id, [0, 0, 0])
+        expected[0] += stats.comment_count
+        expected[1] += stats.reply_count
+        expected[2] += stats.rating_count
+    repaired = 0
+    for movie_id, comment_count, reply_count, rating_count in db.query(models.Movie.id, models.Movie.comment_count,
+                                                                        models.Movie.reply_count, models.Movie.rating_count):
+        expected = counts.get(movie_id, [0, 0, 0])
+        if [comment_count, reply_count, rating_count] != expected:
+            db.query(models.Movie).filter(models.Movie.id == movie_id).update(
+                {models.Movie.comment_count: expected[0], models.Movie.reply_count: expected[1], models.Movie.rating_count: expected[2]},
+                synchronize_session=False)
+            repaired += 1
+    if repaired:
+        catalog.touch(db, catalog.ALL)
+    db.commit()
+    return repaired
+
 def get_comments_for_movie(db: Session, movie_id: int):
     return db.query(models.Comment).filter(models.Comment.movie_id == movie_id).all()    
 
@@ -65,47 +149,130 @@ def create_comment(db:Session, payload:schemas.CommentCreate, current_user: int,
                                 movie_id=movie_id
                              )
     db.add(db_comment)
+    _bump_counters(db, movie_id, comment_count=1)
     db.commit()
     db.refresh(db_comment)
+    event = schemas.CommentEvent(type="comment", id=db_comment.id, movie_id=movie_id, user_id=current_user,
+                                 text=db_comment.comment, created_at=db_comment.created_at)
+    pubsub.publish(pubsub.movie_topic(movie_id), event.model_dump_json())
     return db_comment
 
 
-def get_comments(db: Session, movie_id: int ):
-     # Fetch the movie with its comments and their replies
-    movie_with_comments = db.query(models.Movie).options(joinedload(models.Movie.comments).joinedload(models.Comment.replies)
+def get_comments(db: Session, movie_id: int, since: datetime = None, fields: frozenset = None):
+     # Fetch the movie with its comments and their replies; comments older than the archive
+     # watermark live in the comments archive and are not loaded here. No joins: the comments
+     # and replies may be on a shard, and the replies query is scoped by movie_id to stay on it
+    comments = models.Movie.comments
+    if since is not None:
+        comments = comments.and_(models.Comment.created_at >= since)
+    with_replies = fields is None or "replies" in fields
+    if fields is None:
+        options = [selectinload(comments).noload(models.Comment.replies)]
+    else:
+        # only the requested comment columns and relationships, and nothing of the movie itself
+        options = [fieldsets.load_options(models.Movie, frozenset())[0],
+                   *fieldsets.load_options(models.Comment, fields - {"replies"} or frozenset({"id"}), path=selectinload(comments))]
+    movie_with_comments = db.query(models.Movie).options(*options
     ).filter(models.Movie.id == movie_id).first()
+    if movie_with_comments is not None and with_replies:
+        _attach_replies(db, movie_id, movie_with_comments.comments)
     return movie_with_comments
 
-def get_comment_by_id(db: Session, comment_id: int):
-    return db.query(models.Comment).filter(models.Comment.id == comment_id).first()
 
-def get_reply_by_id(db: Session, reply_id: int):
-    return db.query(models.Reply).filter(models.Reply.id == reply_id).first()
+def _attach_replies(db: Session, movie_id: int, comments):
+    replies = {comment.id: [] for comment in comments}
+    if replies:
+        query = db.query(models.Reply).filter(models.Reply.movie_id == movie_id, models.Reply.comment_id.in_(replies))
+        for reply in query.order_by(models.Reply.path):
+            replies[reply.comment_id].append(reply)
+    for comment in comments:
+        set_committed_value(comment, "replies", replies[comment.id])
+
+def get_archived_comments(db: Session, movie: models.Movie, since: datetime = None):
+    # Comments of the movie moved to the archive, shaped like loaded comments, with the replies
+    # archived together with them; only the monthly partitions from `since` on are read
+    rows = partitioning.archived_rows(db, "comments", movie.id, since)
+    if not rows:
+        return []
+    users = {user.id: user for user in db.query(models.User).filter(models.User.id.in_({row["user_id"] for row in rows}))}
+    replies = defaultdict(list)
+    # replies are never older than their comment
+    for reply in sorted(partitioning.archived_rows(db, "replies", movie.id, since), key=lambda reply: reply["path"]):
+        replies[reply["comment_id"]].append(reply)
+    return [dict(row, user=users.get(row["user_id"]), movie=movie, replies=replies[row["id"]]) for row in rows]
+
+def get_comment_by_id(db: Session, comment_id: int, include_archive: bool = False):
+    # include_archive also finds a comment moved to the archive, as a read-only row
+    comment = database.first_owned(db.query(models.Comment).filter(models.Comment.id == comment_id))
+    if comment is None and include_archive:
+        return partitioning.archived_row(db, "comments", comment_id)
+    return comment
+
+def get_reply_by_id(db: Session, reply_id: int, include_archive: bool = False):
+    reply = database.first_owned(db.query(models.Reply).filter(models.Reply.id == reply_id))
+    if reply is None and include_archive:
+        return partitioning.archived_row(db, "replies", reply_id)
+    return reply
 
 # reply
-def create_reply(db: Session, reply: schemas.ReplyCreate, comment_id: int, current_user: int, original_comment: str, movie_id: int):
+def create_reply(db: Session, reply: schemas.ReplyCreate, comment_id: int, current_user: int, movie_id: int):
+    parent = None
+    if reply.parent_id is not None:
+        parent = get_reply_by_id(db, reply.parent_id)
+        if parent is None or parent.comment_id != comment_id:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Reply_id {reply.parent_id} does not exist on comment_id {comment_id}")
     db_reply_comment = models.Reply(**reply.model_dump(),
                                     user_id = current_user,
                                     comment_id=comment_id,
-                                    original_comment=original_comment,
-                                    movie_id=movie_id
+                                    movie_id=movie_id,
+                                    depth=parent.depth + 1 if parent else 0
                                     )
     db.add(db_reply_comment)
+    # the path needs the generated id
+    db.flush()
+    db_reply_comment.path = f"{parent.path if parent else ''}{db_reply_comment.id:0{models.Reply.PATH_DIGITS}d}."
+    _bump_counters(db, movie_id, reply_count=1)
     db.commit()
     db.refresh(db_reply_comment)
+    event = schemas.CommentEvent(type="reply", id=db_reply_comment.id, movie_id=movie_id, user_id=current_user,
+                                 comment_id=comment_id, text=db_reply_comment.reply, created_at=db_reply_comment.created_at)
+    pubsub.publish(pubsub.movie_topic(movie_id), event.model_dump_json())
     return db_reply_comment
 
 
 def delete_comment(db: Session, comment_id: int):
-    db_comment = db.query(models.Comment).filter(models.Comment.id == comment_id).first()
+    db_comment = database.first_owned(db.query(models.Comment).filter(models.Comment.id == comment_id))
     if db_comment:
+        _bump_counters(db, db_comment.movie_id, comment_count=-1)
         db.delete(db_comment)
         db.commit()
 
 
+def get_reply_thread(db: Session, comment_id: int, parent: models.Reply = None, max_depth: int = None, skip: int = 0, limit: int = 50,
+                     archived_movie_id: int = None):
+    # One index range scan on (comment_id, path): the whole thread, or the subtree under parent,
+    # in display order and at most max_depth levels below the starting point. The thread of an
+    # archived comment (archived_movie_id) is read from the replies archive instead
+    base_depth = parent.depth if parent is not None else -1
+    if archived_movie_id is not None:
+        thread = [reply for reply in partitioning.archived_rows(db, "replies", archived_movie_id, comment_id=comment_id)
+                  if (parent is None or parent.path < reply["path"] < models.Reply.subtree_upper_bound(parent.path))
+                  and (max_depth is None or reply["depth"] <= base_depth + max_depth)]
+        return sorted(thread, key=lambda reply: reply["path"])[skip:skip + limit]
+    query = db.query(models.Reply).filter(models.Reply.comment_id == comment_id)
+    if parent is not None:
+        query = query.filter(models.Reply.path > parent.path, models.Reply.path < models.Reply.subtree_upper_bound(parent.path))
+    if max_depth is not None:
+        query = query.filter(models.Reply.depth <= base_depth + max_depth)
+    return query.order_by(models.Reply.path).offset(skip).limit(limit).all()
+
+
 def delete_reply(db: Session, reply_id: int):
-    db_reply = db.query(models.Reply).filter(models.Reply.id == reply_id).first()
+    db_reply = database.first_owned(db.query(models.Reply).filter(models.Reply.id == reply_id))
     if db_reply:
+        _bump_counters(db, db_reply.movie_id, reply_count=-1)
+        # answers to the deleted reply stay in place (their paths are unchanged) but lose the parent link
+        db.query(models.Reply).filter(models.Reply.movie_id == db_reply.movie_id, models.Reply.parent_id == reply_id).update({models.Reply.parent_id: None}, synchronize_session=False)
         db.delete(db_reply)
         db.commit()
 
@@ -114,7 +281,7 @@ def create_rating(db: Session, rating: schemas.RatingCreate, movie_id: int, user
     # Check if the user has already rated this movie
     existing_rating = db.query(models.Rating).filter(models.Rating.movie_id == movie_id, models.Rating.user_id == user_id).first()
     
-    if existing_rating:
+    if existing_rating or partitioning.archived_rating_exists(db, movie_id, user_id):
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"You have already rated movie_id {movie_id}")
     
      # Check if the rating is within the acceptable range
@@ -123,10 +290,21 @@ def create_rating(db: Session, rating: schemas.RatingCreate, movie_id: int, user
        
     new_rating = Rating(movie_id=movie_id, user_id=user_id, rating=rating.rating)
     db.add(new_rating)
-    db.commit()
+    if rating_queue.WRITE_BEHIND:
+        # the movie aggregates are applied later by rating_queue.RatingWorker
+        rating_queue.enqueue(db, movie_id)
+    else:
+        _bump_counters(db, movie_id, rating_count=1)
+    try:
+        db.commit()
+    except IntegrityError:
+        # a concurrent request from the same user won the race on unique_user_movie_rating
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"You have already rated movie_id {movie_id}")
     db.refresh(new_rating)
     
-    update_movie_average_rating(db, movie_id)
+    if not rating_queue.WRITE_BEHIND:
+        update_movie_average_rating(db, movie_id)
     
     return new_rating
 
@@ -135,33 +313,57 @@ def update_movie_average_rating(db: Session, movie_id: int):
     if not movie:
         raise HTTPException(status_code=404, detail="Movie not found")
     
-    ratings = db.query(models.Rating).filter(models.Rating.movie_id == movie_id).all()
-    if ratings:
-        average_rating = sum(r.rating for r in ratings) / len(ratings)
-        movie.average_rating = round(average_rating, 2)
+    count, total = partitioning.rating_totals(db, [movie_id])[movie_id]
+    if count:
+        movie.average_rating = round(total / count, 2)
     else:
         movie.average_rating = None
     
+    catalog.touch(db, movie_id)
     db.commit()
     db.refresh(movie)
 
 
-def get_ratings_for_movie(db: Session, movie_id: int):
-   return db.query(models.Rating).filter(models.Rating.movie_id == movie_id).all()
+def get_ratings_for_movie(db: Session, movie_id: int, since: datetime = None, until: datetime = None, include_archive: bool = False,
+                          fields: frozenset = None):
+    # Ratings in [since, until); the hot table is skipped when the whole range is archived and the
+    # archive is only read on request, visiting the monthly partitions overlapping the range
+    ratings = []
+    if include_archive:
+        ratings.extend(dict(row, created_by=None) for row in partitioning.archived_rows(db, "ratings", movie_id, since, until))
+    watermark = partitioning.hot_since(db, "ratings")
+    if until is None or watermark is None or until > watermark:
+        query = db.query(models.Rating).options(*fieldsets.load_options(models.Rating, fields)).filter(models.Rating.movie_id == movie_id)
+        if since is not None:
+            query = query.filter(models.Rating.created_at >= since)
+        if until is not None:
+            query = query.filter(models.Rating.created_at < until)
+        ratings.extend(query.order_by(models.Rating.created_at).all())
+    return ratings
 
 def get_rating_by_id(db: Session, rating_id: int):
-    return db.query(models.Rating).filter(models.Rating.id == rating_id).first()
+    # a hot Rating, or the row of a rating moved to the archive (same attributes, read-only)
+    rating = database.first_owned(db.query(models.Rating).filter(models.Rating.id == rating_id))
+    return rating if rating is not None else partitioning.archived_row(db, "ratings", rating_id)
 
 def delete_rating(db: Session, rating_id: int):
-    db_rating = db.query(models.Rating).filter(models.Rating.id == rating_id).first()
+    db_rating = get_rating_by_id(db, rating_id)
     if db_rating:
         
         movie_id = db_rating.movie_id
         
-        db.delete(db_rating)
+        if rating_queue.WRITE_BEHIND:
+            rating_queue.enqueue(db, movie_id)
+        else:
+            _bump_counters(db, movie_id, rating_count=-1)
+        if isinstance(db_rating, models.Rating):
+            db.delete(db_rating)
+        else:
+            partitioning.delete_archived_rating(db, db_rating)
         db.commit()
         
-        update_movie_average_rating(db, movie_id)
+        if not rating_queue.WRITE_BEHIND:
+            update_movie_average_rating(db, movie_id)
         
     else:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Rating_id {rating_id} does not exist")   
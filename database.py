@@ -1,27 +1,652 @@
 #database.py
-from sqlalchemy import create_engine
-import os
-from dotenv import load_dotenv
+from sqlalchemy import Column, Index, MetaData, Table, UniqueConstraint, create_engine, event, inspect, select, text
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+import bisect
+import hashlib
+import hmac
+import itertools
+import math
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from fastapi import Depends
+from starlette.requests import HTTPConnection
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+import metrics
 
-load_dotenv()
+# Engines are created by configure(), called from main.create_app; nothing connects until the
+# first query or the pool warm-up in the application lifespan.
+engine = None
+replicas = None
+shards = None
 
-SQLALCHEMY_DATABASE_URL = os.environ.get('DB_URL')
-#SQLALCHEMY_DATABASE_URL = "sqlite:///./moviestore_db5"
+# Optional read replicas: DB_REPLICA_URLS=url1,url2  DB_REPLICA_POLICY=round_robin|least_connections
+REPLICA_HEALTH_SECONDS = 10
+# a client that wrote recently keeps reading from the primary for this long
+READ_AFTER_WRITE_SECONDS = 5
+# Read-after-write across workers: a response to a request that committed a write carries the
+# signed time of that write in the LAST_WRITE_COOKIE cookie and the X-Last-Write header; requests
+# sending either back within READ_AFTER_WRITE_SECONDS read from the primary, whichever worker
+# serves them. Clients sending neither still get it from the worker that took their write.
+LAST_WRITE_COOKIE = "last_write"
+LAST_WRITE_HEADER = "x-last-write"
+_signing_key = secrets.token_bytes(32)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+class ReplicaSet:
+    """
+    Read replicas with round-robin or least-connections selection. Replicas failing a health
+    check or raising a disconnect error are ejected until a later check succeeds
+    """
+
+    def __init__(self, engines, policy: str = "round_robin"):
+        if policy not in ("round_robin", "least_connections"):
+            raise ValueError(f"Unknown replica policy {policy!r}")
+        self.engines = list(engines)
+        self.policy = policy
+        self.healthy = list(self.engines)
+        self.in_use = {replica: 0 for replica in self.engines}
+        self._cycle = itertools.count()
+        self._lock = threading.Lock()
+        for replica in self.engines:
+            self._track(replica)
+
+    def _track(self, replica):
+        def on_checkout(*args):
+            with self._lock:
+                self.in_use[replica] += 1
+
+        def on_checkin(*args):
+            with self._lock:
+                self.in_use[replica] -= 1
+
+        def on_error(context):
+            if context.is_disconnect:
+                self.mark_down(replica)
+
+        event.listen(replica.pool, "checkout", on_checkout)
+        event.listen(replica.pool, "checkin", on_checkin)
+        event.listen(replica, "handle_error", on_error)
+
+    def choose(self):
+        # Returns None when every replica is down, the caller then falls back to the primary
+        with self._lock:
+            if not self.healthy:
+                return None
+            if self.policy == "least_connections":
+                return min(self.healthy, key=lambda replica: self.in_use[replica])
+            return self.healthy[next(self._cycle) % len(self.healthy)]
+
+    def mark_down(self, replica):
+        with self._lock:
+            if replica in self.healthy:
+                self.healthy.remove(replica)
+                metrics.inc("db_replica_ejections_total")
+            metrics.set_gauge("db_replicas_healthy", len(self.healthy))
+
+    def check(self):
+        healthy = []
+        for replica in self.engines:
+            try:
+                with replica.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                healthy.append(replica)
+            except Exception:
+                metrics.inc("db_replica_health_failures_total")
+        with self._lock:
+            self.healthy = healthy
+        metrics.set_gauge("db_replicas_healthy", len(healthy))
+
+    def dispose(self):
+        for replica in self.engines:
+            replica.dispose()
+
+
+class ReplicaHealthChecker(threading.Thread):
+
+    def __init__(self, replica_set: ReplicaSet, interval: float = None):
+        super().__init__(name="replica-health-checker", daemon=True)
+        self.replica_set = replica_set
+        self.interval = REPLICA_HEALTH_SECONDS if interval is None else interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.replica_set.check()
+
+    def stop(self, timeout: float = 5):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+# hash of the client key -> time of its last committed write in this process
+_recent_writes = OrderedDict()
+_recent_writes_lock = threading.Lock()
+
+
+def _hashed(client_key: str) -> str:
+    # never keep the bearer tokens themselves
+    return hashlib.sha256(client_key.encode()).hexdigest()
+
+
+def record_write(client_key: str):
+    key = _hashed(client_key)
+    with _recent_writes_lock:
+        _recent_writes[key] = time.monotonic()
+        _recent_writes.move_to_end(key)
+        while len(_recent_writes) > 100_000:
+            _recent_writes.popitem(last=False)
+
+
+def last_write_token(written_at: float) -> str:
+    value = f"{written_at:.3f}"
+    return f"{value}.{hmac.new(_signing_key, value.encode(), hashlib.sha256).hexdigest()}"
+
+
+def last_write_time(token: str):
+    # the time signed into a last_write_token, None when it is malformed or not ours
+    value, _, signature = token.rpartition(".")
+    if not value or not hmac.compare_digest(signature, hmac.new(_signing_key, value.encode(), hashlib.sha256).hexdigest()):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def wrote_recently(client_key: str, token: str = None) -> bool:
+    written_at = last_write_time(token) if token else None
+    if written_at is not None and time.time() - written_at < READ_AFTER_WRITE_SECONDS:
+        return True
+    with _recent_writes_lock:
+        last_write = _recent_writes.get(_hashed(client_key))
+    return last_write is not None and time.monotonic() - last_write < READ_AFTER_WRITE_SECONDS
+
+
+class LastWriteMiddleware:
+    """
+    Adds the signed last-write time to the responses of requests whose session committed a write
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            written_at = scope.get("state", {}).get("written_at")
+            if message["type"] == "http.response.start" and written_at is not None:
+                token = last_write_token(written_at).encode()
+                max_age = math.ceil(READ_AFTER_WRITE_SECONDS)
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (LAST_WRITE_HEADER.encode(), token),
+                    (b"set-cookie", b"%s=%s; Max-Age=%d; Path=/; HttpOnly; SameSite=Lax" % (LAST_WRITE_COOKIE.encode(), token, max_age)),
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _replica_for(session):
+    # The replica serving a read-only session, or None when the primary must be used
+    if replicas is not None and session.info.get("read_only") and not session.info.get("wrote") and not session._flushing:
+        replica = session.info.get("replica")
+        if replica is None:
+            # stick to one replica for the whole session so reads are consistent
+            replica = session.info["replica"] = replicas.choose()
+        if replica is not None:
+            metrics.inc("db_replica_reads_total")
+            return replica
+    return None
+
+
+class RoutingSession(Session):
+    """
+    Sends the queries of read-only sessions to a replica; flushes, writes and everything
+    after them go to the primary
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        return _replica_for(self) or super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+# Sharding: DB_SHARD_URLS=name=url,name=url spreads ratings, comments and replies over shard
+# databases by movie_id; users, movies and everything else stay on the primary. A movie is placed
+# by a consistent hash ring of the shard names (DB_SHARD_RING, all shards by default), unless the
+# shard_directory table on the primary pins it elsewhere, which is how "python jobs.py reshard"
+# moves movies online. Queries filtering on movie_id go to that movie's shard, the few others
+# (lookups by rating/comment/reply id, maintenance jobs) are sent to every shard and their
+# results concatenated. Ids of sharded rows come from the id_blocks table on the primary so they
+# stay unique across shards. A session commits each database in turn, so a write touching a
+# shard and the primary (a rating and its movie counters) is not atomic across the two.
+# While a movie moves, its shard_directory entry is marked `moving` and every worker refuses
+# writes to its rows with MovieMovingError (a 503 for clients), so nothing written to the old
+# shard during the move can be lost or come back on the new one.
+
+PRIMARY = "primary"
+SHARDED_TABLES = ("ratings", "comments", "replies")
+RING_VNODES = 64
+ID_BLOCK_SIZE = 100
+SHARD_DIRECTORY_SECONDS = 5
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring: adding a shard to N others only moves about 1/(N+1) of the movies
+    """
+
+    def __init__(self, names, vnodes: int = RING_VNODES):
+        if not names:
+            raise ValueError("A hash ring needs at least one shard")
+        self.names = list(names)
+        points = sorted((_hash(f"{name}#{i}"), name) for name in self.names for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def get(self, key) -> str:
+        position = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._owners[position]
+
+
+class MovieMovingError(Exception):
+    # a write to the rows of a movie that "python jobs.py reshard" is moving right now
+
+    def __init__(self, movie_ids):
+        super().__init__(f"Movie(s) {', '.join(map(str, movie_ids))} are being moved to another shard, retry shortly")
+        self.movie_ids = movie_ids
+
+
+class ShardMap:
+
+    def __init__(self, engines: dict, ring_names=None, directory_seconds: float = None):
+        self.engines = dict(engines)
+        unknown = set(ring_names or ()) - self.engines.keys()
+        if unknown:
+            raise ValueError(f"Unknown shard(s) in the ring: {', '.join(sorted(unknown))}")
+        self.ring = HashRing(ring_names or list(self.engines))
+        self.directory_seconds = SHARD_DIRECTORY_SECONDS if directory_seconds is None else directory_seconds
+        self._directory = {}
+        self._moving = frozenset()
+        self._directory_loaded = None
+        self._lock = threading.Lock()
+        self._id_blocks = {}
+
+    def shard_for(self, movie_id) -> str:
+        self._refresh_directory()
+        return self._directory.get(movie_id) or self.ring.get(movie_id)
+
+    def check_writable(self, movie_ids):
+        """
+        Raises MovieMovingError if one of the movies is being moved; an empty movie_ids stands
+        for a write that may touch any movie
+        """
+        self._refresh_directory()
+        moving = self._moving & set(movie_ids) if movie_ids else self._moving
+        if moving:
+            metrics.inc("db_shard_rejected_writes_total")
+            raise MovieMovingError(sorted(moving))
+
+    def invalidate_directory(self):
+        with self._lock:
+            self._directory_loaded = None
+
+    def _refresh_directory(self):
+        with self._lock:
+            if self._directory_loaded is not None and time.monotonic() - self._directory_loaded < self.directory_seconds:
+                return
+            self._directory_loaded = time.monotonic()
+        try:
+            with engine.connect() as connection:
+                rows = connection.execute(text("SELECT movie_id, shard, moving FROM shard_directory")).all()
+        except DBAPIError:
+            # the table does not exist yet: nothing is pinned
+            rows = []
+        with self._lock:
+            self._directory = {movie_id: shard for movie_id, shard, _ in rows}
+            self._moving = frozenset(movie_id for movie_id, _, moving in rows if moving)
+
+    def allocate_id(self, table: str) -> int:
+        # ids are handed out from blocks of ID_BLOCK_SIZE reserved in id_blocks on the primary
+        with self._lock:
+            block = self._id_blocks.get(table)
+            allocated = next(block, None) if block is not None else None
+            if allocated is not None:
+                return allocated
+        start = reserve_ids(table, ID_BLOCK_SIZE)
+        ids = iter(range(start + 1, start + ID_BLOCK_SIZE))
+        with self._lock:
+            self._id_blocks[table] = ids
+        return start
+
+    def dispose(self):
+        for shard in self.engines.values():
+            shard.dispose()
+
+
+def reserve_ids(table: str, count: int) -> int:
+    """
+    Reserves `count` ids of a sharded table in its own transaction on the primary and returns
+    the first one
+    """
+    for attempt in range(3):
+        try:
+            with engine.begin() as connection:
+                updated = connection.execute(text("UPDATE id_blocks SET next_id = next_id + :count WHERE name = :name"),
+                                             {"count": count, "name": table})
+                if updated.rowcount:
+                    return connection.execute(text("SELECT next_id FROM id_blocks WHERE name = :name"), {"name": table}).scalar() - count
+                connection.execute(text("INSERT INTO id_blocks (name, next_id) VALUES (:name, :next_id)"), {"name": table, "next_id": 1 + count})
+                return 1
+        except IntegrityError:
+            # another process created the row first
+            if attempt == 2:
+                raise
+
+
+def ensure_id_floor(table: str, next_id: int):
+    # makes sure ids handed out for `table` start at next_id or above (rows moved in from elsewhere)
+    with engine.begin() as connection:
+        params = {"name": table, "next_id": next_id}
+        connection.execute(text("UPDATE id_blocks SET next_id = :next_id WHERE name = :name AND next_id < :next_id"), params)
+        if connection.execute(text("SELECT 1 FROM id_blocks WHERE name = :name"), params).first() is None:
+            connection.execute(text("INSERT INTO id_blocks (name, next_id) VALUES (:name, :next_id)"), params)
+
+
+def _movie_ids(statement, parameters=None):
+    # movie_id values compared with = or IN in the WHERE clause of a statement on a sharded table
+    criteria = getattr(statement, "whereclause", None)
+    if criteria is None:
+        return set()
+    values = set()
+    for element in visitors.iterate(criteria):
+        if not isinstance(element, BinaryExpression) or not isinstance(element.right, BindParameter):
+            continue
+        table = getattr(element.left, "table", None)
+        if getattr(element.left, "name", None) != "movie_id" or getattr(table, "name", None) not in SHARDED_TABLES:
+            continue
+        value = element.right.effective_value
+        if value is None and parameters:
+            # selectin loads bind their keys at execution time
+            value = parameters.get(element.right.key)
+        if value is None:
+            continue
+        if element.operator is operators.eq:
+            values.add(value)
+        elif element.operator is operators.in_op:
+            values.update(value)
+    return values
+
+
+def _statement_tables(statement):
+    tables = set()
+    for element in visitors.iterate(statement):
+        if isinstance(element, Table):
+            tables.add(element.name)
+    return tables
+
+
+def _choose_shard(mapper, instance, clause=None, **kw):
+    if mapper is not None and mapper.local_table.name in SHARDED_TABLES:
+        if instance is not None:
+            return shards.shard_for(instance.movie_id)
+        movie_ids = _movie_ids(clause) if clause is not None else set()
+        if len(movie_ids) == 1:
+            return shards.shard_for(movie_ids.pop())
+        raise ValueError(f"Cannot choose a shard for {mapper.local_table.name} without a movie_id")
+    return PRIMARY
+
+
+def _choose_identity_shards(mapper, primary_key, *, lazy_loaded_from=None, **kw):
+    if mapper.local_table.name not in SHARDED_TABLES:
+        return [PRIMARY]
+    if lazy_loaded_from is not None and lazy_loaded_from.mapper.local_table.name in SHARDED_TABLES:
+        # a reply's comment lives on the reply's shard
+        return [lazy_loaded_from.identity_token]
+    return list(shards.engines)
+
+
+def _choose_execute_shards(orm_context):
+    statement = orm_context.statement
+    if not _statement_tables(statement) & set(SHARDED_TABLES):
+        return [PRIMARY]
+    if orm_context.is_insert:
+        raise ValueError("Insert rows of sharded tables through the session, not with a bulk INSERT")
+    movie_ids = _movie_ids(statement, orm_context.parameters)
+    if orm_context.is_update or orm_context.is_delete:
+        shards.check_writable(movie_ids)
+    if movie_ids:
+        return sorted({shards.shard_for(movie_id) for movie_id in movie_ids})
+    parent = orm_context.lazy_loaded_from if orm_context.is_select else None
+    if parent is not None and parent.mapper.local_table.name in SHARDED_TABLES:
+        return [parent.identity_token]
+    # scatter-gather
+    metrics.inc("db_shard_scatter_queries_total")
+    return list(shards.engines)
+
+
+class ShardedRoutingSession(ShardedSession):
+    """
+    RoutingSession for sharded deployments: the primary and its replicas hold users and movies,
+    the shards hold ratings, comments and replies
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(shard_chooser=_choose_shard, identity_chooser=_choose_identity_shards,
+                         execute_chooser=_choose_execute_shards, shards={PRIMARY: engine, **shards.engines}, **kwargs)
+
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        bind = super().get_bind(mapper, shard_id=shard_id, instance=instance, clause=clause, **kw)
+        if bind is engine:
+            return _replica_for(self) or bind
+        return bind
+
+
+@event.listens_for(ShardedRoutingSession, "transient_to_pending")
+def _assign_global_id(session, instance):
+    # before any write of the session, so the id reservation never waits on the session's own locks
+    table = inspect(instance).mapper.local_table.name
+    if table in SHARDED_TABLES and instance.id is None:
+        instance.id = shards.allocate_id(table)
+
+
+@event.listens_for(ShardedRoutingSession, "before_flush")
+def _check_writable(session, flush_context, instances):
+    movie_ids = {instance.movie_id for instance in (*session.new, *session.dirty, *session.deleted)
+                 if inspect(instance).mapper.local_table.name in SHARDED_TABLES}
+    if movie_ids:
+        shards.check_writable(movie_ids)
+
+
+def first_owned(query):
+    """
+    query.first() for lookups of sharded rows by id: while a movie moves its rows are on two
+    shards for a moment, and the copy on the shard the movie is routed to is the live one
+    """
+    if not isinstance(query.session, ShardedRoutingSession):
+        return query.first()
+    rows = query.all()
+    for row in rows:
+        if inspect(row).identity_token == shards.shard_for(row.movie_id):
+            return row
+    return rows[0] if rows else None
+
+
+def primary_connection(db: Session):
+    """
+    The connection of the session's transaction on the primary database. A sharded session can
+    only route statements on mapped tables, so Core statements on other tables (archive
+    partitions, executemany updates) and bare db.connection() calls go through this
+    """
+    return db.connection(bind_arguments={"shard_id": PRIMARY})
+
+
+def primary_dialect(db: Session) -> str:
+    return db.get_bind(shard_id=PRIMARY).dialect.name
+
+
+def shard_metadata() -> MetaData:
+    # the sharded tables without their foreign keys, whose targets (users, movies) are on the primary
+    metadata = MetaData()
+    for name in SHARDED_TABLES:
+        source = Base.metadata.tables[name]
+        columns = [Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                          server_default=column.server_default) for column in source.columns]
+        constraints = [UniqueConstraint(*[column.name for column in constraint.columns], name=constraint.name)
+                       for constraint in source.constraints if isinstance(constraint, UniqueConstraint)]
+        indexes = [Index(index.name, *[column.name for column in index.columns], unique=index.unique) for index in source.indexes]
+        Table(name, metadata, *columns, *constraints, *indexes)
+    return metadata
+
+
+def shard_engine(name: str):
+    return engine if name == PRIMARY else shards.engines[name]
+
+
+def copy_movie_rows(movie_id: int, source: str, target: str) -> int:
+    """
+    Replaces the rows of one movie on the target with those of the source, keeping their ids.
+    The movie must not take writes meanwhile (see pin_movies(moving=True)); repeating it after an
+    interrupted move starts over from the source
+    """
+    delete_movie_rows(movie_id, target)
+    copied = 0
+    with shard_engine(source).connect() as reader, shard_engine(target).begin() as writer:
+        for name in SHARDED_TABLES:
+            table = Base.metadata.tables[name]
+            rows = [dict(row) for row in reader.execute(select(table).where(table.c.movie_id == movie_id)).mappings()]
+            if rows:
+                writer.execute(table.insert(), rows)
+                copied += len(rows)
+    return copied
+
+
+def delete_movie_rows(movie_id: int, source: str):
+    with shard_engine(source).begin() as connection:
+        # children first, the primary still enforces the foreign keys
+        for name in reversed(SHARDED_TABLES):
+            table = Base.metadata.tables[name]
+            connection.execute(table.delete().where(table.c.movie_id == movie_id))
+
+
+def pin_movies(placements: dict, moving: bool = False):
+    """
+    Writes shard_directory entries {movie_id: shard}, read by every worker within
+    SHARD_DIRECTORY_SECONDS. moving marks the movies read-only until they are pinned again
+    """
+    with engine.begin() as connection:
+        for movie_id, shard in placements.items():
+            connection.execute(text("DELETE FROM shard_directory WHERE movie_id = :movie_id"), {"movie_id": movie_id})
+            connection.execute(text("INSERT INTO shard_directory (movie_id, shard, moving, moved_at) VALUES (:movie_id, :shard, :moving, :moved_at)"),
+                               {"movie_id": movie_id, "shard": shard, "moving": moving, "moved_at": datetime.utcnow()})
+    shards.invalidate_directory()
+
+
+def create_tables():
+    Base.metadata.create_all(bind=engine)
+    if shards is not None:
+        metadata = shard_metadata()
+        for shard in shards.engines.values():
+            metadata.create_all(bind=shard)
+
+
+for session_class in (RoutingSession, ShardedRoutingSession):
+
+    @event.listens_for(session_class, "after_flush")
+    def _mark_wrote(session, flush_context):
+        session.info["wrote"] = True
+
+    @event.listens_for(session_class, "do_orm_execute")
+    def _mark_bulk_write(orm_execute_state):
+        # bulk UPDATE/DELETE statements bypass the flush
+        if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+            orm_execute_state.session.info["wrote"] = True
+
+    @event.listens_for(session_class, "after_commit")
+    def _remember_write(session):
+        if session.info.get("wrote") and session.info.get("client_key"):
+            record_write(session.info["client_key"])
+            session.info["request_state"]["written_at"] = time.time()
+
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, class_=RoutingSession)
 
 Base = declarative_base()
 
+
+def configure(settings):
+    global engine, replicas, shards, REPLICA_HEALTH_SECONDS, READ_AFTER_WRITE_SECONDS, _signing_key
+    # the pools of a previous configuration would otherwise stay open
+    dispose()
+    engine = create_engine(settings.db_url)
+    SessionLocal.configure(bind=engine)
+    replicas = ReplicaSet([create_engine(url) for url in settings.replica_urls], settings.db_replica_policy) if settings.replica_urls else None
+    REPLICA_HEALTH_SECONDS = settings.db_replica_health_seconds
+    READ_AFTER_WRITE_SECONDS = settings.db_read_after_write_seconds
+    if settings.secret_key:
+        # shared by every worker, unlike the random default
+        _signing_key = hmac.new(settings.secret_key.encode(), b"last-write", hashlib.sha256).digest()
+    shard_urls = settings.shard_urls
+    shards = ShardMap({name: create_engine(url) for name, url in shard_urls.items()}, settings.shard_ring,
+                      settings.db_shard_directory_seconds) if shard_urls else None
+    SessionLocal.class_ = ShardedRoutingSession if shards is not None else RoutingSession
+
+
+def warm_up(size: int):
+    # Opens `size` pooled connections up front so the first requests don't pay for the connects
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def dispose():
+    if engine is not None:
+        engine.dispose()
+    if replicas is not None:
+        replicas.dispose()
+    if shards is not None:
+        shards.dispose()
+
+
+def client_key(request: HTTPConnection) -> str:
+    # the bearer token identifies a logged in user, anonymous clients fall back to their address
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return authorization
+    return request.client.host if request.client else "unknown"
+
 # Dependency
 
-def get_db():
+def get_db(request: HTTPConnection):
     db = SessionLocal()
+    db.info["client_key"] = client_key(request)
+    db.info["request_state"] = request.scope.setdefault("state", {})
     try:
         yield db
     finally:
         db.close()
+
+
+def get_read_db(request: HTTPConnection, db: Session = Depends(get_db)):
+    # Read-only handlers use this instead of get_db so their queries can be served by a replica
+    token = request.cookies.get(LAST_WRITE_COOKIE) or request.headers.get(LAST_WRITE_HEADER)
+    if not wrote_recently(client_key(request), token):
+        db.info["read_only"] = True
+    return db
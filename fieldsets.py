@@ -0,0 +1,84 @@
+# fieldsets.py
+from functools import lru_cache
+from typing import List, Optional
+from fastapi import HTTPException, Response, status
+from pydantic import ConfigDict, TypeAdapter, create_model
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only, noload, selectinload
+
+# Sparse fieldsets: ?fields=id,title,average_rating. The field set drives both the SQL
+# (load_only for the columns, noload for the relationships that were not asked for) and the
+# serialization, through a pydantic model derived from the full response schema. Derived models
+# and their list adapters are cached per (schema, field set), so a repeated field set costs no
+# model building. Responses are returned as ready JSON, bypassing the route's response_model.
+
+
+def parse(fields: Optional[str], schema) -> Optional[frozenset]:
+    """
+    The requested field names, or None when every field was asked for
+    """
+    if not fields:
+        return None
+    names = frozenset(name.strip() for name in fields.split(",") if name.strip())
+    unknown = names - schema.model_fields.keys()
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unknown field(s) {', '.join(sorted(unknown))}, available fields are {', '.join(schema.model_fields)}")
+    return names or None
+
+
+@lru_cache(maxsize=256)
+def model_for(schema, fields: frozenset):
+    definitions = {name: (field.annotation, field) for name, field in schema.model_fields.items() if name in fields}
+    return create_model(f"{schema.__name__}Fields", __config__=ConfigDict(from_attributes=True), **definitions)
+
+
+@lru_cache(maxsize=256)
+def _list_adapter(schema, fields: frozenset):
+    return TypeAdapter(List[model_for(schema, fields)])
+
+
+@lru_cache(maxsize=256)
+def _envelope(schema, fields: frozenset, key: str):
+    return create_model(f"{schema.__name__}FieldsList", __config__=ConfigDict(from_attributes=True),
+                        **{key: (List[model_for(schema, fields)], [])})
+
+
+def load_options(model, fields: Optional[frozenset], path=None):
+    """
+    Loader options fetching only the requested columns and relationships of `model`. `path` is
+    the loader the model is reached through (e.g. selectinload(Movie.comments)) for nested loads
+    """
+    if fields is None:
+        return [path] if path is not None else []
+    mapper = inspect(model)
+    columns = [getattr(model, name) for name in fields if name in mapper.column_attrs]
+    relationships = []
+    for relationship in mapper.relationships:
+        if relationship.key in fields:
+            relationships.append(selectinload(getattr(model, relationship.key)))
+            # the foreign key has to be loaded for the relationship to be resolved
+            columns.extend(getattr(model, column.key) for column in relationship.local_columns if column.key in mapper.column_attrs)
+        else:
+            relationships.append(noload(getattr(model, relationship.key)))
+    # load_only always adds the primary key
+    options = [load_only(*columns) if columns else load_only(*(getattr(model, column.key) for column in mapper.primary_key)), *relationships]
+    return [path.options(*options)] if path is not None else options
+
+
+def serialize(schema, fields: Optional[frozenset], data, many: bool = False, envelope: str = None) -> bytes:
+    """
+    JSON of `fields` (every field when None) of `schema`; many renders a list and envelope wraps
+    that list in an object under the given key
+    """
+    fields = frozenset(schema.model_fields) if fields is None else fields
+    if envelope is not None:
+        return _envelope(schema, fields, envelope).model_validate({envelope: data}, from_attributes=True).model_dump_json().encode()
+    if many:
+        adapter = _list_adapter(schema, fields)
+        return adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+    return model_for(schema, fields).model_validate(data, from_attributes=True).model_dump_json().encode()
+
+
+def render(schema, fields: Optional[frozenset], data, many: bool = False, envelope: str = None) -> Response:
+    return Response(content=serialize(schema, fields, data, many, envelope), media_type="application/json")
@@ -0,0 +1,289 @@
+# jobs.py
+import argparse
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, func, inspect, select, text
+import analytics
+import catalog
+import crud
+import database
+import models
+import partitioning
+from database import SessionLocal
+from logger import configure_logging, get_logger
+from settings import get_settings
+
+# Maintenance jobs, run from cron or by hand:  python jobs.py <job>
+
+logger = get_logger(__name__)
+
+
+def upgrade_movies(engine):
+    # adds the movie counters to a database created before them, safe to run again; they start
+    # at 0 until crud.repair_movie_counters fills them in
+    with engine.begin() as connection:
+        columns = {column["name"] for column in inspect(connection).get_columns("movies")}
+        for name in ("comment_count", "reply_count", "rating_count"):
+            if name not in columns:
+                connection.execute(text(f"ALTER TABLE movies ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0"))
+
+
+def repair_counters(args):
+    # also the upgrade step of older databases: creates the tables the counters are computed
+    # from (movie_archive_stats) and adds the counter columns first
+    database.create_tables()
+    upgrade_movies(database.engine)
+    db = SessionLocal()
+    try:
+        repaired = crud.repair_movie_counters(db)
+    finally:
+        db.close()
+    logger.info(f"Movie counters repaired for {repaired} movie(s)")
+    print(f"repaired {repaired} movie(s)")
+
+
+def build_catalog(args):
+    if not catalog.PATH:
+        raise SystemExit("CATALOG_PATH is not set")
+    db = SessionLocal()
+    try:
+        count = catalog.build(db, catalog.PATH, incremental=False)
+    finally:
+        db.close()
+    print(f"catalog snapshot written with {count} movie(s)")
+
+
+def run_catalog_builder(args):
+    # Long running builder process, applies the dirty log every --interval seconds
+    if not catalog.PATH:
+        raise SystemExit("CATALOG_PATH is not set")
+    logger.info(f"Catalog builder started for {catalog.PATH}")
+    while True:
+        db = SessionLocal()
+        try:
+            count = catalog.build(db, catalog.PATH)
+            if count is not None:
+                logger.info(f"Catalog snapshot rebuilt with {count} movie(s)")
+        except Exception:
+            logger.exception("Catalog rebuild failed")
+        finally:
+            db.close()
+        time.sleep(args.interval)
+
+
+def build_analytics(args):
+    if not analytics.PATH:
+        raise SystemExit("ANALYTICS_PATH is not set")
+    db = SessionLocal()
+    try:
+        count = analytics.build(db, analytics.PATH)
+    finally:
+        db.close()
+    print(f"analytics snapshot written with {count} rating(s)")
+
+
+def run_analytics_builder(args):
+    # Long running builder process, writes a new snapshot every --interval seconds
+    if not analytics.PATH:
+        raise SystemExit("ANALYTICS_PATH is not set")
+    logger.info(f"Analytics builder started for {analytics.PATH}")
+    while True:
+        db = SessionLocal()
+        try:
+            analytics.build(db, analytics.PATH)
+        except Exception:
+            logger.exception("Analytics snapshot build failed")
+        finally:
+            db.close()
+        time.sleep(args.interval)
+
+
+def archive(args):
+    days = args.days if args.days is not None else partitioning.RETENTION_DAYS
+    if days is None:
+        raise SystemExit("RETENTION_DAYS is not set, pass --days")
+    db = SessionLocal()
+    try:
+        archived = partitioning.archive_before(db, datetime.utcnow() - timedelta(days=days))
+    finally:
+        db.close()
+    print(f"archived {archived['ratings']} rating(s) and {archived['comments']} comment/reply row(s)")
+
+
+def upgrade_users(engine):
+    # adds users.is_admin to a database created before it existed, safe to run again
+    with engine.begin() as connection:
+        if "is_admin" not in {column["name"] for column in inspect(connection).get_columns("users")}:
+            connection.execute(text("ALTER TABLE users ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT false"))
+
+
+def set_admin(args):
+    upgrade_users(database.engine)
+    if args.username is None:
+        return
+    db = SessionLocal()
+    try:
+        user = crud.get_user_by_username(db, username=args.username)
+        if user is None:
+            raise SystemExit(f"No user named {args.username}")
+        user.is_admin = not args.revoke
+        db.commit()
+    finally:
+        db.close()
+    logger.warning(f"Administrator access {'revoked from' if args.revoke else 'granted to'} {args.username}")
+    print(f"{args.username} is {'not ' if args.revoke else ''}an administrator")
+
+
+def upgrade_replies(engine, batch_size: int = 1000):
+    """
+    Brings a replies table created before threaded replies up to date: drops the copied
+    original_comment, adds parent_id, path and depth, gives every existing reply (all of them
+    direct answers to their comment) its path and creates the new indexes. Safe to run again.
+    Returns the number of backfilled replies
+    """
+    replies = models.Reply.__table__
+    with engine.begin() as connection:
+        columns = {column["name"] for column in inspect(connection).get_columns("replies")}
+        if "parent_id" not in columns:
+            connection.execute(text("ALTER TABLE replies ADD COLUMN parent_id INTEGER REFERENCES replies (id)"))
+        if "path" not in columns:
+            connection.execute(text("ALTER TABLE replies ADD COLUMN path VARCHAR NOT NULL DEFAULT ''"))
+        if "depth" not in columns:
+            connection.execute(text("ALTER TABLE replies ADD COLUMN depth INTEGER NOT NULL DEFAULT 0"))
+        if "original_comment" in columns:
+            connection.execute(text("ALTER TABLE replies DROP COLUMN original_comment"))
+        if connection.dialect.name == "postgresql" and not any(
+                key["referred_table"] == "movies" for key in inspect(connection).get_foreign_keys("replies")):
+            # NOT VALID: enforced for new rows without scanning (and failing on) old orphans
+            connection.execute(text("ALTER TABLE replies ADD CONSTRAINT replies_movie_id_fkey "
+                                    "FOREIGN KEY (movie_id) REFERENCES movies (id) NOT VALID"))
+        for index in replies.indexes:
+            index.create(connection, checkfirst=True)
+
+    backfilled = 0
+    while True:
+        with engine.begin() as connection:
+            ids = connection.execute(select(replies.c.id).where(replies.c.path == "").limit(batch_size)).scalars().all()
+            if not ids:
+                return backfilled
+            connection.execute(
+                replies.update().where(replies.c.id == bindparam("b_id")).values(path=bindparam("b_path"), depth=0),
+                [{"b_id": reply_id, "b_path": f"{reply_id:0{models.Reply.PATH_DIGITS}d}."} for reply_id in ids],
+            )
+            backfilled += len(ids)
+            logger.info(f"Backfilled the thread path of {backfilled} replies")
+
+
+def migrate_replies(args):
+    engines = [database.engine, *(database.shards.engines.values() if database.shards else ())]
+    backfilled = sum(upgrade_replies(engine, args.batch_size) for engine in engines)
+    print(f"replies table up to date, {backfilled} reply path(s) backfilled")
+
+
+def reshard_movies(ring_names, from_primary: bool = False, batch_size: int = 100):
+    """
+    Moves every movie whose placement on the ring of ring_names differs from where its rows are
+    now, while the application keeps running. Per batch: mark the movies as moving in
+    shard_directory and wait until every worker has reloaded the directory (from then on their
+    rows only take reads), copy the rows, pin the movies to their new shard, wait again until no
+    worker reads the old shard and delete the rows there. from_primary moves the rows of a
+    database that was not sharded yet out of the primary
+    """
+    shard_map = database.shards
+    ring = database.HashRing(ring_names)
+    unknown = set(ring.names) - shard_map.engines.keys()
+    if unknown:
+        raise SystemExit(f"Unknown shard(s): {', '.join(sorted(unknown))}")
+
+    # never hand out an id below the ones being moved
+    sources = [database.PRIMARY, *shard_map.engines]
+    for name in database.SHARDED_TABLES:
+        table = database.Base.metadata.tables[name]
+        highest = 0
+        for source in sources:
+            with database.shard_engine(source).connect() as connection:
+                highest = max(highest, connection.execute(select(func.max(table.c.id))).scalar() or 0)
+        database.ensure_id_floor(name, highest + 1)
+
+    with database.engine.connect() as connection:
+        movie_ids = connection.execute(select(models.Movie.__table__.c.id).order_by(models.Movie.__table__.c.id)).scalars().all()
+    moves = {}
+    for movie_id in movie_ids:
+        source = database.PRIMARY if from_primary else shard_map.shard_for(movie_id)
+        if ring.get(movie_id) != source:
+            moves[movie_id] = (source, ring.get(movie_id))
+
+    movie_ids = list(moves)
+    for i in range(0, len(movie_ids), batch_size):
+        batch = movie_ids[i:i + batch_size]
+        database.pin_movies({movie_id: moves[movie_id][0] for movie_id in batch}, moving=True)
+        time.sleep(shard_map.directory_seconds)
+        for movie_id in batch:
+            database.copy_movie_rows(movie_id, *moves[movie_id])
+        database.pin_movies({movie_id: moves[movie_id][1] for movie_id in batch})
+        time.sleep(shard_map.directory_seconds)
+        for movie_id in batch:
+            database.delete_movie_rows(movie_id, moves[movie_id][0])
+        logger.info(f"Resharded {min(i + batch_size, len(movie_ids))}/{len(movie_ids)} movie(s)")
+    return len(moves)
+
+
+def reshard(args):
+    if database.shards is None:
+        raise SystemExit("DB_SHARD_URLS is not set")
+    ring_names = [name.strip() for name in args.ring.split(",") if name.strip()] if args.ring else database.shards.ring.names
+    moved = reshard_movies(ring_names, from_primary=args.from_primary, batch_size=args.batch_size)
+    print(f"moved {moved} movie(s); set DB_SHARD_RING={','.join(ring_names)} on every worker, the shard_directory "
+          f"entries keep the moved movies in place until then")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Movie API maintenance jobs")
+    jobs = parser.add_subparsers(dest="job", required=True)
+
+    jobs.add_parser("repair-counters", help="recompute comment/reply/rating counters on every movie").set_defaults(func=repair_counters)
+
+    jobs.add_parser("catalog-build", help="write a full movie catalog snapshot").set_defaults(func=build_catalog)
+    builder = jobs.add_parser("catalog-builder", help="keep the movie catalog snapshot up to date")
+    builder.add_argument("--interval", type=float, default=get_settings().catalog_build_seconds)
+    builder.set_defaults(func=run_catalog_builder)
+
+    jobs.add_parser("analytics-build", help="write a columnar ratings snapshot for /analytics").set_defaults(func=build_analytics)
+    analytics_builder = jobs.add_parser("analytics-builder", help="rebuild the analytics snapshot periodically")
+    analytics_builder.add_argument("--interval", type=float, default=get_settings().analytics_build_seconds)
+    analytics_builder.set_defaults(func=run_analytics_builder)
+
+    migrator = jobs.add_parser("migrate-replies", help="upgrade a replies table from before threaded replies")
+    migrator.add_argument("--batch-size", type=int, default=1000)
+    migrator.set_defaults(func=migrate_replies)
+
+    admin = jobs.add_parser("admin", help="grant or revoke access to the /admin endpoints")
+    admin.add_argument("username", nargs="?", help="without a username, only adds the is_admin column to an older database")
+    admin.add_argument("--revoke", action="store_true")
+    admin.set_defaults(func=set_admin)
+
+    archiver = jobs.add_parser("archive", help="move whole months older than the retention period to the archive partitions")
+    archiver.add_argument("--days", type=int, default=None)
+    archiver.set_defaults(func=archive)
+
+    resharder = jobs.add_parser("reshard", help="move movies to their shard on a new hash ring, online")
+    resharder.add_argument("--ring", default="", help="comma separated shard names of the new ring (DB_SHARD_RING by default)")
+    resharder.add_argument("--from-primary", action="store_true", help="move the rows of a database that was not sharded yet")
+    resharder.add_argument("--batch-size", type=int, default=100)
+    resharder.set_defaults(func=reshard)
+
+    args = parser.parse_args(argv)
+    settings = get_settings()
+    configure_logging(settings)
+    database.configure(settings)
+    catalog.configure(settings)
+    analytics.configure(settings)
+    partitioning.configure(settings)
+    try:
+        args.func(args)
+    finally:
+        database.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,34 @@
 import logging
 import logging.handlers
 
-PAPERTRAIL_HOST ='logs3.papertrailapp.com'
-PAPERTRAIL_PORT = 18858
+FORMAT = "%(asctime)s %(levelname)s %(message)s"
 
-handler = logging.handlers.SysLogHandler(address=(PAPERTRAIL_HOST, PAPERTRAIL_PORT))
-formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+# Handlers are attached by configure_logging() from the application lifespan, so importing this
+# module neither opens the Papertrail syslog socket nor needs the network.
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-    handlers=[handler]
-    
-#Terminal log    
-    #datefmt="%Y-%m-%d %H:%M:%S",
-    #filename="basic.log"
-    
-)
+def configure_logging(settings):
+    root = logging.getLogger()
+    root.setLevel(settings.log_level)
+    formatter = logging.Formatter(FORMAT)
 
-def get_logger(name):
-    logger = logging.getLogger(name)
-    return logger
+    #Terminal log
+    if not any(getattr(handler, "_movieapp", False) for handler in root.handlers):
+        console = logging.StreamHandler()
+        console.setFormatter(formatter)
+        console._movieapp = True
+        root.addHandler(console)
 
-logging.debug("this is a debug message")
-logging.info("this is a info message")
-logging.warning("this is a warning message")
-logging.error("this is a error message")
-logging.critical("this is a critical message")
+    if settings.papertrail_host and not any(isinstance(handler, logging.handlers.SysLogHandler) for handler in root.handlers):
+        try:
+            handler = logging.handlers.SysLogHandler(address=(settings.papertrail_host, settings.papertrail_port))
+        except OSError as exc:
+            root.warning(f"Papertrail logging disabled, {settings.papertrail_host} unreachable: {exc}")
+        else:
+            handler.setFormatter(formatter)
+            root.addHandler(handler)
 
 
+def get_logger(name):
+    logger = logging.getLogger(name)
+    return logger
@@ -1,13 +1,23 @@
 # main.py
-from fastapi import FastAPI, Depends, HTTPException, Response, status
+import asyncio
+import math
+from contextlib import asynccontextmanager
+from datetime import datetime
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from auth import pwd_context, authenticate_user, create_access_token, get_current_user
 from typing import List, Optional
-from database import engine, Base, get_db
+from database import get_db, get_read_db, SessionLocal
+import database
 import crud, models, schemas, auth
+import analytics, catalog, compression, fieldsets, metrics, partitioning, pubsub, ratelimit, rating_queue, singleflight
+from profiler import ProfilerMiddleware, profiler
 #from loguru import logger
-from logger import get_logger
+from logger import configure_logging, get_logger
+from settings import Settings, get_settings
 
 
 
@@ -17,17 +27,149 @@ logger = get_logger(__name__)
 
 #logger.add("app.log", rotation="500 MB", level="DEBUG")
 
-Base.metadata.create_all(bind=engine)
-
-# Initialize FastAPI app
-app = FastAPI() 
-
-@app.get("/")
+router = APIRouter()
+
+# The settings the modules are configured with. Engines, pools and the other module state are
+# per process, so one app serves at a time: an app applies its settings when it starts and hands
+# the previous ones back when it stops.
+active_settings = None
+
+
+def configure(settings: Settings):
+    """
+    Applies settings to every module, replacing (and disposing) the engines of the previous ones
+    """
+    global active_settings
+    database.configure(settings)
+    auth.configure(settings)
+    ratelimit.configure(settings)
+    rating_queue.configure(settings)
+    pubsub.configure(settings)
+    catalog.configure(settings)
+    partitioning.configure(settings)
+    compression.configure(settings)
+    singleflight.configure(settings)
+    analytics.configure(settings)
+    active_settings = settings
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = app.state.settings
+    previous = active_settings
+    if previous is not settings:
+        configure(settings)
+    configure_logging(settings)
+    if settings.create_tables:
+        database.create_tables()
+    database.warm_up(settings.db_pool_warmup)
+    if catalog.reader:
+        # map the shared snapshot now rather than on the first request
+        catalog.reader.current()
+    if analytics.reader:
+        analytics.reader.current()
+
+    workers = []
+    if rating_queue.WRITE_BEHIND:
+        workers.append(rating_queue.RatingWorker(SessionLocal))
+    if database.replicas:
+        database.replicas.check()
+        workers.append(database.ReplicaHealthChecker(database.replicas))
+    for worker in workers:
+        worker.start()
+    logger.info("Application started")
+    try:
+        yield
+    finally:
+        for worker in workers:
+            worker.stop()
+        profiler.stop()
+        database.dispose()
+        logger.info("Application stopped")
+        if previous is not None and previous is not settings:
+            configure(previous)
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """
+    Builds the application without touching the database, the network or any module state; the
+    lifespan configures the modules, creates the tables and starts the background workers
+    """
+    settings = settings or get_settings()
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings = settings
+    app.add_middleware(compression.CompressionMiddleware)
+    app.add_middleware(ProfilerMiddleware)
+    app.add_middleware(database.LastWriteMiddleware)
+    app.include_router(router)
+    app.add_exception_handler(database.MovieMovingError, movie_moving_handler)
+    return app
+
+
+async def movie_moving_handler(request: Request, exc: database.MovieMovingError):
+    # the movie's rows are being copied to another shard, which takes a few seconds
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": str(exc)},
+                        headers={"Retry-After": str(max(1, math.ceil(2 * database.shards.directory_seconds)))})
+
+
+@router.get("/")
 def read_root():
         return {"message":"WELCOME TO MY APP OF MOVIES"}
 
 
-@app.post("/Registration", response_model=schemas.User, status_code =status.HTTP_201_CREATED, tags= ["User"])
+@router.get("/metrics", response_class=PlainTextResponse, tags=["Metrics"])
+def read_metrics():
+    """
+    Exposes the application counters (rate limit rejections etc.) in the Prometheus text format
+    """
+    return metrics.render()
+
+
+# Profiling, administrators only
+@router.post("/admin/profiler/start", tags=["Admin"])
+def start_profiler(request: Request, interval_ms: Optional[float] = None, slow_ms: Optional[float] = None,
+                   admin: models.User = Depends(auth.get_current_admin)):
+    """
+    Starts the sampling profiler and the capture of requests slower than slow_ms
+    """
+    settings = request.app.state.settings
+    profiler.start(interval_ms=interval_ms or settings.profiler_interval_ms,
+                   slow_ms=settings.profiler_slow_ms if slow_ms is None else slow_ms)
+    logger.warning(f"Profiler started by {admin.username}")
+    return {"enabled": True, "interval_ms": profiler.interval * 1000, "slow_ms": profiler.slow_ms}
+
+
+@router.post("/admin/profiler/stop", tags=["Admin"])
+def stop_profiler(admin: models.User = Depends(auth.get_current_admin)):
+    profiler.stop()
+    logger.warning(f"Profiler stopped by {admin.username}")
+    return {"enabled": False, "samples": profiler.sample_count}
+
+
+@router.delete("/admin/profiler", tags=["Admin"])
+def reset_profiler(admin: models.User = Depends(auth.get_current_admin)):
+    profiler.reset()
+    return {"message": "Profiler data cleared"}
+
+
+@router.get("/admin/profiler/flamegraph", response_class=PlainTextResponse, tags=["Admin"])
+def download_flamegraph(admin: models.User = Depends(auth.get_current_admin)):
+    """
+    Collapsed stacks of every sample taken so far, ready for flamegraph.pl or speedscope
+    """
+    return PlainTextResponse(profiler.collapsed(), headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+
+@router.get("/admin/profiler/slow", tags=["Admin"])
+def slow_requests(admin: models.User = Depends(auth.get_current_admin)):
+    """
+    The latest requests over the latency threshold with their SQL statements and stack samples
+    """
+    return profiler.slow_requests()
+
+
+@router.post("/Registration", response_model=schemas.User, status_code =status.HTTP_201_CREATED, tags= ["User"],
+          dependencies=[Depends(ratelimit.limit_by_ip("register"))])
 
 def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
     """
@@ -48,7 +190,7 @@ def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
     return crud.create_user(db=db, user=user, hashed_password=hashed_password)
     
 
-@app.post("/login", status_code =status.HTTP_201_CREATED, tags=["User"])
+@router.post("/login", status_code =status.HTTP_201_CREATED, tags=["User"], dependencies=[Depends(ratelimit.limit_by_ip("login"))])
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """
     This Session is for user to login and generate a token that expires in 30mins time
@@ -67,7 +209,7 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
 
 
 # Movie endpoints
-@app.post("/movies/", response_model=schemas.Movie, status_code =status.HTTP_201_CREATED, tags= ["Movie"])
+@router.post("/movies/", response_model=schemas.Movie, status_code =status.HTTP_201_CREATED, tags= ["Movie"])
 def create_new_movie(movie: schemas.MovieCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
     """
     This is the Movie creation plaform, enter the movie information below
@@ -76,19 +218,27 @@ def create_new_movie(movie: schemas.MovieCreate, db: Session = Depends(get_db),
     return crud.create_movie(db=db, movie=movie, user_id=current_user.id)
 
 
-@app.get("/movies/", response_model=List[schemas.Movie], tags= ["Movie"])
-def list_all_movies(db: Session = Depends(get_db), skip: int = 0, limit: int = 10):
+@router.get("/movies/", response_model=List[schemas.Movie], tags= ["Movie"],
+            dependencies=[Depends(compression.tune("best"))])
+def list_all_movies(db: Session = Depends(get_read_db), skip: int = 0, limit: int = 10, fields: Optional[str] = None):
     
     """
-    This endpoint lists all available Movies created by all user
+    This endpoint lists all available Movies created by all user.
+    fields is a comma separated list of the movie fields to return, e.g. fields=id,title,year_released,average_rating
     """
     
     logger.info("Fetching list of movies")
-    return crud.get_movies(db=db, skip=skip, limit=limit)
+    selected = fieldsets.parse(fields, schemas.Movie)
+    movies = catalog.reader.page(skip, limit) if catalog.reader else None
+    if movies is None:
+        movies = crud.get_movies(db=db, skip=skip, limit=limit, fields=selected)
+    if selected:
+        return fieldsets.render(schemas.Movie, selected, movies, many=True)
+    return movies
 
 # Read User Movies
-@app.get("/movies/List", response_model=list[schemas.Movie], tags= ["Movie"])
-def my_movies(skip: int = 0, limit: int = 10, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(get_db)):
+@router.get("/movies/List", response_model=list[schemas.Movie], tags= ["Movie"])
+def my_movies(skip: int = 0, limit: int = 10, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(get_read_db)):
     """
     This endpoint lists all Movies created by the current user
     """
@@ -96,8 +246,8 @@ def my_movies(skip: int = 0, limit: int = 10, current_user: models.User = Depend
     logger.info(f"Fetching only the list of movie(s) created by the user_id:{current_user.id}")
     return movies
 
-@app.get("/movies/Search", response_model=List[schemas.Movie], tags= ["Movie"])
-def movie_by_title(search: Optional[str] = "", skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+@router.get("/movies/Search", response_model=List[schemas.Movie], tags= ["Movie"])
+def movie_by_title(search: Optional[str] = "", skip: int = 0, limit: int = 10, db: Session = Depends(get_read_db)):
     """
     You can use this endpoint to search for any movie title even if the title name provided doesn't match correctly.
     The Searching entry is case sensitive 
@@ -105,21 +255,33 @@ def movie_by_title(search: Optional[str] = "", skip: int = 0, limit: int = 10, d
     return db.query(models.Movie).filter( models.Movie.title.contains(search)).offset(skip).limit(limit).all()
     
 
-@app.get("/movies/{movie_id}", response_model=schemas.Movie, tags= ["Movie"])
-def get_movie_by_id(movie_id: int, db: Session = Depends(get_db)):
+@router.get("/movies/{movie_id}", response_model=schemas.Movie, tags= ["Movie"])
+def get_movie_by_id(movie_id: int, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
     
     """
-    This endpoint views one Movie at a time using the movie_id
+    This endpoint views one Movie at a time using the movie_id, fields optionally selects the movie fields to return
     """
-    movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, Please try another movie_id")
-    logger.info(f"Fetching details for movie id: {movie_id}, {movie.title}")   
-    return movie
+    selected = fieldsets.parse(fields, schemas.Movie)
+    if catalog.reader:
+        movie = catalog.reader.get(movie_id)
+        if movie is not None:
+            logger.info(f"Fetching details for movie id: {movie_id}, {movie['title']} from the catalog snapshot")
+            return fieldsets.render(schemas.Movie, selected, movie) if selected else movie
+
+    def load():
+        movie = crud.get_movie_by_id(db=db, movie_id=movie_id, fields=selected)
+        if movie is None:
+            logger.warning(f"Movie not found with id: {movie_id}")
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, Please try another movie_id")
+        logger.info(f"Fetching details for movie id: {movie_id}")
+        return fieldsets.serialize(schemas.Movie, selected, movie)
 
+    # concurrent identical requests share one query and one serialization
+    content = singleflight.movies.do(("movie", movie_id, selected, db.info.get("read_only")), load)
+    return Response(content=content, media_type="application/json")
 
-@app.put("/movies/{movie_id}", response_model=schemas.Movie, status_code =status.HTTP_201_CREATED, tags= ["Movie"])
+
+@router.put("/movies/{movie_id}", response_model=schemas.Movie, status_code =status.HTTP_201_CREATED, tags= ["Movie"])
 def update_movie(movie_id: int, movie: schemas.MovieUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     """
     This platform updates Movies created by the user using the Movie_id
@@ -135,7 +297,7 @@ def update_movie(movie_id: int, movie: schemas.MovieUpdate, db: Session = Depend
     logger.info(f"Updating movie details: {movie.title}")
     return crud.update_movie(db=db, movie_id=movie_id, movie=movie)
     
-@app.delete("/movies/{movie_id}", tags= ["Movie"])
+@router.delete("/movies/{movie_id}", tags= ["Movie"])
 def delete_movie(movie_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     """
     This endpoint allows the user to Delete its own created movie
@@ -150,11 +312,9 @@ def delete_movie(movie_id: int, db: Session = Depends(get_db), current_user: mod
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"You are not authorized to delete movie_id {movie_id}")
     
      # Check if there are related ratings or comments
-    if crud.get_ratings_for_movie(db=db, movie_id=movie_id):
-        logger.warning(f"trying to delete Movie {movie_id} with rating or comments, but operation aborted")
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"You cannot delete movie_id {movie_id} with existing ratings or comments")
-    if crud.get_comments_for_movie(db=db, movie_id=movie_id):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"You cannot delete movie_id {movie_id} with existing ratings or comments")
+    if crud.movie_has_dependents(db, movie_id):
+        logger.warning(f"trying to delete Movie {movie_id} with ratings, comments or replies, but operation aborted")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"You cannot delete movie_id {movie_id} with existing ratings, comments or replies")
     
     crud.delete_movie(db=db, movie_id=movie_id)
     logger.info(f"Movie_id {movie_id} deleted successfully")
@@ -163,7 +323,8 @@ def delete_movie(movie_id: int, db: Session = Depends(get_db), current_user: mod
     
 
 # Rating endpoints
-@app.post("/movies/{movie_id}/rate/", response_model=schemas.Rating, status_code=status.HTTP_201_CREATED, tags=["Rating"])
+@router.post("/movies/{movie_id}/rate/", response_model=schemas.Rating, status_code=status.HTTP_201_CREATED, tags=["Rating"],
+          dependencies=[Depends(ratelimit.limit_by_user("rate"))])
 def create_rating(movie_id: int, rating: schemas.RatingCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):   
     """
     This endpoint allows authenticated users to rate any movie using the movie_id,
@@ -179,23 +340,29 @@ def create_rating(movie_id: int, rating: schemas.RatingCreate, db: Session = Dep
     return db_rating
 
 
-@app.get("/movies/{movie_id}/ratings/", response_model=List[schemas.Rating], tags= ["Rating"])
-def get_ratings_for_movie(movie_id: int, db: Session = Depends(get_db)):
+@router.get("/movies/{movie_id}/ratings/", response_model=List[schemas.Rating], tags= ["Rating"],
+            dependencies=[Depends(compression.tune("default"))])
+def get_ratings_for_movie(movie_id: int, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                          include_archive: bool = False, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
     
     """
-    This endpoint allows the public to view the rated movie using the movie_id
+    This endpoint allows the public to view the rated movie using the movie_id.
+    since/until restrict the ratings to a time range and include_archive adds ratings moved to the archive by the retention job,
+    fields optionally selects the rating fields to return
     """
+    selected = fieldsets.parse(fields, schemas.Rating)
     movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
     if movie is None:
         logger.warning(f"Movie not found with id: {movie_id}")
         raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
     logger.info(f"Fetching ratings for movie:{movie.id}, {movie.title}")
-    return crud.get_ratings_for_movie(db=db, movie_id=movie_id, )
+    ratings = crud.get_ratings_for_movie(db=db, movie_id=movie_id, since=since, until=until, include_archive=include_archive, fields=selected)
+    return fieldsets.render(schemas.Rating, selected, ratings, many=True) if selected else ratings
 
-@app.delete("/ratings/{rating_id}", tags=["Rating"])
+@router.delete("/ratings/{rating_id}", tags=["Rating"])
 def delete_rating(rating_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     """
-    This endpoint allows a user to delete their own rating using the rating_id.
+    This endpoint allows a user to delete their own rating using the rating_id, including a rating moved to the archive.
     """
     # Fetch the rating by its ID
     existing_rating = crud.get_rating_by_id(db=db, rating_id=rating_id)
@@ -217,7 +384,8 @@ def delete_rating(rating_id: int, db: Session = Depends(get_db), current_user: m
    
 
 # comments, response_model=schema.CommentResponse
-@app.post("/movies/{movie_id}/comments/", response_model=schemas.CommentResponse, status_code =status.HTTP_201_CREATED, tags= ["Comment"])
+@router.post("/movies/{movie_id}/comments/", response_model=schemas.CommentResponse, status_code =status.HTTP_201_CREATED, tags= ["Comment"],
+          dependencies=[Depends(ratelimit.limit_by_user("comment"))])
 def create_comment(comment: schemas.CommentCreate, 
                    movie_id: int, 
                    current_user: schemas.User = Depends(get_current_user), 
@@ -235,21 +403,100 @@ def create_comment(comment: schemas.CommentCreate,
     return db_comment
 
     
-@app.get("/movies/{movie_id}/comments/", response_model=schemas.MovieCommentResponse, tags= ["Comment"])
-def get_comments(movie_id: int, db: Session = Depends(get_db)):
+@router.get("/movies/{movie_id}/comments/", response_model=schemas.MovieCommentResponse, tags= ["Comment"],
+            dependencies=[Depends(compression.tune("default"))])
+def get_comments(movie_id: int, since: Optional[datetime] = None, include_archive: bool = False, fields: Optional[str] = None,
+                 db: Session = Depends(get_read_db)):
     
     """
-    This endpoint allows the public to view comments & replies attached to any movie using the movie_id
+    This endpoint allows the public to view comments & replies attached to any movie using the movie_id,
+    optionally only those posted since a given time. include_archive adds the comments moved to the archive by the
+    retention job, fields selects the comment fields to return, e.g. fields=id,comment,user
     """
-    movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
-    logger.info(f"Fetching comments for movie:{movie.id}, {movie.title}")
-    return crud.get_comments(db=db, movie_id=movie_id)    
+    selected = fieldsets.parse(fields, schemas.CommentResponse)
+
+    def load():
+        movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
+        if movie is None:
+            logger.warning(f"Movie not found with id: {movie_id}")
+            raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
+        logger.info(f"Fetching comments for movie:{movie.id}, {movie.title}")
+        movie_with_comments = crud.get_comments(db=db, movie_id=movie_id, since=since, fields=selected)
+        comments = movie_with_comments.comments
+        if include_archive:
+            comments = crud.get_archived_comments(db, movie, since) + list(comments)
+        return fieldsets.serialize(schemas.CommentResponse, selected, comments, envelope="comments")
+
+    content = singleflight.comments.do(("comments", movie_id, since, include_archive, selected, db.info.get("read_only")), load)
+    return Response(content=content, media_type="application/json")
+
+
+# live comment streams
+async def _forward_comments(subscription: pubsub.Subscription, websocket: WebSocket):
+    while True:
+        message = await subscription.get()
+        if message is pubsub.OVERFLOW:
+            # the client fell behind, it has to reconnect and reload the comments
+            await websocket.close(code=1013)
+            return
+        await websocket.send_text(message)
 
 
-@app.delete("/comments/{comment_id}", tags=["Comment"])
+@router.websocket("/movies/{movie_id}/comments/ws")
+async def stream_comments_ws(websocket: WebSocket, movie_id: int, db: Session = Depends(get_read_db)):
+    """
+    Pushes new comments and replies on the movie as JSON messages
+    """
+    movie = await run_in_threadpool(crud.get_movie_by_id, db=db, movie_id=movie_id)
+    # release the pooled connection now instead of holding it for the lifetime of the stream
+    db.close()
+    if movie is None:
+        await websocket.close(code=1008)
+        return
+    # subscribe before accepting so nothing committed after the handshake is missed
+    with pubsub.hub.subscribe(pubsub.movie_topic(movie_id)) as subscription:
+        await websocket.accept()
+        sender = asyncio.create_task(_forward_comments(subscription, websocket))
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
+
+
+@router.get("/movies/{movie_id}/comments/stream", tags= ["Comment"],
+            dependencies=[Depends(compression.tune("fast"))])
+async def stream_comments_sse(movie_id: int, db: Session = Depends(get_read_db)):
+    """
+    Server-sent events version of the comment stream for clients without WebSocket support
+    """
+    movie = await run_in_threadpool(crud.get_movie_by_id, db=db, movie_id=movie_id)
+    # release the pooled connection now instead of holding it for the lifetime of the stream
+    db.close()
+    if movie is None:
+        raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
+    async def events():
+        # subscribed only once the body streams: a client gone before that leaves nothing behind,
+        # and a disconnect later cancels the generator inside the with block
+        with pubsub.hub.subscribe(pubsub.movie_topic(movie_id)) as subscription:
+            yield ": subscribed\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if message is pubsub.OVERFLOW:
+                    yield "event: overflow\ndata: {}\n\n"
+                    return
+                yield f"data: {message}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.delete("/comments/{comment_id}", tags=["Comment"])
 def delete_comment(comment_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     """
     This endpoint allows the user to delete their own comment using the comment_id.
@@ -273,33 +520,50 @@ def delete_comment(comment_id: int, db: Session = Depends(get_db), current_user:
     return {"message": "Comment deleted successfully"}
 
 # create reply
-@app.post('/{comment_id}/replies', response_model=schemas.CommentResponse, tags= ["Reply Comment"])
+@router.post('/{comment_id}/replies', response_model=schemas.ReplyCreated, tags= ["Reply Comment"],
+          dependencies=[Depends(ratelimit.limit_by_user("comment"))])
 def create_reply(payload: schemas.ReplyCreate, comment_id:int, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
     db_comment = crud.get_comment_by_id(db, comment_id)
     
     """
-    This endpoint allows the user to create a reply upon an existing comment to a movie 
+    This endpoint allows the user to create a reply upon an existing comment to a movie,
+    or upon another reply to that comment by giving its parent_id
     """
     
     if not db_comment:
         logger.warning(f"comment_id {comment_id} not found")
         raise HTTPException(status_code=404, detail=f"Comment_id {comment_id} does not exist")
     
-    # Extract the original comment text
     original_comment = db_comment.comment
-    movie_id = db_comment.movie_id
-    
-    reply = crud.create_reply(db, payload, comment_id, current_user.id, original_comment, movie_id )
-    db_comment.replies.append(reply)
-    db.add(db_comment)
-    db.commit()
-    db.refresh(db_comment)
-    return db_comment
-
+    reply = crud.create_reply(db, payload, comment_id, current_user.id, db_comment.movie_id)
+    response = schemas.ReplyCreated.model_validate(reply, from_attributes=True)
+    response.original_comment = original_comment
+    return response
 
 
-
-@app.delete("/Reply/{reply_id}", tags=["Reply Comment"])
+@router.get('/comments/{comment_id}/replies', response_model=schemas.ReplyThread, tags= ["Reply Comment"])
+def get_reply_thread(comment_id: int, parent_id: Optional[int] = None, max_depth: Optional[int] = None,
+                     skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=200), db: Session = Depends(get_read_db)):
+    """
+    This endpoint pages through the replies of a comment in thread order, also of a comment moved to the archive.
+    Give parent_id to fetch only the replies under that reply, and max_depth to limit how many levels deep the thread goes
+    """
+    db_comment = crud.get_comment_by_id(db, comment_id, include_archive=True)
+    if not db_comment:
+        logger.warning(f"comment_id {comment_id} not found")
+        raise HTTPException(status_code=404, detail=f"Comment_id {comment_id} does not exist")
+    archived = not isinstance(db_comment, models.Comment)
+    parent = None
+    if parent_id is not None:
+        parent = crud.get_reply_by_id(db, parent_id, include_archive=archived)
+        if parent is None or parent.comment_id != comment_id:
+            raise HTTPException(status_code=404, detail=f"Reply_id {parent_id} does not exist on comment_id {comment_id}")
+    replies = crud.get_reply_thread(db, comment_id, parent=parent, max_depth=max_depth, skip=skip, limit=limit,
+                                    archived_movie_id=db_comment.movie_id if archived else None)
+    return {"comment_id": comment_id, "original_comment": db_comment.comment, "replies": replies}
+
+
+@router.delete("/Reply/{reply_id}", tags=["Reply Comment"])
 def delete_reply(reply_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     """
     This endpoint allows the user to delete their replies made on comment using the reply_id.
@@ -321,3 +585,60 @@ def delete_reply(reply_id: int, db: Session = Depends(get_db), current_user: mod
     crud.delete_reply(db=db, reply_id=reply_id)
     logger.info(f"Reply_id {reply_id} deleted successfully")
     return {"message": "Reply deleted successfully"}
+
+
+
+def _analytics_snapshot():
+    snapshot = analytics.reader.current() if analytics.reader else None
+    if snapshot is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Analytics snapshot is not available yet")
+    return snapshot
+
+
+def _snapshot_at(snapshot):
+    return datetime.utcfromtimestamp(snapshot.built_at)
+
+
+@router.get("/analytics/movies/{movie_id}/histogram", response_model=schemas.RatingHistogram, tags=["Analytics"])
+def movie_rating_histogram(movie_id: int):
+    """
+    This endpoint returns how many half-star ratings a movie received, as of the last analytics snapshot
+    """
+    snapshot = _analytics_snapshot()
+    return {**snapshot.movie_histogram(movie_id), "snapshot_at": _snapshot_at(snapshot)}
+
+
+@router.get("/analytics/genres", response_model=schemas.GenreStatsResponse, tags=["Analytics"])
+def genre_rating_stats():
+    """
+    This endpoint returns the number of ratings and the average rating of every genre
+    """
+    snapshot = _analytics_snapshot()
+    return {"genres": snapshot.genres(), "snapshot_at": _snapshot_at(snapshot)}
+
+
+@router.get("/analytics/timeseries", response_model=schemas.RatingTimeseries, tags=["Analytics"])
+def rating_timeseries(interval: str = "day", since: Optional[datetime] = None, until: Optional[datetime] = None,
+                      movie_id: Optional[int] = None):
+    """
+    This endpoint returns the number of ratings per day, week or month, for every movie or only movie_id
+    """
+    snapshot = _analytics_snapshot()
+    try:
+        buckets = snapshot.timeseries(interval, since, until, movie_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+    return {"interval": interval, "movie_id": movie_id, "buckets": buckets, "snapshot_at": _snapshot_at(snapshot)}
+
+
+@router.get("/analytics/users/{user_id}", response_model=schemas.UserRatingStats, tags=["Analytics"])
+def user_rating_stats(user_id: int):
+    """
+    This endpoint returns the rating statistics of a user
+    """
+    snapshot = _analytics_snapshot()
+    return {**snapshot.user_stats(user_id), "snapshot_at": _snapshot_at(snapshot)}
+
+
+# Initialize FastAPI app
+app = create_app()
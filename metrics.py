@@ -0,0 +1,61 @@
+# metrics.py
+import threading
+from collections import defaultdict
+
+# Small in-process metrics registry, rendered in the Prometheus text format by GET /metrics
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name: str, value, **labels):
+    # value may be a number or a zero-argument callable evaluated at scrape time
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def get(name: str, **labels):
+    key = _key(name, labels)
+    with _lock:
+        if key in _counters:
+            return _counters[key]
+        value = _gauges.get(key)
+    return value() if callable(value) else value
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render() -> str:
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items(), key=lambda item: item[0])
+    lines = []
+    for (name, labels), value in counters:
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), value in gauges:
+        if callable(value):
+            value = value()
+        if value is None:
+            continue
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, UniqueConstraint, DateTime
+from sqlalchemy import Boolean, Column, Integer, String, Float, ForeignKey, UniqueConstraint, DateTime, Index, false
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -13,6 +13,8 @@ class User(Base):
     email = Column(String, nullable=False, unique=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     hashed_password = Column(String, nullable=False)
+    # granted out of band with "python jobs.py admin <username>", never through the API
+    is_admin = Column(Boolean, nullable=False, default=False, server_default=false())
     
     
     movies = relationship("Movie", back_populates="owner")
@@ -37,6 +39,10 @@ class Movie(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     owner_id = Column(Integer, ForeignKey("users.id"))
     average_rating = Column(Float, nullable=True)
+    # denormalized counters, maintained by crud and repaired by crud.repair_movie_counters
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+    reply_count = Column(Integer, nullable=False, default=0, server_default="0")
+    rating_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     owner = relationship("User", back_populates="movies")
     comments = relationship("Comment", back_populates="movie")
@@ -57,9 +63,19 @@ class Rating(Base):
     movie = relationship("Movie", back_populates="ratings")
     created_by = relationship("User", back_populates="ratings")
     
-    __table_args__ = (UniqueConstraint('user_id', 'movie_id', name='unique_user_movie_rating'),)
+    __table_args__ = (UniqueConstraint('user_id', 'movie_id', name='unique_user_movie_rating'),
+                      Index("ix_ratings_movie_created", "movie_id", "created_at"))
     
     
+class RatingAggregateQueue(Base):
+    # append-only log of movies whose rating aggregates must be recomputed (write-behind mode)
+    __tablename__ = "rating_aggregate_queue"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    movie_id = Column(Integer, nullable=False, index=True)
+    enqueued_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
 class Comment(Base):
     __tablename__ = "comments"
 
@@ -78,7 +94,9 @@ class Comment(Base):
     user = relationship("User", back_populates="comments", overlaps="created_by")
     created_by = relationship("User", overlaps="user, comments")
     movie = relationship("Movie", back_populates="comments")
-    replies = relationship("Reply", back_populates="comment")
+    replies = relationship("Reply", back_populates="comment", order_by="Reply.path")
+
+    __table_args__ = (Index("ix_comments_movie_created", "movie_id", "created_at"),)
     
 class Reply(Base):
     __tablename__ = "replies"
@@ -87,11 +105,74 @@ class Reply(Base):
     reply = Column(String, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"))
     comment_id = Column(Integer, ForeignKey("comments.id"), nullable=True)
-    original_comment = Column(String, nullable=False)
-    movie_id = Column(Integer, nullable=False)
+    movie_id = Column(Integer, ForeignKey("movies.id"), nullable=False, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # threading: parent_id is the reply answered (NULL for a direct reply to the comment), path is the
+    # materialized path of zero-padded ids ("0000000012.0000000034.") so a subtree is one index range
+    parent_id = Column(Integer, ForeignKey("replies.id"), nullable=True)
+    path = Column(String, nullable=False, default="")
+    depth = Column(Integer, nullable=False, default=0)
  
     comment = relationship("Comment", back_populates="replies")
     user = relationship("User")
-    
-    
\ No newline at end of file
+
+    __table_args__ = (Index("ix_replies_comment_path", "comment_id", "path"),)
+
+    PATH_DIGITS = 10
+
+    @staticmethod
+    def subtree_upper_bound(path: str) -> str:
+        # every descendant path sorts between path and this bound ("." + 1 == "/")
+        return path[:-1] + "/"
+
+
+class ArchivePartition(Base):
+    # one row per monthly archive partition written by partitioning.archive_before
+    __tablename__ = "archive_partitions"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    period_start = Column(DateTime, nullable=False)
+    period_end = Column(DateTime, nullable=False)
+    rows = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint("source", "period_start", name="unique_archive_partition"),)
+
+
+class ArchiveWatermark(Base):
+    # every row of `source` created before archived_before has moved to the archive
+    __tablename__ = "archive_watermarks"
+
+    source = Column(String, primary_key=True)
+    archived_before = Column(DateTime, nullable=False)
+
+
+class MovieArchiveStats(Base):
+    # per-movie totals of the archived rows, used to repair the counters on movies
+    __tablename__ = "movie_archive_stats"
+
+    movie_id = Column(Integer, primary_key=True)
+    comment_count = Column(Integer, nullable=False, default=0)
+    reply_count = Column(Integer, nullable=False, default=0)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Float, nullable=False, default=0)
+
+
+class ShardDirectory(Base):
+    # movies pinned to a shard other than their hash ring placement (see database.ShardMap)
+    __tablename__ = "shard_directory"
+
+    movie_id = Column(Integer, primary_key=True)
+    shard = Column(String, nullable=False)
+    # set while "python jobs.py reshard" copies the movie: its rows take no writes
+    moving = Column(Boolean, default=False, nullable=False)
+    moved_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class IdBlock(Base):
+    # next free id of each sharded table, reserved in blocks by database.reserve_ids
+    __tablename__ = "id_blocks"
+
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer, nullable=False)
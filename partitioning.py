@@ -0,0 +1,306 @@
+# partitioning.py
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import Column, Index, MetaData, Table, and_, delete, func, insert, or_, select, text, union_all, update
+from sqlalchemy.orm import Session
+import database
+import metrics
+import models
+from logger import get_logger
+
+# Time partitioning of ratings, comments and replies.
+#
+# The hot tables keep their foreign keys and the one-rating-per-user constraint, which a
+# Postgres partitioned table cannot carry (its keys must include the partition column), so they
+# stay plain tables kept small by retention. archive_before() moves whole cold months into
+# compact archive partitions without foreign keys:
+#   - Postgres: "<table>_archive" declared PARTITION BY RANGE (created_at), with one
+#     "<table>_archive_YYYY_MM" partition per month, so the planner prunes partitions itself
+#   - SQLite (or NATIVE = False): one plain "<table>_archive_YYYY_MM" table per month, listed in
+#     archive_partitions, and queries only visit the months overlapping their time range
+# Archived rows keep counting in the movie counters; their per-movie totals are kept in
+# movie_archive_stats so crud.repair_movie_counters stays exact. An archived rating can still be
+# deleted by its owner (crud.delete_rating), which updates those totals; archived comments and
+# replies are read-only, listed with include_archive like archived ratings.
+
+SOURCES = {
+    "ratings": models.Rating.__table__,
+    "comments": models.Comment.__table__,
+    "replies": models.Reply.__table__,
+}
+NATIVE = True
+RETENTION_DAYS = None
+CHUNK_SIZE = 500
+
+archive_metadata = MetaData()
+logger = get_logger(__name__)
+
+
+def configure(settings):
+    global NATIVE, RETENTION_DAYS
+    NATIVE = settings.archive_native_partitions
+    RETENTION_DAYS = settings.retention_days
+
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def next_month(value: datetime) -> datetime:
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def uses_native(db: Session) -> bool:
+    return NATIVE and database.primary_dialect(db) == "postgresql"
+
+
+def _archive_table(name: str, source: str, **kwargs) -> Table:
+    if name in archive_metadata.tables:
+        return archive_metadata.tables[name]
+    columns = [Column(column.name, column.type) for column in SOURCES[source].columns]
+    return Table(name, archive_metadata, *columns, Index(f"ix_{name}_movie_created", "movie_id", "created_at"),
+                 Index(f"ix_{name}_id", "id"), **kwargs)
+
+
+def _parent_table(source: str) -> Table:
+    return _archive_table(f"{source}_archive", source, postgresql_partition_by="RANGE (created_at)")
+
+
+def partition_name(source: str, start: datetime) -> str:
+    return f"{source}_archive_{start:%Y_%m}"
+
+
+def ensure_partition(db: Session, source: str, start: datetime) -> Table:
+    """
+    Creates the archive partition of the month starting at `start` if needed and returns the
+    table rows must be inserted into
+    """
+    name = partition_name(source, start)
+    end = next_month(start)
+    connection = database.primary_connection(db)
+    if uses_native(db):
+        target = _parent_table(source)
+        target.create(connection, checkfirst=True)
+        # the bounds are generated dates, never user input
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {target.name} "
+            f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        ))
+    else:
+        target = _archive_table(name, source)
+        target.create(connection, checkfirst=True)
+    partition = db.query(models.ArchivePartition).filter(models.ArchivePartition.source == source,
+                                                         models.ArchivePartition.period_start == start).first()
+    if partition is None:
+        db.add(models.ArchivePartition(source=source, name=name, period_start=start, period_end=end, rows=0))
+        db.flush()
+    return target
+
+
+# Reads
+
+def hot_since(db: Session, source: str):
+    # rows of `source` older than this are only in the archive
+    watermark = db.get(models.ArchiveWatermark, source)
+    return watermark.archived_before if watermark else None
+
+
+def partitions(db: Session, source: str, since: datetime = None, until: datetime = None):
+    query = db.query(models.ArchivePartition).filter(models.ArchivePartition.source == source)
+    if since is not None:
+        query = query.filter(models.ArchivePartition.period_end > since)
+    if until is not None:
+        query = query.filter(models.ArchivePartition.period_start < until)
+    return query.order_by(models.ArchivePartition.period_start).all()
+
+
+def _tables(db: Session, source: str, existing):
+    # the tables to read the partitions `existing` of source from
+    if uses_native(db):
+        return [_parent_table(source)]
+    return [_archive_table(partition.name, source) for partition in existing]
+
+
+def archived_rows(db: Session, source: str, movie_id: int, since: datetime = None, until: datetime = None, **equals):
+    """
+    Archived rows of one movie in [since, until), oldest first, visiting only the partitions
+    overlapping the range
+    """
+    overlapping = partitions(db, source, since, until)
+    if not overlapping:
+        return []
+    selects = []
+    for table in _tables(db, source, overlapping):
+        criteria = [table.c.movie_id == movie_id]
+        if since is not None:
+            criteria.append(table.c.created_at >= since)
+        if until is not None:
+            criteria.append(table.c.created_at < until)
+        criteria.extend(table.c[name] == value for name, value in equals.items())
+        selects.append(select(table).where(*criteria))
+    combined = (union_all(*selects) if len(selects) > 1 else selects[0]).subquery()
+    return db.execute(select(combined).order_by(combined.c.created_at, combined.c.id)).mappings().all()
+
+
+def iter_archived(db: Session, source: str, columns, chunk_size: int = 100_000):
+    # every archived row of source as chunks of tuples of `columns`, for bulk readers
+    existing = partitions(db, source)
+    if not existing:
+        return
+    for table in _tables(db, source, existing):
+        result = db.execute(select(*[table.c[name] for name in columns]).execution_options(yield_per=chunk_size))
+        yield from result.partitions()
+
+
+def rating_totals(db: Session, movie_ids):
+    """
+    {movie_id: (count, sum)} over hot and archived ratings; the hot part is an aggregate over
+    ix_ratings_movie_created, which retention keeps bounded
+    """
+    totals = {movie_id: (0, 0.0) for movie_id in movie_ids}
+    rows = db.execute(
+        select(models.Rating.movie_id, func.count(models.Rating.id), func.sum(models.Rating.rating))
+        .where(models.Rating.movie_id.in_(totals))
+        .group_by(models.Rating.movie_id)
+    )
+    for movie_id, count, total in rows:
+        totals[movie_id] = (count, total or 0.0)
+    for stats in db.query(models.MovieArchiveStats).filter(models.MovieArchiveStats.movie_id.in_(totals)):
+        count, total = totals[stats.movie_id]
+        totals[stats.movie_id] = (count + stats.rating_count, total + stats.rating_sum)
+    return totals
+
+
+def archived_rating_exists(db: Session, movie_id: int, user_id: int) -> bool:
+    stats = db.get(models.MovieArchiveStats, movie_id)
+    if stats is None or not stats.rating_count:
+        return False
+    return bool(archived_rows(db, "ratings", movie_id, user_id=user_id))
+
+
+def archived_row(db: Session, source: str, row_id: int):
+    # the archived row of source with this id, or None
+    for table in _tables(db, source, partitions(db, source)):
+        row = db.execute(select(table).where(table.c.id == row_id)).first()
+        if row is not None:
+            return row
+    return None
+
+
+def delete_archived_rating(db: Session, row):
+    """
+    Deletes an archived rating (a row returned by archived_row) and takes it out of the
+    movie's archive totals; the caller commits and updates the movie
+    """
+    start = month_start(row.created_at)
+    table = _parent_table("ratings") if uses_native(db) else _archive_table(partition_name("ratings", start), "ratings")
+    db.execute(delete(table).where(table.c.id == row.id))
+    db.query(models.ArchivePartition).filter(models.ArchivePartition.source == "ratings",
+                                             models.ArchivePartition.period_start == start).update(
+        {models.ArchivePartition.rows: models.ArchivePartition.rows - 1}, synchronize_session=False)
+    _add_stats(db, row.movie_id, rating_count=-1, rating_sum=-row.rating)
+
+
+# Retention job
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), CHUNK_SIZE):
+        yield values[i:i + CHUNK_SIZE]
+
+
+def _add_stats(db: Session, movie_id: int, **deltas):
+    stats = db.get(models.MovieArchiveStats, movie_id)
+    if stats is None:
+        stats = models.MovieArchiveStats(movie_id=movie_id, comment_count=0, reply_count=0, rating_count=0, rating_sum=0)
+        db.add(stats)
+    for name, delta in deltas.items():
+        setattr(stats, name, getattr(stats, name) + delta)
+
+
+def _move_rows(db: Session, source: str, rows):
+    # inserts rows (mappings of the hot table) into their monthly partitions
+    by_month = defaultdict(list)
+    for row in rows:
+        by_month[month_start(row["created_at"])].append(dict(row))
+    for start, month_rows in by_month.items():
+        target = ensure_partition(db, source, start)
+        db.execute(insert(target), month_rows)
+        db.query(models.ArchivePartition).filter(models.ArchivePartition.source == source,
+                                                 models.ArchivePartition.period_start == start).update(
+            {models.ArchivePartition.rows: models.ArchivePartition.rows + len(month_rows)}, synchronize_session=False)
+
+
+def _archive_ratings(db: Session, start: datetime, end: datetime):
+    ratings = SOURCES["ratings"]
+    in_range = and_(ratings.c.created_at >= start, ratings.c.created_at < end)
+    rows = db.execute(select(ratings).where(in_range)).mappings().all()
+    if not rows:
+        return 0
+    _move_rows(db, "ratings", rows)
+    for row in db.execute(select(ratings.c.movie_id, func.count(), func.sum(ratings.c.rating)).where(in_range).group_by(ratings.c.movie_id)):
+        _add_stats(db, row[0], rating_count=row[1], rating_sum=row[2])
+    db.execute(delete(ratings).where(in_range))
+    return len(rows)
+
+
+def _archive_comments(db: Session, start: datetime, end: datetime):
+    comments, replies = SOURCES["comments"], SOURCES["replies"]
+    in_range = and_(comments.c.created_at >= start, comments.c.created_at < end)
+    # a comment moves together with its whole reply thread; replies whose comment was deleted
+    # are archived by their own date
+    reply_rows = db.execute(select(replies).where(or_(
+        replies.c.comment_id.in_(select(comments.c.id).where(in_range)),
+        and_(replies.c.comment_id.is_(None), replies.c.created_at >= start, replies.c.created_at < end),
+    ))).mappings().all()
+    comment_rows = db.execute(select(comments).where(in_range)).mappings().all()
+
+    if reply_rows:
+        _move_rows(db, "replies", reply_rows)
+        reply_counts = defaultdict(int)
+        for row in reply_rows:
+            reply_counts[row["movie_id"]] += 1
+        for movie_id, count in reply_counts.items():
+            _add_stats(db, movie_id, reply_count=count)
+        reply_ids = [row["id"] for row in reply_rows]
+        for chunk in _chunks(reply_ids):
+            # answers that stay hot lose the link to an archived parent, as in crud.delete_reply
+            db.execute(update(replies).where(replies.c.parent_id.in_(chunk)).values(parent_id=None))
+        for chunk in _chunks(reply_ids):
+            db.execute(delete(replies).where(replies.c.id.in_(chunk)))
+
+    if comment_rows:
+        _move_rows(db, "comments", comment_rows)
+        for row in db.execute(select(comments.c.movie_id, func.count()).where(in_range).group_by(comments.c.movie_id)):
+            _add_stats(db, row[0], comment_count=row[1])
+        db.execute(delete(comments).where(in_range))
+    return len(comment_rows) + len(reply_rows)
+
+
+def archive_before(db: Session, cutoff: datetime):
+    """
+    Moves every whole month older than cutoff out of the hot tables, one transaction per month.
+    Returns {source: rows archived}
+    """
+    cutoff = month_start(cutoff)
+    # one row per shard when the tables are sharded
+    oldest = [value for source in SOURCES for value in db.scalars(select(func.min(SOURCES[source].c.created_at))) if value is not None]
+    archived = {"ratings": 0, "comments": 0}
+    start = month_start(min(oldest)) if oldest else cutoff
+    while start < cutoff:
+        end = next_month(start)
+        archived["ratings"] += _archive_ratings(db, start, end)
+        archived["comments"] += _archive_comments(db, start, end)
+        db.commit()
+        start = end
+    for source in SOURCES:
+        watermark = db.get(models.ArchiveWatermark, source)
+        if watermark is None:
+            db.add(models.ArchiveWatermark(source=source, archived_before=cutoff))
+        elif watermark.archived_before < cutoff:
+            watermark.archived_before = cutoff
+    db.commit()
+    metrics.inc("archived_rows_total", archived["ratings"], source="ratings")
+    metrics.inc("archived_rows_total", archived["comments"], source="comments")
+    logger.info(f"Archived {archived['ratings']} rating(s) and {archived['comments']} comment/reply row(s) older than {cutoff:%Y-%m-%d}")
+    return archived
@@ -0,0 +1,222 @@
+# profiler.py
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import metrics
+
+# Opt-in sampling profiler. While it is off the only cost is one attribute check per request in
+# ProfilerMiddleware. While it is on, a daemon thread samples every thread's stack every
+# interval and aggregates them as collapsed stacks ("module:function;module:function count"),
+# the input format of flamegraph.pl and speedscope. Requests slower than slow_ms are kept with
+# their SQL statements and the stack samples taken while those statements ran. Samples are only
+# attributed inside these windows: the event loop thread is shared by every async request and a
+# threadpool thread moves on to other requests, so a thread id alone does not identify a request.
+
+MAX_DEPTH = 64
+MAX_STACKS = 10_000
+MAX_SQL_PER_REQUEST = 200
+MAX_CAPTURES = 50
+
+# stacks parked in these modules are idle threads (pool workers waiting for work, the event loop)
+IDLE_MODULES = {"threading.py", "selectors.py", "queue.py", "base_events.py"}
+
+_current_capture = contextvars.ContextVar("profiler_capture", default=None)
+
+
+class RequestCapture:
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.status = None
+        self.sql = []
+        self.samples = Counter()
+
+    def as_dict(self):
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "duration_ms": round(self.duration_ms, 2),
+            "sql": [{"statement": statement, "duration_ms": round(duration, 2)} for statement, duration in self.sql],
+            "samples": [f"{stack} {count}" for stack, count in self.samples.most_common()],
+        }
+
+
+def _collapse(frame):
+    frames = []
+    while frame is not None and len(frames) < MAX_DEPTH:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    frames.reverse()
+    return ";".join(frames)
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = 0.01
+        self.slow_ms = 500.0
+        self.stacks = Counter()
+        self.sample_count = 0
+        self.captures = deque(maxlen=MAX_CAPTURES)
+        self._inflight = set()
+        # thread id -> capture of the request whose SQL statement the thread is executing
+        self._active = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # lifecycle
+
+    def start(self, interval_ms: float = 10, slow_ms: float = 500):
+        with self._lock:
+            self.interval = max(interval_ms, 1) / 1000
+            self.slow_ms = slow_ms
+            if self.enabled:
+                return
+            self.enabled = True
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+    def stop(self):
+        with self._lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self._stopped.set()
+            thread = self._thread
+        thread.join(5)
+        event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.remove(Engine, "handle_error", _handle_error)
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.sample_count = 0
+            self.captures.clear()
+
+    # sampling
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            started = time.perf_counter()
+            self.sample(exclude=own_id)
+            metrics.inc("profiler_sampling_seconds_total", time.perf_counter() - started)
+
+    def sample(self, exclude=None):
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, frame in frames.items():
+                if thread_id == exclude or os.path.basename(frame.f_code.co_filename) in IDLE_MODULES:
+                    continue
+                stack = _collapse(frame)
+                if stack in self.stacks or len(self.stacks) < MAX_STACKS:
+                    self.stacks[stack] += 1
+                else:
+                    self.stacks["[other]"] += 1
+                capture = self._active.get(thread_id)
+                if capture is not None:
+                    capture.samples[stack] += 1
+            self.sample_count += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    # request captures
+
+    def begin(self, method: str, path: str):
+        capture = RequestCapture(method, path)
+        with self._lock:
+            self._inflight.add(capture)
+        return capture, _current_capture.set(capture)
+
+    def end(self, capture: RequestCapture, token):
+        _current_capture.reset(token)
+        capture.duration_ms = (time.perf_counter() - capture.started) * 1000
+        with self._lock:
+            self._inflight.discard(capture)
+            for thread_id in [thread_id for thread_id, active in self._active.items() if active is capture]:
+                del self._active[thread_id]
+            if capture.duration_ms >= self.slow_ms:
+                self.captures.append(capture)
+                metrics.inc("profiler_slow_requests_total")
+
+    def enter_sql(self, capture: RequestCapture):
+        with self._lock:
+            self._active[threading.get_ident()] = capture
+
+    def leave_sql(self):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def slow_requests(self):
+        with self._lock:
+            return [capture.as_dict() for capture in self.captures]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    capture = _current_capture.get()
+    if capture is not None:
+        # samples of this thread belong to the request until the statement returns
+        profiler.enter_sql(capture)
+        conn.info.setdefault("profiler_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    capture = _current_capture.get()
+    starts = conn.info.get("profiler_query_start")
+    if capture is not None and starts:
+        profiler.leave_sql()
+        elapsed = (time.perf_counter() - starts.pop()) * 1000
+        if len(capture.sql) < MAX_SQL_PER_REQUEST:
+            capture.sql.append((statement, elapsed))
+
+
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute
+    connection = exception_context.connection
+    starts = connection.info.get("profiler_query_start") if connection is not None else None
+    if _current_capture.get() is not None and starts:
+        starts.pop()
+        profiler.leave_sql()
+
+
+profiler = Profiler()
+
+
+class ProfilerMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not profiler.enabled or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        capture, token = profiler.begin(scope["method"], scope["path"])
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                capture.status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.end(capture, token)
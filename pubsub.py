@@ -0,0 +1,135 @@
+# pubsub.py
+import asyncio
+import threading
+import metrics
+
+# In-process fan-out hub for live comment/reply streams. Messages are serialized once by the
+# publisher and handed to every subscriber's bounded queue on the subscriber's own event loop,
+# so publishing from the sync threadpool (crud) never blocks on slow clients.
+
+QUEUE_SIZE = 100
+
+# Delivered instead of further messages once a subscriber's queue overflowed; the client is
+# expected to reconnect and reload the comments with GET /movies/{movie_id}/comments/
+OVERFLOW = object()
+
+
+def movie_topic(movie_id: int) -> str:
+    return f"movie:{movie_id}:comments"
+
+
+class Subscription:
+
+    def __init__(self, hub, topic: str, maxsize: int):
+        self.hub = hub
+        self.topic = topic
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def offer(self, message):
+        # always runs on self.loop
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            metrics.inc("pubsub_overflowed_subscribers_total")
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Hub:
+
+    def __init__(self):
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic: str, maxsize: int = None) -> Subscription:
+        """
+        Must be called from the event loop that will consume the subscription
+        """
+        subscription = Subscription(self, topic, maxsize or QUEUE_SIZE)
+        with self._lock:
+            self._topics.setdefault(topic, set()).add(subscription)
+        metrics.inc("pubsub_subscriptions_total")
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._topics.get(subscription.topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[subscription.topic]
+
+    def subscriber_count(self, topic: str = None) -> int:
+        with self._lock:
+            if topic is not None:
+                return len(self._topics.get(topic, ()))
+            return sum(len(subscribers) for subscribers in self._topics.values())
+
+    def deliver(self, topic: str, message: str):
+        # Thread-safe; may be called from any thread or event loop
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+            except RuntimeError:
+                # the subscriber's loop is already closed
+                self.unsubscribe(subscription)
+        metrics.inc("pubsub_delivered_total", len(subscribers))
+
+
+class LocalBroker:
+    """
+    Local stand-in for a cross-worker broker. A shared broker (Redis pub/sub, Postgres
+    LISTEN/NOTIFY, ...) implements the same publish/attach pair and calls hub.deliver for
+    messages received from other workers
+    """
+
+    def __init__(self):
+        self._hubs = []
+
+    def attach(self, hub: Hub):
+        self._hubs.append(hub)
+
+    def publish(self, topic: str, message: str):
+        for hub in self._hubs:
+            hub.deliver(topic, message)
+
+
+hub = Hub()
+broker = LocalBroker()
+broker.attach(hub)
+
+
+def configure(settings):
+    global QUEUE_SIZE
+    QUEUE_SIZE = settings.pubsub_queue_size
+
+
+def set_broker(new_broker):
+    global broker
+    broker = new_broker
+    broker.attach(hub)
+
+
+def publish(topic: str, message: str):
+    metrics.inc("pubsub_published_total")
+    broker.publish(topic, message)
@@ -0,0 +1,186 @@
+# ratelimit.py
+import math
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Depends, HTTPException, Request, status
+import metrics
+import models
+from auth import get_current_user
+
+# Token-bucket rate limiting. Each bucket is keyed by "<scope>:<client ip>" or "<scope>:user:<id>"
+# and stores (tokens, last_refill) so a check is O(1) regardless of traffic.
+
+TRUST_PROXY = False
+PROXY_HOPS = 1
+ENABLED = True
+
+# scope -> "capacity/period_in_seconds", overridable with RATE_LIMIT_<SCOPE>=N/SECONDS
+DEFAULT_POLICIES = {
+    "login": "30/60",
+    "register": "10/60",
+    "rate": "60/60",
+    "comment": "30/60",
+}
+
+
+def parse_policy(value: str):
+    capacity, period = value.split("/")
+    capacity, period = int(capacity), float(period)
+    if capacity <= 0 or period <= 0:
+        raise ValueError(f"Invalid rate limit policy {value!r}")
+    return capacity, capacity / period
+
+
+def load_policies(settings=None):
+    policies = {}
+    for scope, default in DEFAULT_POLICIES.items():
+        policies[scope] = parse_policy(getattr(settings, f"rate_limit_{scope}", default))
+    return policies
+
+
+def _refill(tokens, last, now, capacity, refill_rate):
+    return min(capacity, tokens + (now - last) * refill_rate)
+
+
+def _take(state, now, capacity, refill_rate, cost):
+    # Returns (new_state, allowed, retry_after)
+    if state is None:
+        tokens = float(capacity)
+    else:
+        tokens = _refill(state[0], state[1], now, capacity, refill_rate)
+    if tokens >= cost:
+        return (tokens - cost, now), True, 0.0
+    return (tokens, now), False, (cost - tokens) / refill_rate
+
+
+class InMemoryBackend:
+    """
+    Per-process buckets. The least recently used keys are evicted once max_keys is reached
+    """
+
+    def __init__(self, max_keys: int = 100_000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, capacity: int, refill_rate: float, cost: int = 1):
+        with self._lock:
+            state, allowed, retry_after = _take(self._buckets.get(key), self.clock(), capacity, refill_rate, cost)
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class LocalStore:
+    """
+    Local stand-in for a shared key/value store (e.g. Redis) used by SharedBackend.
+    A real store must implement the same get/compare_and_set contract atomically
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def compare_and_set(self, key, expected, new, ttl: float):
+        with self._lock:
+            if self._data.get(key) != expected:
+                return False
+            self._data[key] = new
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedBackend:
+    """
+    Buckets kept in a store shared by every worker, updated with an optimistic compare-and-set
+    loop. Uses wall-clock time because the timestamps are compared across processes
+    """
+
+    def __init__(self, store, clock=time.time, max_retries: int = 5):
+        self.store = store
+        self.clock = clock
+        self.max_retries = max_retries
+
+    def consume(self, key: str, capacity: int, refill_rate: float, cost: int = 1):
+        for _ in range(self.max_retries):
+            current = self.store.get(key)
+            state, allowed, retry_after = _take(current, self.clock(), capacity, refill_rate, cost)
+            # a full bucket is reached after capacity/refill_rate seconds, so the key can expire then
+            if self.store.compare_and_set(key, current, state, ttl=capacity / refill_rate):
+                return allowed, retry_after
+        # heavy contention on a single key: fail closed rather than spinning
+        return False, 1 / refill_rate
+
+    def reset(self):
+        self.store.clear()
+
+
+backend = InMemoryBackend()
+policies = load_policies()
+
+
+def configure(settings):
+    global ENABLED, TRUST_PROXY, PROXY_HOPS
+    ENABLED = settings.rate_limit_enabled
+    TRUST_PROXY = settings.rate_limit_trust_proxy
+    PROXY_HOPS = settings.rate_limit_proxy_hops
+    # updated in place so references held elsewhere stay valid
+    policies.clear()
+    policies.update(load_policies(settings))
+
+
+def set_backend(new_backend):
+    global backend
+    backend = new_backend
+
+
+def client_ip(request: Request) -> str:
+    if TRUST_PROXY:
+        # the client can write any entries itself; only the ones appended by our own proxies
+        # count, the address the outermost one saw is PROXY_HOPS from the right
+        forwarded = [entry.strip() for entry in request.headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+        if len(forwarded) >= PROXY_HOPS:
+            return forwarded[-PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+def check(scope: str, key: str):
+    if not ENABLED:
+        return
+    capacity, refill_rate = policies[scope]
+    allowed, retry_after = backend.consume(f"{scope}:{key}", capacity, refill_rate)
+    if not allowed:
+        metrics.inc("rate_limit_rejected_total", scope=scope)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, please slow down",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+def limit_by_ip(scope: str):
+    def dependency(request: Request):
+        check(scope, client_ip(request))
+    return dependency
+
+
+def limit_by_user(scope: str):
+    # get_current_user is cached per request by FastAPI, so the token is decoded only once
+    def dependency(current_user: models.User = Depends(get_current_user)):
+        check(scope, f"user:{current_user.id}")
+    return dependency
@@ -0,0 +1,118 @@
+# rating_queue.py
+import threading
+from datetime import datetime
+from sqlalchemy import bindparam, delete, func, select, update
+from sqlalchemy.orm import Session
+import catalog
+import database
+import metrics
+import models
+import partitioning
+from logger import get_logger
+
+# Write-behind mode for rating aggregates. The rating row is inserted synchronously (so the rater
+# reads their own write and the unique constraint still applies), while the hot movies row update
+# (average_rating, rating_count) is queued and applied by RatingWorker, coalesced per movie.
+# Every web worker runs a RatingWorker: each claims its batch with FOR UPDATE SKIP LOCKED, so no
+# two processes apply the same entries, and updates the movies in id order so they cannot deadlock.
+
+WRITE_BEHIND = False
+BATCH_SIZE = 1000
+POLL_INTERVAL = 0.5
+
+logger = get_logger(__name__)
+
+
+def configure(settings):
+    global WRITE_BEHIND, BATCH_SIZE, POLL_INTERVAL
+    WRITE_BEHIND = settings.rating_write_behind
+    BATCH_SIZE = settings.rating_queue_batch_size
+    POLL_INTERVAL = settings.rating_queue_poll_seconds
+
+
+def enqueue(db: Session, movie_id: int):
+    # Joins the caller's transaction: the queue entry commits together with the rating change
+    db.add(models.RatingAggregateQueue(movie_id=movie_id))
+
+
+def apply_pending(db: Session, batch_size: int = None):
+    """
+    Applies up to batch_size queued entries and returns the number of movies updated
+    """
+    batch_size = batch_size or BATCH_SIZE
+    entries = db.execute(
+        select(models.RatingAggregateQueue.id, models.RatingAggregateQueue.movie_id, models.RatingAggregateQueue.enqueued_at)
+        .order_by(models.RatingAggregateQueue.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not entries:
+        _report_lag(db)
+        return 0
+
+    movie_ids = sorted({entry.movie_id for entry in entries})
+    totals = partitioning.rating_totals(db, movie_ids)
+    params = []
+    for movie_id in movie_ids:
+        count, total = totals[movie_id]
+        params.append({
+            "b_id": movie_id,
+            "b_count": count,
+            "b_average": round(total / count, 2) if count else None,
+        })
+    database.primary_connection(db).execute(
+        update(models.Movie.__table__)
+        .where(models.Movie.__table__.c.id == bindparam("b_id"))
+        .values(rating_count=bindparam("b_count"), average_rating=bindparam("b_average")),
+        params,
+    )
+    for movie_id in movie_ids:
+        catalog.touch(db, movie_id)
+    db.execute(delete(models.RatingAggregateQueue).where(models.RatingAggregateQueue.id.in_([entry.id for entry in entries])))
+    db.commit()
+
+    metrics.inc("rating_queue_applied_total", len(entries))
+    metrics.inc("rating_queue_coalesced_total", len(entries) - len(movie_ids))
+    metrics.set_gauge("rating_queue_apply_lag_seconds", (datetime.utcnow() - entries[0].enqueued_at).total_seconds())
+    _report_lag(db)
+    return len(movie_ids)
+
+
+def _report_lag(db: Session):
+    depth, oldest = db.execute(
+        select(func.count(models.RatingAggregateQueue.id), func.min(models.RatingAggregateQueue.enqueued_at))
+    ).one()
+    metrics.set_gauge("rating_queue_depth", depth)
+    metrics.set_gauge("rating_queue_lag_seconds", (datetime.utcnow() - oldest).total_seconds() if oldest else 0)
+
+
+class RatingWorker(threading.Thread):
+    """
+    Background thread draining the queue; it only sleeps once the queue is empty
+    """
+
+    def __init__(self, session_factory, interval: float = None, batch_size: int = None):
+        super().__init__(name="rating-queue-worker", daemon=True)
+        self.session_factory = session_factory
+        self.interval = POLL_INTERVAL if interval is None else interval
+        self.batch_size = batch_size or BATCH_SIZE
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                db = self.session_factory()
+                try:
+                    updated = apply_pending(db, self.batch_size)
+                finally:
+                    db.close()
+            except Exception:
+                logger.exception("Applying queued rating aggregates failed")
+                updated = 0
+            if not updated:
+                self._stopped.wait(self.interval)
+
+    def stop(self, timeout: float = 5):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
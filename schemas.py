@@ -66,6 +66,9 @@ class Movie(MovieBase):
     created_at: datetime
     owner: Optional[UserResponse] 
     average_rating: Optional[float] 
+    comment_count: int = 0
+    reply_count: int = 0
+    rating_count: int = 0
 
     class Config:
         orm_mode = True
@@ -116,15 +119,39 @@ class CommentCreate(CommentBase):
 
 class ReplyCreate(BaseModel):
     reply: str
+    parent_id: Optional[int] = None
     
     
 class ReplyResponse(BaseModel):
     id: int
     reply: str
     user_id: int
+    comment_id: Optional[int]
+    parent_id: Optional[int] = None
+    depth: int = 0
+    movie_id: int
+    created_at: datetime
+
+
+class ReplyCreated(ReplyResponse):
+    # the replied comment is stored by reference (comment_id), its text is only resolved here
+    original_comment: Optional[str] = None
+
+
+class ReplyThread(BaseModel):
     comment_id: int
     original_comment: str
+    replies: List[ReplyResponse] = []
+
+
+class CommentEvent(BaseModel):
+    # pushed to /movies/{movie_id}/comments/ws and /movies/{movie_id}/comments/stream subscribers
+    type: str
+    id: int
     movie_id: int
+    user_id: int
+    comment_id: Optional[int] = None
+    text: str
     created_at: datetime
 
 
@@ -143,4 +170,55 @@ class MovieCommentResponse(BaseModel):
     comments: List[CommentResponse] = []
 
     model_config = ConfigDict(from_attributes=True)    
-    
\ No newline at end of file
+    
+
+# /analytics, computed from the columnar ratings snapshot (see analytics.py)
+
+class RatingBucket(BaseModel):
+    rating: float
+    count: int
+
+
+class RatingHistogram(BaseModel):
+    movie_id: int
+    count: int
+    average: Optional[float] = None
+    histogram: List[RatingBucket]
+    snapshot_at: datetime
+
+
+class GenreStats(BaseModel):
+    genre: str
+    movies: int
+    ratings: int
+    average_rating: Optional[float] = None
+
+
+class GenreStatsResponse(BaseModel):
+    genres: List[GenreStats]
+    snapshot_at: datetime
+
+
+class TimeBucket(BaseModel):
+    start: datetime
+    count: int
+
+
+class RatingTimeseries(BaseModel):
+    interval: str
+    movie_id: Optional[int] = None
+    buckets: List[TimeBucket]
+    snapshot_at: datetime
+
+
+class UserRatingStats(BaseModel):
+    user_id: int
+    count: int
+    average: Optional[float] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+    movies: int = 0
+    first_rated_at: Optional[datetime] = None
+    last_rated_at: Optional[datetime] = None
+    histogram: List[RatingBucket]
+    snapshot_at: datetime
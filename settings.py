@@ -0,0 +1,122 @@
+# settings.py
+import os
+from functools import lru_cache
+from typing import Optional
+from pydantic import BaseModel, ConfigDict
+
+# Every setting is read from the environment variable of the same name in upper case
+# (db_url -> DB_URL), after loading a .env file if there is one. PAPERTRAIL_HOST= (empty)
+# turns off remote logging.
+
+
+class Settings(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    # database
+    db_url: str
+    db_replica_urls: str = ""
+    db_replica_policy: str = "round_robin"
+    db_replica_health_seconds: float = 10
+    db_read_after_write_seconds: float = 5
+    db_pool_warmup: int = 1
+    # ratings, comments and replies sharded by movie_id: "name=url,name=url"; DB_SHARD_RING lists
+    # the shards movies are hashed to (all of them when empty)
+    db_shard_urls: str = ""
+    db_shard_ring: str = ""
+    db_shard_directory_seconds: float = 5
+    create_tables: bool = True
+
+    # authentication
+    secret_key: Optional[str] = None
+    algorithm: str = "HS256"
+    access_token_expire_minutes: int = 30
+
+    # logging
+    log_level: str = "INFO"
+    papertrail_host: Optional[str] = "logs3.papertrailapp.com"
+    papertrail_port: int = 18858
+
+    # rate limiting, policies are "capacity/period_in_seconds"
+    rate_limit_enabled: bool = True
+    rate_limit_trust_proxy: bool = False
+    # proxies in front of the app that each append to X-Forwarded-For
+    rate_limit_proxy_hops: int = 1
+    rate_limit_login: str = "30/60"
+    rate_limit_register: str = "10/60"
+    rate_limit_rate: str = "60/60"
+    rate_limit_comment: str = "30/60"
+
+    # write-behind rating aggregates
+    rating_write_behind: bool = False
+    rating_queue_batch_size: int = 1000
+    rating_queue_poll_seconds: float = 0.5
+
+    # live comment streams
+    pubsub_queue_size: int = 100
+
+    # memory-mapped movie catalog snapshot, disabled unless a path is given
+    catalog_path: Optional[str] = None
+    catalog_check_seconds: float = 0.5
+    catalog_build_seconds: float = 1
+
+    # on-demand profiler defaults, used when /admin/profiler/start is called without parameters
+    profiler_interval_ms: float = 10
+    profiler_slow_ms: float = 500
+
+    # ratings, comments and replies older than this many days are moved to monthly archive
+    # partitions by "python jobs.py archive"; unset keeps everything in the hot tables
+    retention_days: Optional[int] = None
+    archive_native_partitions: bool = True
+
+    # response compression; encodings in order of preference, br and zstd need the brotli and
+    # zstandard packages. The profile (fast/default/best) applies to routes that do not choose one
+    compression_enabled: bool = True
+    compression_min_size: int = 1024
+    compression_encodings: str = "zstd,br,gzip"
+    compression_profile: str = "default"
+    compression_cache_entries: int = 256
+    compression_cache_max_bytes: int = 32 * 1024 * 1024
+
+    # coalescing of concurrent identical hot reads; followers give up waiting after the timeout
+    singleflight_enabled: bool = True
+    singleflight_timeout_seconds: float = 5
+
+    # columnar ratings snapshot behind /analytics, disabled unless a path is given; rebuilt by
+    # "python jobs.py analytics-builder" every analytics_build_seconds
+    analytics_path: Optional[str] = None
+    analytics_check_seconds: float = 1
+    analytics_build_seconds: float = 300
+
+    @property
+    def replica_urls(self):
+        return [url.strip() for url in self.db_replica_urls.split(",") if url.strip()]
+
+    @property
+    def shard_urls(self):
+        urls = {}
+        for item in self.db_shard_urls.split(","):
+            name, _, url = item.partition("=")
+            if name.strip() and url.strip():
+                urls[name.strip()] = url.strip()
+        return urls
+
+    @property
+    def shard_ring(self):
+        return [name.strip() for name in self.db_shard_ring.split(",") if name.strip()] or None
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        values = {}
+        for name in cls.model_fields:
+            value = environ.get(name.upper())
+            if value is not None:
+                values[name] = value
+        return cls(**values)
+
+
+@lru_cache
+def get_settings() -> Settings:
+    from dotenv import load_dotenv
+    load_dotenv()
+    return Settings.from_env()
@@ -0,0 +1,111 @@
+# singleflight.py
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from fastapi.concurrency import run_in_threadpool
+import metrics
+
+# Request coalescing for hot reads. Concurrent callers asking for the same key while a
+# computation for it is in flight wait for that computation and share its result (or its
+# exception) instead of running the same queries again. Nothing is cached: once the leader
+# finishes, the next caller starts a new flight.
+#
+# Flights are concurrent.futures.Future objects, so sync handlers running in the threadpool and
+# async handlers on the event loop join the same flights. A follower waits at most `timeout`
+# seconds and then computes the result itself, so one stuck leader cannot hold every request.
+
+ENABLED = True
+TIMEOUT = 5.0
+
+
+def configure(settings):
+    global ENABLED, TIMEOUT
+    ENABLED = settings.singleflight_enabled
+    TIMEOUT = settings.singleflight_timeout_seconds
+
+
+class Group:
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        # returns (future, leader)
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._flights[key] = future
+            return future, True
+
+    def _finish(self, key, future: Future, result=None, error: BaseException = None):
+        with self._lock:
+            self._flights.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+    def do(self, key, fn, timeout: float = None):
+        """
+        Returns fn() for the first caller of key and that same result for the callers arriving
+        while it runs
+        """
+        if not ENABLED:
+            return fn()
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                result = future.result(TIMEOUT if timeout is None else timeout)
+            except FutureTimeout:
+                metrics.inc("singleflight_timeouts_total", group=self.name)
+                return fn()
+            metrics.inc("singleflight_shared_total", group=self.name)
+            return result
+        metrics.inc("singleflight_leaders_total", group=self.name)
+        try:
+            result = fn()
+        except BaseException as exc:
+            self._finish(key, future, error=exc)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, fn, timeout: float = None):
+        """
+        do() for async handlers; fn is a coroutine function or a plain function, which is run in
+        the threadpool
+        """
+        async def call():
+            return await fn() if asyncio.iscoroutinefunction(fn) else await run_in_threadpool(fn)
+
+        if not ENABLED:
+            return await call()
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), TIMEOUT if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                metrics.inc("singleflight_timeouts_total", group=self.name)
+                return await call()
+            metrics.inc("singleflight_shared_total", group=self.name)
+            return result
+        metrics.inc("singleflight_leaders_total", group=self.name)
+        try:
+            result = await call()
+        except BaseException as exc:
+            self._finish(key, future, error=exc)
+            raise
+        self._finish(key, future, result)
+        return result
+
+
+movies = Group("movies")
+comments = Group("comments")
@@ -1,10 +1,14 @@
+import os
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
+os.environ.setdefault("DB_URL", "sqlite:///./test.db")
+import main
 from main import app
 from database import Base, get_db
 import schemas, crud
+import metrics, ratelimit
 
 # Create a temporary test database
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -20,6 +24,8 @@ def override_get_db():
         db.close()
 
 app.dependency_overrides[get_db] = override_get_db
+# the client below does not run the lifespan
+main.configure(app.state.settings)
 
 client = TestClient(app)
 
@@ -29,6 +35,25 @@ def setup_db():
     yield
     Base.metadata.drop_all(bind=engine)
 
+@pytest.fixture
+def make_user():
+    # a user with throwaway profile fields, created in any session
+    def make(db, username):
+        return crud.create_user(db, schemas.UserCreate(username=username, full_name=username.capitalize(), email=f"{username}@example.com", password="x"), hashed_password="x")
+    return make
+
+@pytest.fixture
+def make_movie():
+    def make(db, owner, title, year_released, cast="Someone", **fields):
+        return crud.create_movie(db, schemas.MovieCreate(title=title, cast=cast, year_released=year_released, **fields), user_id=owner.id)
+    return make
+
+@pytest.fixture
+def secret_key(monkeypatch):
+    # tokens are signed with auth.SECRET_KEY, which the environment may not set
+    import auth
+    monkeypatch.setattr(auth, "SECRET_KEY", "test-secret")
+
 def test_root():
     response = client.get("/")
     assert response.status_code == 200
@@ -145,7 +170,769 @@ def test_ratings(test_movie, test_db: Session):
     return ratings
 
 
-    
-    
-    
-   
+def test_token_bucket_refills_over_time():
+    now = [0.0]
+    backend = ratelimit.InMemoryBackend(clock=lambda: now[0])
+    assert backend.consume("k", capacity=2, refill_rate=1) == (True, 0.0)
+    assert backend.consume("k", capacity=2, refill_rate=1)[0]
+    allowed, retry_after = backend.consume("k", capacity=2, refill_rate=1)
+    assert not allowed and retry_after == 1
+    now[0] = 1.0
+    assert backend.consume("k", capacity=2, refill_rate=1)[0]
+
+
+def test_shared_backend_is_shared_between_workers():
+    store = ratelimit.LocalStore()
+    worker_a, worker_b = ratelimit.SharedBackend(store), ratelimit.SharedBackend(store)
+    assert worker_a.consume("k", capacity=1, refill_rate=0.01)[0]
+    assert not worker_b.consume("k", capacity=1, refill_rate=0.01)[0]
+
+
+def test_login_rate_limited(monkeypatch):
+    monkeypatch.setitem(ratelimit.policies, "login", ratelimit.parse_policy("1/60"))
+    ratelimit.backend.reset()
+    client.post("/login", data={"username": "nobody", "password": "x"})
+    response = client.post("/login", data={"username": "nobody", "password": "x"})
+    ratelimit.backend.reset()
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert metrics.get("rate_limit_rejected_total", scope="login") >= 1
+    assert 'rate_limit_rejected_total{scope="login"}' in client.get("/metrics").text
+
+
+def test_client_ip_ignores_forwarded_entries_written_by_the_client(monkeypatch):
+    from starlette.requests import Request
+
+    def request(forwarded):
+        return Request({"type": "http", "headers": [(b"x-forwarded-for", forwarded.encode())], "client": ("10.0.0.1", 1234)})
+
+    assert ratelimit.client_ip(request("1.2.3.4, 203.0.113.9")) == "10.0.0.1"
+    monkeypatch.setattr(ratelimit, "TRUST_PROXY", True)
+    assert ratelimit.client_ip(request("1.2.3.4, 203.0.113.9")) == "203.0.113.9"
+    monkeypatch.setattr(ratelimit, "PROXY_HOPS", 2)
+    assert ratelimit.client_ip(request("1.2.3.4, 198.51.100.7, 203.0.113.9")) == "198.51.100.7"
+    assert ratelimit.client_ip(request("203.0.113.9")) == "10.0.0.1"
+
+
+def test_movie_counters_are_maintained_and_repaired(setup_db, make_user, make_movie):
+    db = TestingSessionLocal()
+    try:
+        owner = make_user(db, "counter")
+        movie = make_movie(db, owner, "Counted", 2020)
+        comment = crud.create_comment(db, schemas.CommentCreate(comment="Nice"), owner.id, movie.id)
+        reply = crud.create_reply(db, schemas.ReplyCreate(reply="Agreed"), comment.id, owner.id, movie.id)
+        rating = crud.create_rating(db, schemas.RatingCreate(rating=4), movie_id=movie.id, user_id=owner.id)
+        db.refresh(movie)
+        assert (movie.comment_count, movie.reply_count, movie.rating_count) == (1, 1, 1)
+
+        crud.delete_reply(db, reply.id)
+        crud.delete_rating(db, rating.id)
+        db.refresh(movie)
+        assert (movie.comment_count, movie.reply_count, movie.rating_count) == (1, 0, 0)
+
+        movie.comment_count = 7
+        db.commit()
+        assert crud.repair_movie_counters(db) == 1
+        db.refresh(movie)
+        assert movie.comment_count == 1
+        assert client.get(f"/movies/{movie.id}").json()["comment_count"] == 1
+    finally:
+        db.close()
+
+
+def test_repair_counters_upgrades_an_older_movies_table(tmp_path, monkeypatch, make_user, make_movie):
+    from sqlalchemy import inspect, text
+    import argparse, database, jobs
+    old = create_engine(f"sqlite:///{tmp_path}/old.db")
+    Base.metadata.create_all(bind=old)
+    db = sessionmaker(bind=old)()
+    try:
+        owner = make_user(db, "veteran")
+        movie = make_movie(db, owner, "Veteran", 1980)
+        crud.create_comment(db, schemas.CommentCreate(comment="still here"), owner.id, movie.id)
+        movie_id = movie.id
+    finally:
+        db.close()
+    with old.begin() as connection:
+        for name in ("comment_count", "reply_count", "rating_count"):
+            connection.execute(text(f"ALTER TABLE movies DROP COLUMN {name}"))
+        connection.execute(text("DROP TABLE movie_archive_stats"))
+
+    monkeypatch.setattr(database, "engine", old)
+    monkeypatch.setattr(jobs, "SessionLocal", sessionmaker(bind=old))
+    jobs.repair_counters(argparse.Namespace())
+    jobs.repair_counters(argparse.Namespace())
+    assert {"comment_count", "reply_count", "rating_count"} <= {column["name"] for column in inspect(old).get_columns("movies")}
+    with old.connect() as connection:
+        assert connection.execute(text("SELECT comment_count, reply_count, rating_count FROM movies WHERE id = :id"),
+                                  {"id": movie_id}).one() == (1, 0, 0)
+    old.dispose()
+
+
+def test_write_behind_ratings_are_coalesced(setup_db, monkeypatch, make_user, make_movie):
+    import rating_queue
+    monkeypatch.setattr(rating_queue, "WRITE_BEHIND", True)
+    db = TestingSessionLocal()
+    try:
+        owner = make_user(db, "voter1")
+        voter = make_user(db, "voter2")
+        movie = make_movie(db, owner, "Premiere", 2024)
+        crud.create_rating(db, schemas.RatingCreate(rating=4), movie_id=movie.id, user_id=owner.id)
+        crud.create_rating(db, schemas.RatingCreate(rating=3), movie_id=movie.id, user_id=voter.id)
+
+        # the raters see their own ratings straight away, the aggregate follows
+        assert len(crud.get_ratings_for_movie(db, movie.id)) == 2
+        db.refresh(movie)
+        assert movie.average_rating is None
+        # not deletable even though its rating_count is still 0
+        assert crud.movie_has_dependents(db, movie.id)
+
+        assert rating_queue.apply_pending(db) == 1
+        db.refresh(movie)
+        assert (movie.average_rating, movie.rating_count) == (3.5, 2)
+        assert metrics.get("rating_queue_depth") == 0
+    finally:
+        db.close()
+
+
+def test_comment_stream_pushes_new_comments(setup_db, secret_key, make_user, make_movie):
+    import auth
+    db = TestingSessionLocal()
+    try:
+        owner = make_user(db, "streamer")
+        movie = make_movie(db, owner, "Live", 2024)
+        movie_id = movie.id
+    finally:
+        db.close()
+    token = auth.create_access_token(data={"sub": "streamer"})
+
+    with client.websocket_connect(f"/movies/{movie_id}/comments/ws") as websocket:
+        response = client.post(f"/movies/{movie_id}/comments/", json={"comment": "First!"}, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 201
+        event = websocket.receive_json()
+    assert event["type"] == "comment"
+    assert event["text"] == "First!"
+    assert event["id"] == response.json()["id"]
+
+    # a stream dropped before its body starts leaves no subscription behind
+    import asyncio, pubsub
+    response = asyncio.run(main.stream_comments_sse(movie_id, TestingSessionLocal()))
+    assert response.media_type == "text/event-stream"
+    del response
+    assert pubsub.hub.subscriber_count(pubsub.movie_topic(movie_id)) == 0
+
+
+def test_slow_subscriber_overflows_instead_of_blocking():
+    import asyncio, pubsub
+
+    async def scenario():
+        hub = pubsub.Hub()
+        with hub.subscribe("topic", maxsize=2) as subscription:
+            for i in range(5):
+                hub.deliver("topic", str(i))
+            await asyncio.sleep(0)
+            assert await subscription.get() is pubsub.OVERFLOW
+        assert hub.subscriber_count("topic") == 0
+
+    asyncio.run(scenario())
+
+
+def test_read_only_sessions_are_routed_to_healthy_replicas(tmp_path, monkeypatch):
+    import database
+    primary = create_engine(f"sqlite:///{tmp_path}/primary.db")
+    replica_a = create_engine(f"sqlite:///{tmp_path}/replica_a.db")
+    replica_b = create_engine(f"sqlite:///{tmp_path}/replica_b.db")
+    replica_set = database.ReplicaSet([replica_a, replica_b])
+    monkeypatch.setattr(database, "replicas", replica_set)
+
+    assert [replica_set.choose() for _ in range(3)] == [replica_a, replica_b, replica_a]
+    replica_set.mark_down(replica_a)
+    assert replica_set.choose() is replica_b
+    replica_set.check()
+    assert replica_set.healthy == [replica_a, replica_b]
+
+    session = database.RoutingSession(bind=primary)
+    assert session.get_bind() is primary
+    session.info["read_only"] = True
+    replica = session.get_bind()
+    assert replica in (replica_a, replica_b)
+    assert session.get_bind() is replica
+    session.info["wrote"] = True
+    assert session.get_bind() is primary
+
+
+def test_recent_writers_read_from_primary(setup_db, monkeypatch):
+    import time
+    import database
+    monkeypatch.setattr(database, "READ_AFTER_WRITE_SECONDS", 60)
+    assert not database.wrote_recently("Bearer fresh-writer")
+    database.record_write("Bearer fresh-writer")
+    assert database.wrote_recently("Bearer fresh-writer")
+    assert "Bearer fresh-writer" not in database._recent_writes
+
+    # any worker honours the signed last-write time sent back by the client
+    monkeypatch.delitem(app.dependency_overrides, get_db)
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(bind=engine, class_=database.RoutingSession))
+    response = client.post("/Registration", json={"username": "sticky", "full_name": "S", "email": "sticky@example.com", "password": "x"})
+    token = response.headers["x-last-write"]
+    assert response.cookies[database.LAST_WRITE_COOKIE] == token
+    database._recent_writes.clear()
+    assert database.wrote_recently("another-worker", token)
+    assert not database.wrote_recently("another-worker", token.replace(".", "1.", 1))
+    assert not database.wrote_recently("another-worker", database.last_write_token(time.time() - 120))
+
+
+# cold start budget for the application's own modules on top of fastapi, sqlalchemy and pydantic
+IMPORT_BUDGET_SECONDS = 1.0
+
+
+def test_import_is_fast_and_side_effect_free(tmp_path):
+    import subprocess, sys, os
+    code = (
+        "import socket, time\n"
+        "def deny(*args, **kwargs): raise AssertionError('network used at import')\n"
+        "socket.getaddrinfo = deny\n"
+        "import fastapi, fastapi.security, sqlalchemy.orm, sqlalchemy.ext.horizontal_shard, pydantic, jose.jwt, passlib.context\n"
+        "start = time.perf_counter()\n"
+        "import main, sys\n"
+        "print(time.perf_counter() - start)\n"
+        "assert 'numpy' not in sys.modules, 'numpy imported while the snapshots are disabled'\n"
+    )
+    env = dict(os.environ, DB_URL=f"sqlite:///{tmp_path}/cold.db")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env, cwd=os.path.dirname(__file__))
+    assert result.returncode == 0, result.stderr
+    assert float(result.stdout.strip()) < IMPORT_BUDGET_SECONDS
+    assert not (tmp_path / "cold.db").exists()
+
+
+def test_lifespan_creates_tables_and_disposes_pool(tmp_path):
+    import database
+    from settings import Settings
+    settings = Settings(db_url=f"sqlite:///{tmp_path}/lifespan.db", papertrail_host=None, secret_key="lifespan")
+    configured = (main.active_settings, database.engine)
+    lifespan_app = main.create_app(settings)
+    # building an app leaves the running configuration alone
+    assert (main.active_settings, database.engine) == configured
+    with TestClient(lifespan_app) as lifespan_client:
+        assert lifespan_client.get("/movies/").json() == []
+        lifespan_engine = database.engine
+        assert str(lifespan_engine.url).endswith("lifespan.db")
+    assert lifespan_engine.pool.checkedout() == 0
+    # stopping hands the previous settings back
+    assert main.active_settings is configured[0]
+    assert str(database.engine.url) == configured[0].db_url
+
+
+def test_catalog_snapshot_serves_movies_and_rebuilds_incrementally(setup_db, tmp_path, monkeypatch, make_user, make_movie):
+    import catalog, models
+    path = str(tmp_path / "catalog.bin")
+    monkeypatch.setattr(catalog, "PATH", path)
+    monkeypatch.setattr(catalog, "reader", catalog.CatalogReader(path, check_interval=0))
+    db = TestingSessionLocal()
+    try:
+        owner = make_user(db, "cataloguer")
+        movie = make_movie(db, owner, "Snapshotted", 2001, cast="Ünïcode cast")
+        assert catalog.build(db, path, incremental=False) >= 1
+
+        cached = catalog.reader.get(movie.id)
+        assert cached["title"] == "Snapshotted"
+        assert cached["cast"] == "Ünïcode cast"
+        assert cached["owner"]["username"] == "cataloguer"
+        assert cached["created_at"] == movie.created_at
+        assert cached["description"] is None and cached["average_rating"] is None
+        assert client.get(f"/movies/{movie.id}").json()["title"] == "Snapshotted"
+
+        crud.update_movie(db, movie.id, schemas.MovieUpdate(title="Renamed", cast="Someone", year_released=2001))
+        # this worker wrote the movie after the snapshot was built, so it reads from the DB
+        assert catalog.reader.get(movie.id) is None
+        assert client.get(f"/movies/{movie.id}").json()["title"] == "Renamed"
+
+        catalog.build(db, path)
+        assert catalog.reader.get(movie.id)["title"] == "Renamed"
+        assert catalog.build(db, path) is None
+
+        # the dirty ids of a failed build are rebuilt by the next one
+        crud.update_movie(db, movie.id, schemas.MovieUpdate(title="Retried", cast="Someone", year_released=2001))
+        with monkeypatch.context() as failing:
+            failing.setattr(catalog, "_load_movies", lambda *args: 1 / 0)
+            with pytest.raises(ZeroDivisionError):
+                catalog.build(db, path)
+        other = make_movie(db, owner, "Other", 2002)
+        catalog.build(db, path)
+        assert catalog.reader.get(movie.id)["title"] == "Retried"
+        assert catalog.reader.get(other.id)["title"] == "Other"
+        assert catalog.Snapshot(path).count == db.query(models.Movie).count()
+    finally:
+        db.close()
+
+
+def test_threaded_replies_and_subtree_pages(setup_db, secret_key, make_user, make_movie):
+    import auth
+    db = TestingSessionLocal()
+    try:
+        owner = make_user(db, "threader")
+        movie = make_movie(db, owner, "Threads", 2010)
+        comment = crud.create_comment(db, schemas.CommentCreate(comment="A long original comment"), owner.id, movie.id)
+        comment_id = comment.id
+    finally:
+        db.close()
+    headers = {"Authorization": f"Bearer {auth.create_access_token(data={'sub': 'threader'})}"}
+
+    first = client.post(f"/{comment_id}/replies", json={"reply": "first"}, headers=headers).json()
+    assert first["original_comment"] == "A long original comment"
+    assert first["depth"] == 0 and first["parent_id"] is None
+    child = client.post(f"/{comment_id}/replies", json={"reply": "child", "parent_id": first["id"]}, headers=headers).json()
+    grandchild = client.post(f"/{comment_id}/replies", json={"reply": "grandchild", "parent_id": child["id"]}, headers=headers).json()
+    second = client.post(f"/{comment_id}/replies", json={"reply": "second"}, headers=headers).json()
+    assert grandchild["depth"] == 2
+
+    thread = client.get(f"/comments/{comment_id}/replies").json()
+    assert thread["original_comment"] == "A long original comment"
+    assert [reply["reply"] for reply in thread["replies"]] == ["first", "child", "grandchild", "second"]
+    assert "original_comment" not in thread["replies"][0]
+
+    subtree = client.get(f"/comments/{comment_id}/replies", params={"parent_id": first["id"], "max_depth": 1}).json()
+    assert [reply["id"] for reply in subtree["replies"]] == [child["id"]]
+    top_level = client.get(f"/comments/{comment_id}/replies", params={"max_depth": 1, "limit": 1, "skip": 1}).json()
+    assert [reply["id"] for reply in top_level["replies"]] == [second["id"]]
+
+    other = client.post(f"/{comment_id}/replies", json={"reply": "bad", "parent_id": 10**6}, headers=headers)
+    assert other.status_code == 404
+
+    assert client.get(f"/comments/{comment_id}/replies", params={"limit": -1}).status_code == 422
+
+
+def test_upgrade_replies_backfills_paths(tmp_path):
+    import jobs
+    from sqlalchemy import inspect, text
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE replies (id INTEGER PRIMARY KEY, reply VARCHAR NOT NULL, user_id INTEGER, comment_id INTEGER, "
+            "original_comment VARCHAR NOT NULL, movie_id INTEGER NOT NULL, created_at DATETIME)"))
+        connection.execute(text("INSERT INTO replies (id, reply, comment_id, original_comment, movie_id) VALUES "
+                                "(1, 'a', 1, 'c', 1), (2, 'b', 1, 'c', 1), (3, 'c', NULL, 'c', 1)"))
+
+    assert jobs.upgrade_replies(engine, batch_size=2) == 3
+    assert jobs.upgrade_replies(engine) == 0
+    columns = {column["name"] for column in inspect(engine).get_columns("replies")}
+    assert {"parent_id", "path", "depth"} <= columns and "original_comment" not in columns
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT id, path, depth, parent_id FROM replies ORDER BY id")).all()
+        connection.execute(text("INSERT INTO replies (reply, movie_id, path) VALUES ('new', 1, 'x.')"))
+    assert [tuple(row) for row in rows] == [(1, "0000000001.", 0, None), (2, "0000000002.", 0, None), (3, "0000000003.", 0, None)]
+    engine.dispose()
+
+
+def test_profiler_is_admin_only_and_captures_slow_requests(setup_db, secret_key, monkeypatch, make_user):
+    import auth
+    from profiler import profiler
+    db = TestingSessionLocal()
+    try:
+        make_user(db, "admin")
+    finally:
+        db.close()
+    headers = {"Authorization": f"Bearer {auth.create_access_token(data={'sub': 'admin'})}"}
+    assert client.post("/admin/profiler/start", headers=headers).status_code == 403
+
+    # only the admin job grants access
+    import argparse, jobs
+    monkeypatch.setattr(jobs, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(jobs.database, "engine", engine)
+    jobs.set_admin(argparse.Namespace(username="admin", revoke=False))
+    try:
+        assert client.post("/admin/profiler/start", params={"interval_ms": 1, "slow_ms": 0}, headers=headers).json()["enabled"]
+        assert client.get("/movies/").status_code == 200
+        profiler.sample()
+    finally:
+        client.post("/admin/profiler/stop", headers=headers)
+
+    captures = client.get("/admin/profiler/slow", headers=headers).json()
+    listing = [capture for capture in captures if capture["path"] == "/movies/"][-1]
+    assert listing["status"] == 200
+    assert any("FROM movies" in query["statement"] for query in listing["sql"])
+    flamegraph = client.get("/admin/profiler/flamegraph", headers=headers)
+    assert flamegraph.headers["content-disposition"].startswith("attachment")
+    assert flamegraph.text.strip()
+    client.delete("/admin/profiler", headers=headers)
+    assert client.get("/admin/profiler/slow", headers=headers).json() == []
+
+    # samples belong to a request only while one of its statements runs on the sampled thread
+    from sqlalchemy import event, text
+    probe_engine = create_engine("sqlite://")
+
+    @event.listens_for(probe_engine, "connect")
+    def register_probe(dbapi_connection, record):
+        dbapi_connection.create_function("probe", 0, lambda: profiler.sample() or 1)
+
+    profiler.start(interval_ms=60_000)
+    try:
+        outside, token = profiler.begin("GET", "/outside")
+        profiler.sample()
+        profiler.end(outside, token)
+        inside, token = profiler.begin("GET", "/inside")
+        with probe_engine.connect() as connection:
+            connection.execute(text("SELECT probe()"))
+        profiler.end(inside, token)
+    finally:
+        profiler.stop()
+        profiler.reset()
+        probe_engine.dispose()
+    assert not outside.samples
+    assert any("test_main.py:<lambda>" in stack for stack in inside.samples)
+
+
+def test_cold_months_are_archived_with_counters_intact(tmp_path, make_user, make_movie):
+    import json
+    from datetime import datetime
+    import fieldsets, models, partitioning
+    archive_engine = create_engine(f"sqlite:///{tmp_path}/archive.db")
+    Base.metadata.create_all(bind=archive_engine)
+    db = sessionmaker(bind=archive_engine)()
+    try:
+        users = [make_user(db, f"rater{i}") for i in range(3)]
+        movie = make_movie(db, users[0], "Old", 1990)
+        for user, value, day in zip(users, [2, 4, 5], [datetime(2020, 1, 10), datetime(2020, 2, 10), datetime(2030, 1, 1)]):
+            rating = crud.create_rating(db, schemas.RatingCreate(rating=value), movie.id, user.id)
+            rating.created_at = day
+        comment = crud.create_comment(db, schemas.CommentCreate(comment="old comment"), users[0].id, movie.id)
+        comment.created_at = datetime(2020, 1, 5)
+        db.commit()
+        comment_id = comment.id
+        crud.create_reply(db, schemas.ReplyCreate(reply="late answer"), comment.id, users[1].id, movie.id)
+        # a reply whose comment was deleted, older than every rating and comment
+        orphan = crud.create_reply(db, schemas.ReplyCreate(reply="orphan"), comment.id, users[2].id, movie.id)
+        orphan.comment_id, orphan.created_at = None, datetime(2019, 12, 3)
+        db.commit()
+
+        archived = partitioning.archive_before(db, datetime(2021, 1, 1))
+        assert archived == {"ratings": 2, "comments": 3}
+        assert [p.name for p in partitioning.partitions(db, "ratings")] == ["ratings_archive_2020_01", "ratings_archive_2020_02"]
+        assert db.query(models.Rating).count() == 1 and db.query(models.Comment).count() == 0 and db.query(models.Reply).count() == 0
+
+        # pruned: only the January partition overlaps the range
+        assert len(partitioning.partitions(db, "ratings", since=datetime(2020, 1, 1), until=datetime(2020, 2, 1))) == 1
+        january = crud.get_ratings_for_movie(db, movie.id, since=datetime(2020, 1, 1), until=datetime(2020, 2, 1), include_archive=True)
+        assert [r["rating"] for r in january] == [2]
+        assert len(crud.get_ratings_for_movie(db, movie.id, include_archive=True)) == 3
+        assert len(crud.get_ratings_for_movie(db, movie.id)) == 1
+
+        db.refresh(movie)
+        assert (movie.rating_count, movie.comment_count, movie.reply_count) == (3, 1, 2)
+        assert crud.repair_movie_counters(db) == 0
+        crud.update_movie_average_rating(db, movie.id)
+        assert movie.average_rating == round(11 / 3, 2)
+        with pytest.raises(Exception) as rerate:
+            crud.create_rating(db, schemas.RatingCreate(rating=1), movie.id, users[0].id)
+        assert rerate.value.status_code == 409
+
+        # archived comments are listed on request, with the replies archived along with them
+        assert crud.get_comment_by_id(db, comment_id) is None
+        assert crud.get_comment_by_id(db, comment_id, include_archive=True).comment == "old comment"
+        archived_comments = crud.get_archived_comments(db, movie)
+        assert [c["comment"] for c in archived_comments] == ["old comment"]
+        page = json.loads(fieldsets.serialize(schemas.CommentResponse, None, archived_comments, envelope="comments"))
+        assert [r["reply"] for r in page["comments"][0]["replies"]] == ["late answer"]
+        assert page["comments"][0]["user"]["username"] == "rater0"
+        assert crud.get_archived_comments(db, movie, since=datetime(2020, 2, 1)) == []
+        thread = crud.get_reply_thread(db, comment_id, archived_movie_id=movie.id)
+        assert [r["reply"] for r in thread] == ["late answer"]
+
+        # the owner can still delete an archived rating, and rate again
+        february = crud.get_ratings_for_movie(db, movie.id, since=datetime(2020, 2, 1), until=datetime(2020, 3, 1), include_archive=True)[0]
+        assert crud.get_rating_by_id(db, february["id"]).user_id == users[1].id
+        crud.delete_rating(db, february["id"])
+        db.refresh(movie)
+        assert movie.rating_count == 2 and movie.average_rating == 3.5
+        assert crud.get_rating_by_id(db, february["id"]) is None
+        assert crud.repair_movie_counters(db) == 0
+        assert len(crud.get_ratings_for_movie(db, movie.id, include_archive=True)) == 2
+        crud.create_rating(db, schemas.RatingCreate(rating=1), movie.id, users[1].id)
+    finally:
+        db.close()
+        archive_engine.dispose()
+
+
+def test_responses_are_negotiated_compressed_and_cached(setup_db, monkeypatch):
+    import gzip
+    import compression
+    assert compression.negotiate("gzip;q=0.5, identity") == "gzip"
+    assert compression.negotiate("gzip;q=0, identity") is None
+    assert compression.negotiate("*") == compression.PREFERENCE[0]
+    monkeypatch.setattr(compression, "MIN_SIZE", 10)
+    compression.cache.clear()
+    metrics.reset()
+
+    plain = client.get("/movies/", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    first = client.get("/movies/", headers={"Accept-Encoding": "gzip"})
+    second = client.get("/movies/", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["content-encoding"] == "gzip" and "Accept-Encoding" in first.headers["vary"]
+    assert first.json() == second.json() == plain.json()
+    assert metrics.get("compression_cache_misses_total") == 1
+    assert metrics.get("compression_cache_hits_total") == 1
+    assert metrics.get("http_response_bytes_total", encoding="gzip") == 2 * int(first.headers["content-length"])
+
+    encoder = compression.ENCODERS["gzip"](6)
+    chunks = [encoder.compress(b"data: one\n\n") + encoder.flush(), encoder.compress(b"data: two\n\n") + encoder.finish()]
+    # every flushed chunk is decodable on its own, so streamed events are not held back
+    assert gzip.decompress(b"".join(chunks)) == b"data: one\n\ndata: two\n\n"
+
+    # large bodies are compressed off the event loop
+    monkeypatch.setattr(compression, "THREADPOOL_MIN_SIZE", 10)
+    compression.cache.clear()
+    offloaded = client.get("/movies/", headers={"Accept-Encoding": "gzip"})
+    assert offloaded.headers["content-encoding"] == "gzip" and offloaded.json() == plain.json()
+
+
+def test_sparse_fieldsets_prune_columns_and_output(setup_db, make_user, make_movie):
+    from sqlalchemy import event
+    import fieldsets
+    db = TestingSessionLocal()
+    try:
+        owner = make_user(db, "sparse")
+        movie = make_movie(db, owner, "Sparse", 2001, description="long " * 100)
+        crud.create_comment(db, schemas.CommentCreate(comment="short"), owner.id, movie.id)
+        movie_id, owner_id = movie.id, owner.id
+    finally:
+        db.close()
+
+    statements = []
+    capture = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        movies = client.get("/movies/", params={"fields": "id,title,year_released", "limit": 100}).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    assert {"id": movie_id, "title": "Sparse", "year_released": 2001} in movies
+    assert all(set(item) == {"id", "title", "year_released"} for item in movies)
+    assert not any("description" in statement or "users" in statement for statement in statements)
+
+    one = client.get(f"/movies/{movie_id}", params={"fields": "title,owner"}).json()
+    assert one == {"title": "Sparse", "owner": {"id": owner_id, "username": "sparse", "full_name": "Sparse", "email": "sparse@example.com"}}
+    comments = client.get(f"/movies/{movie_id}/comments/", params={"fields": "id,comment"}).json()
+    assert [set(comment) for comment in comments["comments"]] == [{"id", "comment"}]
+    assert client.get("/movies/", params={"fields": "id,secret"}).status_code == 400
+    assert fieldsets.model_for(schemas.Movie, frozenset({"id"})) is fieldsets.model_for(schemas.Movie, frozenset({"id"}))
+
+
+def test_single_flight_coalesces_sync_and_async_callers():
+    import asyncio
+    import threading
+    import singleflight
+    metrics.reset()
+    started, release = threading.Event(), threading.Event()
+    # the 5 followers and this thread meet once every follower has joined the flight
+    followers = threading.Barrier(6)
+    calls = []
+
+    class Group(singleflight.Group):
+        def _join(self, key):
+            future, leader = super()._join(key)
+            if not leader:
+                followers.wait(5)
+            return future, leader
+
+    group = Group("test")
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return b"shared"
+
+    async def join_async():
+        return await group.do_async("key", load)
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(group.do("key", load)))
+    leader.start()
+    assert started.wait(5)
+    threads = [threading.Thread(target=lambda: results.append(group.do("key", load))) for _ in range(4)]
+    threads.append(threading.Thread(target=lambda: results.append(asyncio.run(join_async()))))
+    for thread in threads:
+        thread.start()
+    followers.wait(5)
+    release.set()
+    for thread in [leader, *threads]:
+        thread.join(5)
+    assert results == [b"shared"] * 6
+    assert len(calls) == 1
+    assert metrics.get("singleflight_shared_total", group="test") == 5
+
+    # a follower stops waiting for a stuck leader and computes the value itself
+    group = singleflight.Group("test")
+    entered, stuck = threading.Event(), threading.Event()
+    leader = threading.Thread(target=lambda: group.do("slow", lambda: (entered.set(), stuck.wait(5))))
+    leader.start()
+    assert entered.wait(5)
+    assert group.do("slow", lambda: "own", timeout=0.05) == "own"
+    assert metrics.get("singleflight_timeouts_total", group="test") == 1
+    stuck.set()
+    leader.join(5)
+    assert group.in_flight() == 0
+
+
+def test_ratings_and_comments_are_sharded_by_movie(tmp_path, monkeypatch, make_user, make_movie):
+    from datetime import datetime
+    from sqlalchemy import text
+    import database, jobs, partitioning, rating_queue
+    primary = create_engine(f"sqlite:///{tmp_path}/primary.db")
+    shard_engines = {name: create_engine(f"sqlite:///{tmp_path}/shard_{name}.db") for name in ("a", "b", "c")}
+    monkeypatch.setattr(database, "engine", primary)
+    monkeypatch.setattr(database, "shards", database.ShardMap(shard_engines, ["a", "b"], directory_seconds=0))
+    # several id blocks per table
+    monkeypatch.setattr(database, "ID_BLOCK_SIZE", 5)
+    database.create_tables()
+
+    def rows_on(name, table, movie_id):
+        with shard_engines[name].connect() as connection:
+            return connection.execute(text(f"SELECT count(*) FROM {table} WHERE movie_id = :m"), {"m": movie_id}).scalar()
+
+    db = database.ShardedRoutingSession()
+    try:
+        user = make_user(db, "sharded")
+        movie_ids, rating_ids = [], []
+        for i in range(16):
+            movie = make_movie(db, user, f"Sharded {i}", 2000 + i)
+            rating_ids.append(crud.create_rating(db, schemas.RatingCreate(rating=4), movie.id, user.id).id)
+            comment = crud.create_comment(db, schemas.CommentCreate(comment=f"comment {i}"), user.id, movie.id)
+            crud.create_reply(db, schemas.ReplyCreate(reply="reply"), comment.id, user.id, movie.id)
+            movie_ids.append(movie.id)
+        assert len(set(rating_ids)) == 16
+        user_id = user.id
+        ring = database.HashRing(["a", "b"])
+        for movie_id in movie_ids:
+            assert rows_on(ring.get(movie_id), "ratings", movie_id) == 1
+            assert rows_on(ring.get(movie_id), "replies", movie_id) == 1
+        assert {ring.get(movie_id) for movie_id in movie_ids} == {"a", "b"}
+
+        db.expunge_all()
+        metrics.reset()
+        assert [r.rating for r in crud.get_ratings_for_movie(db, movie_ids[0])] == [4]
+        comments = crud.get_comments(db, movie_ids[1]).comments
+        assert [c.comment for c in comments] == ["comment 1"] and len(comments[0].replies) == 1
+        # per-movie reads go to one shard, lookups by id ask every shard
+        assert not metrics.get("db_shard_scatter_queries_total")
+        assert crud.get_rating_by_id(db, rating_ids[3]).movie_id == movie_ids[3]
+        assert metrics.get("db_shard_scatter_queries_total") == 1
+        assert crud.get_movie_by_id(db, movie_ids[1]).average_rating == 4
+        assert crud.repair_movie_counters(db) == 0
+
+        new_ring = database.HashRing(["a", "b", "c"])
+        moving = next(i for i, m in enumerate(movie_ids) if ring.get(m) != new_ring.get(m))
+        phases = []
+
+        def during_move(seconds):
+            # called while every worker sees the movies as moving, then once they are pinned to their new shard
+            writer = database.ShardedRoutingSession()
+            try:
+                if not phases:
+                    with pytest.raises(database.MovieMovingError):
+                        crud.delete_rating(writer, rating_ids[moving])
+                else:
+                    crud.delete_rating(writer, rating_ids[moving])
+            finally:
+                writer.close()
+            phases.append(seconds)
+
+        monkeypatch.setattr(jobs.time, "sleep", during_move)
+        moved = jobs.reshard_movies(["a", "b", "c"])
+        assert len(phases) == 2
+        assert moved == sum(ring.get(m) != new_ring.get(m) for m in movie_ids) > 0
+        # the rating deleted on the new shard did not come back from the old one
+        assert sum(rows_on(name, "ratings", movie_ids[moving]) for name in shard_engines) == 0
+        for movie_id in movie_ids:
+            assert database.shards.shard_for(movie_id) == new_ring.get(movie_id)
+            assert sum(rows_on(name, "comments", movie_id) for name in shard_engines) == 1
+            assert rows_on(new_ring.get(movie_id), "comments", movie_id) == 1
+        db.expunge_all()
+        assert crud.repair_movie_counters(db) == 0
+        assert len(crud.get_ratings_for_movie(db, movie_ids[-1])) == 1
+        assert crud.create_rating(db, schemas.RatingCreate(rating=2), movie_ids[moving], user_id).id not in rating_ids
+
+        # statements on unsharded tables go to the primary
+        assert crud.get_rating_by_id(db, 12345) is None
+        with pytest.raises(Exception) as missing:
+            crud.delete_rating(db, 12345)
+        assert missing.value.status_code == 404
+        voter = make_user(db, "late voter")
+        monkeypatch.setattr(rating_queue, "WRITE_BEHIND", True)
+        late = crud.create_rating(db, schemas.RatingCreate(rating=1), movie_ids[0], voter.id)
+        late.created_at = datetime(2020, 1, 5)
+        db.commit()
+        late_id, voter_id = late.id, voter.id
+        assert rating_queue.apply_pending(db) == 1
+        assert crud.get_movie_by_id(db, movie_ids[0]).rating_count == 2
+        monkeypatch.setattr(rating_queue, "WRITE_BEHIND", False)
+        assert partitioning.archive_before(db, datetime(2021, 1, 1))["ratings"] == 1
+        assert crud.get_rating_by_id(db, late_id).user_id == voter_id
+        crud.delete_rating(db, late_id)
+        assert crud.get_rating_by_id(db, late_id) is None
+        assert crud.repair_movie_counters(db) == 0
+    finally:
+        db.close()
+        for shard in shard_engines.values():
+            shard.dispose()
+        primary.dispose()
+
+
+def test_analytics_are_computed_from_the_ratings_snapshot(tmp_path, monkeypatch, make_user, make_movie):
+    from datetime import datetime
+    import analytics, partitioning
+    analytics_engine = create_engine(f"sqlite:///{tmp_path}/analytics.db")
+    Base.metadata.create_all(bind=analytics_engine)
+    db = sessionmaker(bind=analytics_engine)()
+    path = str(tmp_path / "analytics")
+    monkeypatch.setattr(analytics, "reader", analytics.AnalyticsReader(path, check_interval=0))
+    try:
+        assert client.get("/analytics/genres").status_code == 503
+        users = [make_user(db, f"analyst{i}") for i in range(3)]
+        drama = make_movie(db, users[0], "Drama", 1990, genres="Drama, Crime")
+        comedy = make_movie(db, users[0], "Comedy", 1991, genres="Comedy")
+        ratings = [(drama, users[0], 4.5, datetime(2020, 1, 6)), (drama, users[1], 3, datetime(2020, 1, 7)),
+                   (drama, users[2], 4.5, datetime(2020, 3, 2)), (comedy, users[0], 1, datetime(2030, 1, 15))]
+        for movie, user, value, day in ratings:
+            rating = crud.create_rating(db, schemas.RatingCreate(rating=value), movie.id, user.id)
+            rating.created_at = day
+        db.commit()
+        drama_id, comedy_id, user_id = drama.id, comedy.id, users[0].id
+        # the snapshot covers archived ratings too
+        assert partitioning.archive_before(db, datetime(2021, 1, 1))["ratings"] == 3
+        assert analytics.build(db, path) == 4
+
+        histogram = client.get(f"/analytics/movies/{drama_id}/histogram").json()
+        assert (histogram["count"], histogram["average"]) == (3, 4.0)
+        assert {bucket["rating"]: bucket["count"] for bucket in histogram["histogram"] if bucket["count"]} == {3.0: 1, 4.5: 2}
+        assert client.get("/analytics/movies/999/histogram").json()["count"] == 0
+
+        genres = {genre["genre"]: genre for genre in client.get("/analytics/genres").json()["genres"]}
+        assert (genres["Crime"]["ratings"], genres["Crime"]["average_rating"]) == (3, 4.0)
+        assert (genres["Comedy"]["movies"], genres["Comedy"]["average_rating"]) == (1, 1.0)
+
+        weekly = client.get("/analytics/timeseries", params={"interval": "week", "until": "2020-03-09T00:00:00"}).json()["buckets"]
+        assert weekly[0] == {"start": "2020-01-06T00:00:00", "count": 2}
+        assert sum(bucket["count"] for bucket in weekly) == 3 and weekly[-1]["start"] == "2020-03-02T00:00:00"
+        monthly = client.get("/analytics/timeseries", params={"interval": "month", "movie_id": drama_id}).json()["buckets"]
+        assert [bucket["count"] for bucket in monthly] == [2, 0, 1]
+        assert client.get("/analytics/timeseries", params={"interval": "hour"}).status_code == 400
+        # too many buckets is an error, not a truncated series
+        assert client.get("/analytics/timeseries", params={"interval": "day", "since": "2020-01-01T00:00:00",
+                                                           "until": "2023-01-01T00:00:00"}).status_code == 400
+        assert client.get("/analytics/timeseries", params={"interval": "month", "since": "1900-01-01T00:00:00"}).status_code == 400
+        # aware bounds keep their offset: midnight at +02:00 is 22:00 UTC the day before
+        shifted = client.get("/analytics/timeseries", params={"interval": "day", "since": "2020-01-07T00:00:00+02:00",
+                                                              "until": "2020-01-08T00:00:00+02:00"}).json()["buckets"]
+        assert shifted[0]["start"] == "2020-01-06T00:00:00"
+
+        stats = client.get(f"/analytics/users/{user_id}").json()
+        assert (stats["count"], stats["movies"], stats["min"], stats["max"], stats["average"]) == (2, 2, 1.0, 4.5, 2.75)
+        assert stats["last_rated_at"] == "2030-01-15T00:00:00"
+
+        # a new build replaces the mapped snapshot
+        crud.create_rating(db, schemas.RatingCreate(rating=2), comedy_id, users[1].id)
+        analytics.build(db, path)
+        assert client.get(f"/analytics/movies/{comedy_id}/histogram").json()["count"] == 2
+    finally:
+        db.close()
+        analytics_engine.dispose()